@@ -0,0 +1,83 @@
+#!/usr/bin/python2
+# -*- coding: utf-8 -*-
+
+"""Render chat messages with the compiled chat style templates and with the plain template strings"""
+
+import locale
+import os
+import random
+import sys
+
+from time import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QTextDocument
+from PyQt5.QtWidgets import QApplication
+
+from blink.chatwindow import ChatMessage, ChatMessageStyle, ChatSender, HtmlProcessor
+from blink.resources import Resources
+
+
+message_count = 10000
+styles = ['Stockholm', 'Smooth Operator']
+
+words = [u'hello', u'there', u'how', u'are', u'you', u'call', u'me', u'later', u'see', u'http://example.org/page?id=42', u'مرحبا', u'ok', u'thanks']
+
+
+class BaselineChatMessage(ChatMessage):
+    """A chat message with the date, time and text direction implemented as they were before the templates were compiled"""
+
+    @property
+    def date(self):
+        language, encoding = locale.getlocale(locale.LC_TIME)
+        return self.timestamp.strftime('%d %b %Y').decode(encoding or 'ascii')
+
+    @property
+    def time(self):
+        language, encoding = locale.getlocale(locale.LC_TIME)
+        return self.timestamp.strftime('%H:%M').decode(encoding or 'ascii')
+
+    @property
+    def text_direction(self):
+        try:
+            return self.__dict__['text_direction']
+        except KeyError:
+            document = QTextDocument()
+            document.setHtml(self.message)
+            return self.__dict__.setdefault('text_direction', 'rtl' if document.firstBlock().textDirection() == Qt.RightToLeft else 'ltr')
+
+
+def create_messages(count, message_class):
+    generator = random.Random(42)
+    senders = [ChatSender(u'Alice', u'alice@example.org', Resources.get('icons/default-avatar.png')), ChatSender(u'Bob', u'bob@example.org', Resources.get('icons/default-avatar.png'))]
+    messages = []
+    for n in xrange(count):
+        text = u' '.join(generator.choice(words) for i in xrange(generator.randrange(1, 20)))
+        message = message_class(HtmlProcessor.process(text), generator.choice(senders), generator.choice(['incoming', 'outgoing']))
+        message.consecutive = n % 3 != 0
+        messages.append(message)
+    return messages
+
+
+def render(messages, message_template, continuation_template):
+    start = time()
+    for message in messages:
+        template = continuation_template if message.consecutive else message_template
+        template.format(message=message, user_icons='show-icons')
+    return time() - start
+
+
+def main():
+    for name in styles:
+        style = ChatMessageStyle(name)
+        # new messages for every run, as the text direction is cached on the message
+        compiled = render(create_messages(message_count, ChatMessage), style.html.message, style.html.message_continuation)
+        plain = render(create_messages(message_count, BaselineChatMessage), unicode(style.html.message), unicode(style.html.message_continuation))
+        print '%-16s compiled templates %6.1fms, baseline (template strings and message properties) %6.1fms for %d messages' % (name, compiled * 1000, plain * 1000, message_count)
+
+
+if __name__ == '__main__':
+    application = QApplication(sys.argv)  # needed by the QTextDocument used by the baseline messages
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/python2
+
+"""Replay typing into the contact search over a synthetic contact list and report how long the UI is blocked"""
+
+import os
+import random
+import sys
+
+from time import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from PyQt5.QtCore import Qt, QAbstractListModel, QEventLoop, QModelIndex, QObject, QSortFilterProxyModel
+from PyQt5.QtWidgets import QApplication
+
+from blink.contacts import ContactSearchIndex, ContactSearchModel, Group
+
+
+contact_count = 50000
+typing_delay = 0.08  # seconds between keystrokes
+queries = [u'john smith', u'maria', u'4455', u'alex wil', u'zzz']
+
+first_names = [u'john', u'maria', u'alex', u'anna', u'peter', u'elena', u'david', u'sofia', u'michael', u'laura', u'george', u'ioana', u'daniel', u'eva', u'thomas', u'nina']
+last_names = [u'smith', u'popescu', u'wilson', u'garcia', u'muller', u'rossi', u'novak', u'jansen', u'kowalski', u'silva', u'dubois', u'larsen', u'ivanov', u'nagy', u'moreau', u'costa']
+
+
+class SyntheticGroup(object):
+    virtual = True
+
+
+class SyntheticURI(object):
+    def __init__(self, uri):
+        self.uri = uri
+
+
+class SyntheticContact(object):
+    def __init__(self, name, uris, group):
+        self.name = name
+        self.uris = uris
+        self.group = group
+
+
+class SyntheticContactModel(QAbstractListModel):
+    def __init__(self, count, parent=None):
+        super(SyntheticContactModel, self).__init__(parent)
+        group = SyntheticGroup()
+        generator = random.Random(42)
+        self.items = []
+        self.search_index = ContactSearchIndex()
+        for n in xrange(count):
+            first_name, last_name = generator.choice(first_names), generator.choice(last_names)
+            uris = [SyntheticURI(u'sip:%s.%s%d@example.org' % (first_name, last_name, n)), SyntheticURI(u'+40%09d@example.org' % generator.randrange(10**9))]
+            contact = SyntheticContact(u'%s %s %d' % (first_name.title(), last_name.title(), n), uris, group)
+            self.items.append(contact)
+            self.search_index.add(contact)
+
+    def rowCount(self, parent=QModelIndex()):
+        return len(self.items)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole:
+            return self.items[index.row()].name
+        elif role == Qt.UserRole:
+            return self.items[index.row()]
+        return None
+
+
+class SearchListOwner(QObject):
+    search_list = None
+
+
+class BaselineSearchModel(QSortFilterProxyModel):
+    """The contact search as it was before the search index, which scans the text of every contact for every keystroke"""
+
+    def __init__(self, model, parent=None):
+        super(BaselineSearchModel, self).__init__(parent)
+        self.setSourceModel(model)
+        self.setDynamicSortFilter(True)
+        self.sort(0)
+
+    def filterAcceptsRow(self, source_row, source_parent):
+        source_model = self.sourceModel()
+        source_index = source_model.index(source_row, 0, source_parent)
+        item = source_index.data(Qt.UserRole)
+        if isinstance(item, Group) or not item.group.virtual:
+            return False
+        search_tokens = self.filterRegExp().pattern().lower().split()
+        searched_item = u' '.join([item.name] + [uri.uri for uri in item.uris]).lower()
+        return all(token in searched_item for token in search_tokens)
+
+    def lessThan(self, left_index, right_index):
+        return left_index.data(Qt.DisplayRole) < right_index.data(Qt.DisplayRole)
+
+
+def run_events(application, duration):
+    """Run the event loop for duration seconds and return the longest time it was blocked"""
+    stall = 0
+    deadline = time() + duration
+    while time() < deadline:
+        start = time()
+        application.processEvents(QEventLoop.AllEvents)
+        stall = max(stall, time() - start)
+    return stall
+
+
+def replay_typing(application, search_model, query):
+    finished = []
+    search_model.searchFinished.connect(lambda: finished.append(time()))
+    stall = 0
+    for length in xrange(1, len(query)+1):
+        search_model.search(query[:length])
+        typed = time()
+        stall = max(stall, run_events(application, typing_delay))
+    while not finished:
+        stall = max(stall, run_events(application, 0.01))
+    search_model.searchFinished.disconnect()
+    return finished[-1] - typed, stall, search_model.rowCount()
+
+
+def filter_per_keystroke(application, search_model, query):
+    durations = []
+    for length in xrange(1, len(query)+1):
+        start = time()
+        search_model.setFilterFixedString(query[:length])
+        application.processEvents(QEventLoop.AllEvents)
+        durations.append(time() - start)
+    return sum(durations), max(durations), search_model.rowCount()
+
+
+def main():
+    application = QApplication(sys.argv)
+    start = time()
+    model = SyntheticContactModel(contact_count)
+    print 'Indexed %d contacts in %.2fs' % (contact_count, time() - start)
+
+    owner = SearchListOwner()
+    search_model = ContactSearchModel(model, owner)
+    print
+    print 'Debounced search (%dms between keystrokes)' % (typing_delay * 1000)
+    for query in queries:
+        latency, stall, results = replay_typing(application, search_model, query)
+        print '  %-12r %6d results, %7.1fms after the last keystroke, longest stall %6.1fms' % (query, results, latency * 1000, stall * 1000)
+        search_model.search(u'')
+
+    print
+    print 'Filtering on every keystroke by scanning every contact (before the search index)'
+    search_model = BaselineSearchModel(model, owner)
+    for query in queries:
+        total, longest, results = filter_per_keystroke(application, search_model, query)
+        print '  %-12r %6d results, %7.1fms in total, longest keystroke %6.1fms' % (query, results, total * 1000, longest * 1000)
+        search_model.setFilterFixedString(u'')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/python2
+
+"""Feed a synthetic full-state watcher list with many pending watchers to the presence subscription handler"""
+
+import os
+import random
+import sys
+
+from time import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from application.notification import IObserver, Notification, NotificationCenter, NotificationData
+from twisted.internet import reactor
+from zope.interface import implements
+
+from blink.addressbook import AddressbookIndex
+from blink.presence import PresenceSubscriptionHandler
+
+
+contact_count = 20000
+policy_count = 5000
+watcher_count = 5000
+
+
+class SyntheticPresence(object):
+    def __init__(self, policy):
+        self.policy = policy
+
+
+class SyntheticURI(object):
+    def __init__(self, uri):
+        self.uri = uri
+
+
+class SyntheticContact(object):
+    def __init__(self, uris, policy):
+        self.uris = [SyntheticURI(uri) for uri in uris]
+        self.presence = SyntheticPresence(policy)
+
+
+class SyntheticPolicy(object):
+    def __init__(self, uri, policy):
+        self.uri = uri
+        self.presence = SyntheticPresence(policy)
+
+
+class SyntheticWatcher(object):
+    def __init__(self, sipuri, status):
+        self.sipuri = sipuri
+        self.status = status
+
+
+class SyntheticAccount(object):
+    id = u'bench@example.org'
+
+
+class PendingWatcherCollector(object):
+    implements(IObserver)
+
+    def __init__(self):
+        self.uris = []
+
+    def handle_notification(self, notification):
+        self.uris.append(notification.data.uri)
+
+
+def legacy_pending_watchers(pending, contacts, policies):
+    """The linear scans that were done for every pending watcher before the index was used"""
+    result = []
+    for uri in pending:
+        if next((policy for policy in policies if policy.uri == uri and policy.presence.policy != 'default'), None) is not None:
+            continue
+        if next((contact for contact in contacts if uri in (contact_uri.uri for contact_uri in contact.uris) and contact.presence.policy != 'default'), None) is not None:
+            continue
+        result.append(uri)
+    return result
+
+
+def main():
+    generator = random.Random(42)
+    contacts = [SyntheticContact([u'contact%d@example.org' % n, u'contact%d@example.net' % n], generator.choice(['default', 'allow', 'block'])) for n in xrange(contact_count)]
+    policies = [SyntheticPolicy(u'policy%d@example.org' % n, generator.choice(['default', 'allow', 'block'])) for n in xrange(policy_count)]
+    watchers = [SyntheticWatcher(u'sip:%s%d@example.org' % (generator.choice(['contact', 'policy', 'stranger']), generator.randrange(contact_count)), generator.choice(['pending', 'waiting', 'active'])) for n in xrange(watcher_count)]
+
+    index = AddressbookIndex()
+    start = time()
+    with index._lock:
+        for contact in contacts:
+            index._add_contact(contact)
+        for policy in policies:
+            index._add_policy(policy)
+    print 'Indexed %d contacts and %d policies in %.1fms' % (contact_count, policy_count, (time() - start) * 1000)
+
+    collector = PendingWatcherCollector()
+    notification_center = NotificationCenter()
+    notification_center.add_observer(collector, name='SIPAccountGotPendingWatcher')
+
+    handler = PresenceSubscriptionHandler()
+    notification = Notification('SIPAccountGotPresenceWinfo', SyntheticAccount(), NotificationData(state='full', watcher_list=watchers))
+    notification.center = notification_center
+    start = time()
+    handler._NH_SIPAccountGotPresenceWinfo(notification)
+    duration = time() - start
+    pending = handler._winfo_map[SyntheticAccount.id].get('pending', set()) | handler._winfo_map[SyntheticAccount.id].get('waiting', set())
+    print 'Processed %d watchers (%d pending) in %.1fms, %d need authorization' % (watcher_count, len(pending), duration * 1000, len(collector.uris))
+
+    sample = sorted(pending)[:200]
+    start = time()
+    legacy_pending_watchers(sample, contacts, policies)
+    print 'The linear scans took %.1fms for %d of the pending watchers' % ((time() - start) * 1000, len(sample))
+
+    for call in reactor.getDelayedCalls():
+        call.cancel()
+
+
+if __name__ == '__main__':
+    main()
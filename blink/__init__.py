@@ -28,6 +28,7 @@ try:
 except ImportError:
     branding = Null
 
+from blink.addressbook import AddressbookIndex
 from blink.chatwindow import ChatWindow
 from blink.configuration.account import AccountExtension, BonjourAccountExtension
 from blink.configuration.addressbook import ContactExtension, GroupExtension
@@ -97,6 +98,7 @@ class Blink(QApplication):
         super(Blink, self).__init__(sys.argv)
         self.setAttribute(Qt.AA_DontShowIconsInMenus, False)
         self.sip_application = SIPApplication()
+        self.addressbook_index = AddressbookIndex()
         self.first_run = False
 
         self.setOrganizationDomain("ag-projects.com")
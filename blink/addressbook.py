@@ -0,0 +1,123 @@
+"""Fast lookups into the addressbook"""
+
+import re
+
+from application.notification import IObserver, NotificationCenter
+from application.python import Null
+from application.python.types import Singleton
+from threading import Lock
+from zope.interface import implements
+
+from sipsimple.addressbook import AddressbookManager
+
+
+__all__ = ['AddressbookIndex']
+
+
+class AddressbookIndex(object):
+    """Map URIs to the addressbook contacts and policies that have them"""
+
+    __metaclass__ = Singleton
+    implements(IObserver)
+
+    sip_prefix_re = re.compile('^sips?:')
+
+    def __init__(self):
+        self._lock = Lock()
+        self._contact_map = {}  # normalized uri -> [contact, ...]
+        self._uri_map = {}      # contact -> {normalized uri, ...}
+        self._policy_map = {}   # normalized uri -> [policy, ...]
+        self._policy_uris = {}  # policy -> normalized uri
+        notification_center = NotificationCenter()
+        notification_center.add_observer(self, name='AddressbookContactWasActivated')
+        notification_center.add_observer(self, name='AddressbookContactWasDeleted')
+        notification_center.add_observer(self, name='AddressbookContactDidChange')
+        notification_center.add_observer(self, name='AddressbookPolicyWasActivated')
+        notification_center.add_observer(self, name='AddressbookPolicyWasDeleted')
+        notification_center.add_observer(self, name='AddressbookPolicyDidChange')
+        addressbook_manager = AddressbookManager()
+        with self._lock:
+            for contact in addressbook_manager.get_contacts():
+                self._add_contact(contact)
+            for policy in addressbook_manager.get_policies():
+                self._add_policy(policy)
+
+    @classmethod
+    def normalize(cls, uri):
+        return cls.sip_prefix_re.sub('', uri)
+
+    def get_contacts(self, uri):
+        with self._lock:
+            return list(self._contact_map.get(self.normalize(uri), ()))
+
+    def get_policies(self, uri):
+        with self._lock:
+            return list(self._policy_map.get(self.normalize(uri), ()))
+
+    def has_presence_policy(self, uri):
+        """Return True if a policy or a contact for uri sets a presence policy other than the default one"""
+        with self._lock:
+            uri = self.normalize(uri)
+            items = self._policy_map.get(uri, []) + self._contact_map.get(uri, [])
+        return any(item.presence.policy != 'default' for item in items)
+
+    def _add_contact(self, contact):
+        uris = {self.normalize(contact_uri.uri) for contact_uri in contact.uris}
+        self._uri_map[contact] = uris
+        for uri in uris:
+            self._contact_map.setdefault(uri, []).append(contact)
+
+    def _remove_contact(self, contact):
+        for uri in self._uri_map.pop(contact, ()):
+            contacts = self._contact_map[uri]
+            contacts.remove(contact)
+            if not contacts:
+                del self._contact_map[uri]
+
+    def _add_policy(self, policy):
+        uri = self._policy_uris[policy] = self.normalize(policy.uri)
+        self._policy_map.setdefault(uri, []).append(policy)
+
+    def _remove_policy(self, policy):
+        try:
+            uri = self._policy_uris.pop(policy)
+        except KeyError:
+            return
+        policies = self._policy_map[uri]
+        policies.remove(policy)
+        if not policies:
+            del self._policy_map[uri]
+
+    def handle_notification(self, notification):
+        handler = getattr(self, '_NH_%s' % notification.name, Null)
+        handler(notification)
+
+    def _NH_AddressbookContactWasActivated(self, notification):
+        with self._lock:
+            self._remove_contact(notification.sender)
+            self._add_contact(notification.sender)
+
+    def _NH_AddressbookContactWasDeleted(self, notification):
+        with self._lock:
+            self._remove_contact(notification.sender)
+
+    def _NH_AddressbookContactDidChange(self, notification):
+        if any(key.startswith('uris') for key in notification.data.modified):
+            with self._lock:
+                self._remove_contact(notification.sender)
+                self._add_contact(notification.sender)
+
+    def _NH_AddressbookPolicyWasActivated(self, notification):
+        with self._lock:
+            self._remove_policy(notification.sender)
+            self._add_policy(notification.sender)
+
+    def _NH_AddressbookPolicyWasDeleted(self, notification):
+        with self._lock:
+            self._remove_policy(notification.sender)
+
+    def _NH_AddressbookPolicyDidChange(self, notification):
+        if 'uri' in notification.data.modified:
+            with self._lock:
+                self._remove_policy(notification.sender)
+                self._add_policy(notification.sender)
@@ -1,9 +1,12 @@
 
 from __future__ import division
 
+import hashlib
 import locale
 import os
 import re
+import unicodedata
+import zlib
 
 from PyQt5 import uic
 from PyQt5.QtCore import Qt, QBuffer, QEasingCurve, QEvent, QPoint, QPointF, QPropertyAnimation, QRect, QRectF, QSettings, QSize, QSizeF, QTimer, QUrl, pyqtSignal
@@ -17,13 +20,17 @@ from abc import ABCMeta, abstractmethod
 from application.notification import IObserver, NotificationCenter, ObserverWeakrefProxy
 from application.python import Null, limit
 from application.python.descriptor import WriteOnceAttribute
-from application.python.types import MarkerType
-from application.system import makedirs
+from application.python.threadpool import ThreadPool, run_in_threadpool
+from application.python.types import MarkerType, Singleton
+from application.system import makedirs, unlink
 from collections import MutableSet, deque
 from datetime import datetime, timedelta
 from itertools import count
 from lxml import etree, html
 from lxml.html.clean import autolink
+from operator import attrgetter
+from threading import Lock
+from time import time
 from weakref import proxy
 from zope.interface import implements
 
@@ -37,7 +44,8 @@ from sipsimple.threading import run_in_thread
 from blink.configuration.datatypes import FileURL, GraphTimeScale
 from blink.configuration.settings import BlinkSettings
 from blink.contacts import URIUtils
-from blink.resources import IconManager, Resources
+from blink.history import ChatArchive, ChatArchiveEntry
+from blink.resources import ApplicationData, IconManager, Resources
 from blink.sessions import ChatSessionModel, ChatSessionListView, SessionManager, StreamDescription
 from blink.util import run_in_gui_thread
 from blink.widgets.color import ColorHelperMixin
@@ -60,14 +68,50 @@ class Container(object): pass
 class ChatStyleError(Exception): pass
 
 
+class ChatHtmlTemplate(object):
+    """
+    A chat html fragment in str.format syntax, compiled to a positional
+    template that gets every distinct field only once per rendering
+    """
+
+    def __init__(self, template):
+        self.template = template
+        self.fields = []
+        field_indexes = {}
+        parts = []
+        for literal, field_name, format_spec, conversion in template._formatter_parser():
+            parts.append(literal.replace(u'{', u'{{').replace(u'}', u'}}'))
+            if field_name is None:
+                continue
+            if field_name not in field_indexes:
+                name, lookups = field_name._formatter_field_name_split()
+                lookups = list(lookups)
+                if not isinstance(name, basestring) or not name:
+                    raise ChatStyleError("only named fields are supported in chat message html templates: %r" % field_name)
+                if not all(is_attribute for is_attribute, key in lookups):
+                    raise ChatStyleError("only attribute lookups are supported in chat message html templates: %r" % field_name)
+                field_indexes[field_name] = len(self.fields)
+                self.fields.append((name, attrgetter('.'.join(key for is_attribute, key in lookups)) if lookups else None))
+            parts.append(u'{%d%s%s}' % (field_indexes[field_name], u'!' + conversion if conversion else u'', u':' + format_spec if format_spec else u''))
+        self.compiled_template = u''.join(parts)
+
+    def __unicode__(self):
+        return self.template
+
+    def format(self, **kw):
+        return self.compiled_template.format(*[kw[name] if getter is None else getter(kw[name]) for name, getter in self.fields])
+
+
 class ChatHtmlTemplates(object):
     def __init__(self, style_path):
         try:
-            self.message = open(os.path.join(style_path, 'html/message.html')).read().decode('utf-8')
-            self.message_continuation = open(os.path.join(style_path, 'html/message_continuation.html')).read().decode('utf-8')
-            self.notification = open(os.path.join(style_path, 'html/notification.html')).read().decode('utf-8')
+            self.message = ChatHtmlTemplate(open(os.path.join(style_path, 'html/message.html')).read().decode('utf-8'))
+            self.message_continuation = ChatHtmlTemplate(open(os.path.join(style_path, 'html/message_continuation.html')).read().decode('utf-8'))
+            self.notification = ChatHtmlTemplate(open(os.path.join(style_path, 'html/notification.html')).read().decode('utf-8'))
         except (OSError, IOError):
             raise ChatStyleError("missing or unreadable chat message html template files in %s" % os.path.join(style_path, 'html'))
+        except ValueError, e:
+            raise ChatStyleError("invalid chat message html template in %s: %s" % (os.path.join(style_path, 'html'), e))
 
 
 class ChatMessageStyle(object):
@@ -226,6 +270,10 @@ class ChatContent(object):
 
     continuation_interval = timedelta(0, 5*60)  # 5 minutes
 
+    markup_re = re.compile(r'<(head|script|style)\b.*?</\1\s*>|<[^>]*>|&[^;\s]*;', re.I | re.S)  # the parts of a html message that are not text
+
+    _time_encoding = None
+
     history = ChatContentBooleanOption('history')
     focus = ChatContentBooleanOption('focus')
     consecutive = ChatContentBooleanOption('consecutive')
@@ -242,24 +290,39 @@ class ChatContent(object):
     def css_classes(self):
         return ' '.join(self.__cssclasses__)
 
+    @property
+    def time_encoding(self):
+        # the locale doesn't change while the application is running, so the encoding only needs to be looked up once
+        if ChatContent._time_encoding is None:
+            language, encoding = locale.getlocale(locale.LC_TIME)
+            ChatContent._time_encoding = encoding or 'ascii'
+        return ChatContent._time_encoding
+
     @property
     def date(self):
-        language, encoding = locale.getlocale(locale.LC_TIME)
-        return self.timestamp.strftime('%d %b %Y').decode(encoding or 'ascii')
+        return self.timestamp.strftime('%d %b %Y').decode(self.time_encoding)
 
     @property
     def time(self):
-        language, encoding = locale.getlocale(locale.LC_TIME)
-        return self.timestamp.strftime('%H:%M').decode(encoding or 'ascii')
+        return self.timestamp.strftime('%H:%M').decode(self.time_encoding)
 
     @property
     def text_direction(self):
         try:
             return self.__dict__['text_direction']
         except KeyError:
-            document = QTextDocument()
-            document.setHtml(self.message)
-            return self.__dict__.setdefault('text_direction', 'rtl' if document.firstBlock().textDirection() == Qt.RightToLeft else 'ltr')
+            return self.__dict__.setdefault('text_direction', self._get_text_direction())
+
+    def _get_text_direction(self):
+        # the direction is given by the first character with a strong direction, which is how QTextDocument determines the direction of a block
+        message = self.message if isinstance(self.message, unicode) else self.message.decode('utf-8', 'replace')
+        for char in self.markup_re.sub(u'', message):
+            direction = unicodedata.bidirectional(char)
+            if direction == 'L':
+                return 'ltr'
+            elif direction in ('R', 'AL'):
+                return 'rtl'
+        return 'ltr'
 
     def add_css_class(self, name):
         self.__cssclasses__.add(name)
@@ -355,9 +418,11 @@ class ChatWebPage(QWebPage):
 
 class ChatWebView(QWebView):
     sizeChanged = pyqtSignal()
+    scrolled = pyqtSignal()
 
     def __init__(self, parent=None):
         super(ChatWebView, self).__init__(parent)
+        self.scroll_position = None
         palette = self.palette()
         palette.setBrush(QPalette.Base, Qt.transparent)
         self.setPalette(palette)
@@ -377,6 +442,14 @@ class ChatWebView(QWebView):
     def dragEnterEvent(self, event):
         event.ignore()  # let the parent process DND
 
+    def paintEvent(self, event):
+        super(ChatWebView, self).paintEvent(event)
+        # QWebView doesn't signal scrolling, but every scroll results in a repaint
+        scroll_position = self.page().mainFrame().scrollPosition()
+        if scroll_position != self.scroll_position:
+            self.scroll_position = scroll_position
+            self.scrolled.emit()
+
     def resizeEvent(self, event):
         super(ChatWebView, self).resizeEvent(event)
         self.sizeChanged.emit()
@@ -558,8 +631,21 @@ class IconDescriptor(object):
 
 
 class Thumbnail(object):
+    max_size = QSize(1280, 720)
+
     def __new__(cls, filename):
-        image_reader = QImageReader(filename)
+        return cls.from_reader(QImageReader(filename))
+
+    @classmethod
+    def from_data(cls, data):
+        buffer = QBuffer()
+        buffer.setData(data)
+        buffer.open(QBuffer.ReadOnly)
+        return cls.from_reader(QImageReader(buffer))
+
+    @classmethod
+    def from_reader(cls, image_reader):
+        # only QImage is used, so that thumbnails can be created outside the GUI thread
         if image_reader.canRead() and image_reader.size().isValid():
             if image_reader.supportsAnimation() and image_reader.imageCount() > 1:
                 image_format = str(image_reader.format())
@@ -568,9 +654,9 @@ class Thumbnail(object):
                 file_format = str(image_reader.format())
                 file_size = image_reader.device().size()
                 image_size = image_reader.size()
-                if image_size.height() > 720:
-                    image_reader.setScaledSize(image_size * 720 / image_size.height())
-                image = QPixmap.fromImageReader(image_reader)
+                if image_size.width() > cls.max_size.width() or image_size.height() > cls.max_size.height():
+                    image_reader.setScaledSize(image_size.scaled(cls.max_size, Qt.KeepAspectRatio))
+                image = image_reader.read()
                 image_buffer = QBuffer()
                 image_format = 'png' if image.hasAlphaChannel() or (file_format in {'png', 'tiff', 'ico'} and file_size <= 100*1024) else 'jpeg'
                 image.save(image_buffer, image_format)
@@ -618,6 +704,131 @@ class FileDescriptor(object):
         return QUrl.fromLocalFile(self.filename).toString()
 
 
+class ChatImage(object):
+    def __init__(self, filename, thumbnail_filename):
+        self.filename = filename
+        self.thumbnail_filename = thumbnail_filename
+
+    @property
+    def url(self):
+        return QUrl.fromLocalFile(self.filename).toString()
+
+    @property
+    def thumbnail_url(self):
+        return QUrl.fromLocalFile(self.thumbnail_filename).toString()
+
+
+class ChatImageCache(object):
+    """Store the images exchanged in chat messages on disk by content, together with the thumbnails used to display them"""
+
+    __metaclass__ = Singleton
+
+    threadpool = ThreadPool(name='chat-images', min_threads=1, max_threads=4)
+    threadpool.start()
+
+    extensions = {'bmp': 'bmp', 'gif': 'gif', 'ico': 'ico', 'jpeg': 'jpg', 'jpg': 'jpg', 'mng': 'mng', 'png': 'png', 'svg': 'svg', 'tiff': 'tif', 'webp': 'webp'}  # image format -> file extension
+
+    max_age = 30*24*60*60      # seconds after their last use when images are removed
+    max_size = 512*1024*1024   # bytes, the least recently used images are removed above it
+
+    def __init__(self):
+        self.directory = ApplicationData.get('chat_images')
+        self._lock = Lock()
+        self._requests = {}  # digest -> [callback, ...] for the images being processed
+        self._cleanup()
+
+    def add(self, data, callback):
+        """Store the image and create its thumbnail in the background, then call callback with the digest and the ChatImage, or None if the data is not a valid image. Return the digest"""
+        digest = hashlib.sha1(data).hexdigest()
+        with self._lock:
+            if digest in self._requests:
+                self._requests[digest].append(callback)
+                return digest
+            self._requests[digest] = [callback]
+        self._add(digest, data)
+        return digest
+
+    @run_in_threadpool(threadpool)
+    def _add(self, digest, data):
+        try:
+            image = self._load(digest, data) or self._create(digest, data)
+        except (IOError, OSError):
+            image = None
+        with self._lock:
+            callbacks = self._requests.pop(digest)
+        for callback in callbacks:
+            callback(digest, image)
+
+    def _filename(self, digest, data):
+        buffer = QBuffer()
+        buffer.setData(data)
+        buffer.open(QBuffer.ReadOnly)
+        # the extension is chosen from a fixed set based on the format detected from the content, never from what the peer says the content is
+        image_format = str(QImageReader.imageFormat(buffer)).lower()
+        return os.path.join(self.directory, '%s.%s' % (digest, self.extensions.get(image_format, 'img')))
+
+    def _load(self, digest, data):
+        filename = self._filename(digest, data)
+        try:
+            os.utime(filename, None)  # the modification time of the image records its last use
+        except OSError:
+            return None
+        # the thumbnail is written before the image, so if the image exists so does the thumbnail, unless the image is its own thumbnail
+        thumbnail_filename = next(name for name in (os.path.join(self.directory, digest + '-thumbnail.jpeg'), os.path.join(self.directory, digest + '-thumbnail.png'), filename) if os.path.exists(name))
+        return ChatImage(filename, thumbnail_filename)
+
+    def _create(self, digest, data):
+        thumbnail = Thumbnail.from_data(data)
+        if thumbnail is None:
+            return None
+        filename = self._filename(digest, data)
+        makedirs(self.directory)
+        if thumbnail.data == data:
+            thumbnail_filename = filename
+        else:
+            thumbnail_filename = os.path.join(self.directory, '%s-thumbnail.%s' % (digest, thumbnail.type.partition('/')[2]))
+            self._write(thumbnail_filename, thumbnail.data)
+        self._write(filename, data)
+        return ChatImage(filename, thumbnail_filename)
+
+    @run_in_threadpool(threadpool)
+    def _cleanup(self):
+        """Remove the images that were not used recently, or the least recently used ones if the cache is too big, together with their thumbnails"""
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        images = {}  # digest -> [last use, size, [filename, ...]]
+        for name in names:
+            filename = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            image = images.setdefault(name.partition('.')[0].partition('-')[0], [0, 0, []])
+            image[0] = max(image[0], stat.st_mtime)
+            image[1] += stat.st_size
+            image[2].append(filename)
+        expire_time = time() - self.max_age
+        cache_size = sum(size for last_use, size, filenames in images.itervalues())
+        for last_use, size, filenames in sorted(images.itervalues()):
+            if last_use >= expire_time and cache_size <= self.max_size:
+                break
+            for filename in filenames:
+                unlink(filename)
+            cache_size -= size
+
+    @staticmethod
+    def _write(filename, data):
+        with open(filename + '.tmp', 'wb') as f:
+            f.write(data)
+        try:
+            os.rename(filename + '.tmp', filename)  # a file that exists is always complete, as the files are also looked up from other threads
+        except OSError:
+            unlink(filename)
+            os.rename(filename + '.tmp', filename)
+
+
 ui_class, base_class = uic.loadUiType(Resources.get('chat_widget.ui'))
 
 
@@ -629,6 +840,11 @@ class ChatWidget(base_class, ui_class):
     chat_template = open(Resources.get('chat/template.html')).read()
 
     image_data_re = re.compile(r"data:(?P<type>image/.+?);base64,(?P<data>.*)", re.I|re.U)
+    insertion_point_re = re.compile(r'<(?P<tag>\w+) id="insert"></(?P=tag)>')
+
+    visible_blocks = 200     # how many top level blocks (a message with its continuations or a notification) are kept in the chat view
+    backlog_page_size = 50   # how many blocks are brought back from the backlog when scrolling to the top of the chat view
+    history_page_size = 25   # how many messages are loaded from the chat archive at a time, once the backlog is exhausted
 
     def __init__(self, session, parent=None):
         super(ChatWidget, self).__init__(parent)
@@ -644,15 +860,26 @@ class ChatWidget(base_class, ui_class):
         self.chat_element = self.chat_view.page().mainFrame().findFirstElement('#chat')
         self.composing_timer = QTimer()
         self.last_message = None
+        self.backlog = []  # the compressed html of the blocks removed from the chat view, oldest first
+        self._images = {}  # digest -> ChatImage or None, for the images that finished processing
+        self._block_count = 0
+        self._last_block = self.chat_element.lastChild()
+        self._scroll_anchor = None
+        self._history_before = None
+        self._history_until = time()  # messages archived after this are already displayed
+        self._history_complete = False
+        self._history_loading = False
         self.session = session
         if session is not None:
             notification_center = NotificationCenter()
             notification_center.add_observer(ObserverWeakrefProxy(self), sender=session.blink_session)
+            self._load_history()
         # connect to signals
         self.chat_input.textChanged.connect(self._SH_ChatInputTextChanged)
         self.chat_input.textEntered.connect(self._SH_ChatInputTextEntered)
         self.chat_input.lockReleased.connect(self._SH_ChatInputLockReleased)
         self.chat_view.sizeChanged.connect(self._SH_ChatViewSizeChanged)
+        self.chat_view.scrolled.connect(self._SH_ChatViewScrolled, Qt.QueuedConnection)
         self.chat_view.page().mainFrame().contentsSizeChanged.connect(self._SH_ChatViewFrameContentsSizeChanged)
         self.composing_timer.timeout.connect(self._SH_ComposingTimerTimeout)
 
@@ -660,6 +887,11 @@ class ChatWidget(base_class, ui_class):
     def user_icon(self):
         return IconManager().get('avatar') or self.default_user_icon
 
+    @property
+    def archive_uri(self):
+        uri = self.session.blink_session.uri if self.session is not None else None
+        return u'%s@%s' % (uri.user, uri.host) if uri is not None else None
+
     def add_message(self, message):
         insertion_point = self.chat_element.findFirst('#insert')
         if message.is_related_to(self.last_message):
@@ -669,6 +901,110 @@ class ChatWidget(base_class, ui_class):
             insertion_point.removeFromDocument()
             self.chat_element.appendInside(message.to_html(self.style, user_icons=self.user_icons_css_class))
         self.last_message = message
+        self._update_blocks()
+
+    def image_html(self, data, content_type, link=None):
+        """Return the HTML for an image, which is displayed once its thumbnail was created in the background"""
+        link_attribute = u' href="{}"'.format(link) if link is not None else u''
+        if (self.session.chat_stream or Null).encryption.active:
+            # images from off the record chats are only kept in memory, they are never written to the image cache
+            return u'<a{}><img src="data:{};base64,{}" class="scaled-to-fit" /></a>'.format(link_attribute, HtmlProcessor.escape(content_type), data.encode('base64').replace('\n', ''))
+        digest = ChatImageCache().add(data, self._image_ready)
+        return u'<a{} data-image="{}"><img class="scaled-to-fit" /></a>'.format(link_attribute, digest)
+
+    @run_in_gui_thread
+    def _image_ready(self, digest, image):
+        self._images[digest] = image  # the placeholders that are in the backlog right now will be resolved when they are brought back
+        self._show_images('a[data-image="{}"]'.format(digest))
+
+    def _show_images(self, selector='a[data-image]'):
+        for element in self.chat_element.findAll(selector):
+            try:
+                image = self._images[element.attribute('data-image')]
+            except KeyError:
+                continue  # the image is still being processed
+            if image is None:
+                element.removeFromDocument()
+                continue
+            if not element.hasAttribute('href'):
+                element.setAttribute('href', image.url)  # the full image is only opened on demand, when the thumbnail is clicked
+            element.removeAttribute('data-image')
+            element.firstChild().setAttribute('src', image.thumbnail_url)
+
+    def _update_blocks(self):
+        # find the blocks added to the chat element by the last message, by walking back from its end up to the last block we know about
+        element = self.chat_element.lastChild()
+        last_block = None
+        while not element.isNull() and element != self._last_block:
+            if element.attribute('id') != 'insert':
+                last_block = last_block or element
+                self._block_count += 1
+            element = element.previousSibling()
+        if last_block is not None:
+            self._last_block = last_block
+        # move the oldest blocks to the backlog, so that the size of the document (and the cost of adding messages to it) doesn't grow with the conversation
+        while self._block_count > self.visible_blocks:
+            element = self.chat_element.firstChild()
+            self.backlog.append(zlib.compress(element.toOuterXml().encode('utf-8')))
+            element.removeFromDocument()
+            self._block_count -= 1
+
+    def _prepend_blocks(self, html, count):
+        frame = self.chat_view.page().mainFrame()
+        if frame.scrollBarMaximum(Qt.Vertical) > 0:
+            self._scroll_anchor = frame.scrollBarMaximum(Qt.Vertical) - frame.scrollBarValue(Qt.Vertical)  # keep the same content in view after the blocks are added above it
+        self.chat_element.prependInside(html)
+        self._block_count += count
+        if self._images:
+            self._show_images()
+        if self._last_block.isNull():
+            self._last_block = self.chat_element.lastChild()
+        if self._scroll_anchor is None:
+            self._align_chat()
+
+    def _load_backlog(self):
+        blocks = self.backlog[-self.backlog_page_size:]
+        del self.backlog[-self.backlog_page_size:]
+        self._prepend_blocks(u''.join(zlib.decompress(block).decode('utf-8') for block in blocks), len(blocks))
+
+    def _load_history(self):
+        uri = self.archive_uri
+        if uri is None or self._history_complete or self._history_loading:
+            return
+        self._history_loading = True
+        self._fetch_history(uri, self._history_before, self._history_until)
+
+    @run_in_thread('file-io')
+    def _fetch_history(self, uri, before, until):
+        entries = ChatArchive().get_entries(self.history_page_size, before=before, until=until, uri=uri)
+        self._add_history(entries, [HtmlProcessor.process(entry.content, entry.content_type) for entry in entries])
+
+    @run_in_gui_thread
+    def _add_history(self, entries, contents):
+        self._history_loading = False
+        self._history_complete = len(entries) < self.history_page_size
+        if not entries:
+            return
+        self._history_before = entries[-1]
+        html = u''
+        blocks = 0
+        last_message = None
+        for entry, content in reversed(zip(entries, contents)):
+            if entry.direction == 'outgoing':
+                sender = ChatSender(entry.sender_name, entry.sender_uri, self.user_icon.filename)
+            else:
+                sender = ChatSender(entry.sender_name, entry.sender_uri, self.session.icon.filename)
+            message = ChatMessage(content, sender, entry.direction, history=True)
+            message.timestamp = entry.time
+            if message.is_related_to(last_message):
+                message.consecutive = True
+                message_html = message.to_html(self.style, user_icons=self.user_icons_css_class)
+                html = self.insertion_point_re.sub(lambda match: message_html, html, count=1)
+            else:
+                html = self.insertion_point_re.sub(u'', html) + message.to_html(self.style, user_icons=self.user_icons_css_class)
+                blocks += 1
+            last_message = message
+        self._prepend_blocks(self.insertion_point_re.sub(u'', html), blocks)
 
     def send_message(self, content, content_type='text/plain', recipients=None, courtesy_recipients=None, subject=None, timestamp=None, required=None, additional_headers=None):
         blink_session = self.session.blink_session
@@ -686,6 +1022,10 @@ class ChatWidget(base_class, ui_class):
 
         self.session.chat_stream.send_message(content, content_type, recipients, courtesy_recipients, subject, timestamp, required, additional_headers)
 
+        if content_type.startswith('text/') and not self.session.chat_stream.encryption.active:  # off the record messages are not archived
+            account = blink_session.account
+            ChatArchive().add(ChatArchiveEntry(unicode(account.id), self.archive_uri, 'outgoing', account.display_name, unicode(account.id), content_type, content))
+
     def _align_chat(self, scroll=False):
         # frame_height = self.chat_view.page().mainFrame().contentsSize().height()
         widget_height = self.chat_view.size().height()
@@ -748,10 +1088,17 @@ class ChatWidget(base_class, ui_class):
             self._DH_Text(text)
 
     def _DH_Files(self, urls):
+        self._create_file_descriptors([url.toLocalFile() for url in urls])
+
+    @run_in_threadpool(ChatImageCache.threadpool)
+    def _create_file_descriptors(self, filenames):
+        self._send_files([FileDescriptor(filename) for filename in filenames])
+
+    @run_in_gui_thread
+    def _send_files(self, file_descriptors):
         session_manager = SessionManager()
         blink_session = self.session.blink_session
 
-        file_descriptors  = [FileDescriptor(url.toLocalFile()) for url in urls]
         image_descriptors = [descriptor for descriptor in file_descriptors if descriptor.thumbnail is not None]
         other_descriptors = [descriptor for descriptor in file_descriptors if descriptor.thumbnail is None]
 
@@ -761,7 +1108,7 @@ class ChatWidget(base_class, ui_class):
             except Exception, e:
                 self.add_message(ChatStatus("Error sending image '%s': %s" % (os.path.basename(image.filename), e)))  # decide what type to use here. -Dan
             else:
-                content = u'''<a href="{}"><img src="data:{};base64,{}" class="scaled-to-fit" /></a>'''.format(image.fileurl, image.thumbnail.type, image.thumbnail.data.encode('base64').rstrip())
+                content = self.image_html(image.thumbnail.data, image.thumbnail.type, link=image.fileurl)
                 sender  = ChatSender(blink_session.account.display_name, blink_session.account.id, self.user_icon.filename)
                 self.add_message(ChatMessage(content, sender, 'outgoing'))
 
@@ -771,13 +1118,14 @@ class ChatWidget(base_class, ui_class):
     def _DH_Text(self, text):
         match = self.image_data_re.match(text)
         if match is not None:
+            data = match.group('data').decode('base64')
             try:
-                self.send_message(match.group('data').decode('base64'), content_type=match.group('type'))
+                self.send_message(data, content_type=match.group('type'))
             except Exception, e:
                 self.add_message(ChatStatus('Error sending image: %s' % e))  # decide what type to use here. -Dan
             else:
                 account = self.session.blink_session.account
-                content = u'''<img src="{}" class="scaled-to-fit" />'''.format(text)
+                content = self.image_html(data, match.group('type'))
                 sender  = ChatSender(account.display_name, account.id, self.user_icon.filename)
                 self.add_message(ChatMessage(content, sender, 'outgoing'))
         else:
@@ -792,7 +1140,21 @@ class ChatWidget(base_class, ui_class):
 
     def _SH_ChatViewFrameContentsSizeChanged(self, size):
         # print "frame contents size changed to %r (current=%r)" % (size, self.chat_view.page().mainFrame().contentsSize())
-        self._align_chat(scroll=True)
+        if self._scroll_anchor is not None:
+            self._align_chat()
+            frame = self.chat_view.page().mainFrame()
+            frame.setScrollBarValue(Qt.Vertical, frame.scrollBarMaximum(Qt.Vertical) - self._scroll_anchor)
+            self._scroll_anchor = None
+        else:
+            self._align_chat(scroll=True)
+
+    def _SH_ChatViewScrolled(self):
+        frame = self.chat_view.page().mainFrame()
+        if self._scroll_anchor is None and frame.scrollBarValue(Qt.Vertical) <= self.chat_view.size().height()*0.2:
+            if self.backlog:
+                self._load_backlog()
+            else:
+                self._load_history()
 
     def _SH_ChatInputTextChanged(self):
         chat_stream = self.session.chat_stream
@@ -1437,6 +1799,8 @@ class ChatWindow(base_class, ui_class, ColorHelperMixin):
 
     sliding_panels = True
 
+    info_panel_elements = ('status', 'session', 'media', 'statistics')  # the order in which the session info panel elements are updated
+
     __streamtypes__ = {'chat', 'screen-sharing', 'video'} # the stream types for which we show the chat window
 
     def __init__(self, parent=None):
@@ -1445,6 +1809,12 @@ class ChatWindow(base_class, ui_class, ColorHelperMixin):
             self.setupUi()
 
         self.selected_item = None
+        self.selected_session = None
+        self.info_panel_profiler = Null  # a callable that receives the name of each info panel element that is updated and the time in seconds it took
+
+        self._info_panel_pending_elements = set()
+        self._info_panel_pending_visibility = False
+        self._info_panel_statistics_state = None
         self.session_model = ChatSessionModel(self)
         self.session_list.setModel(self.session_model)
         self.session_widget.installEventFilter(self)
@@ -1491,6 +1861,7 @@ class ChatWindow(base_class, ui_class, ColorHelperMixin):
         notification_center.add_observer(self, name='BlinkSessionNewOutgoing')
         notification_center.add_observer(self, name='BlinkSessionDidReinitializeForIncoming')
         notification_center.add_observer(self, name='BlinkSessionDidReinitializeForOutgoing')
+        notification_center.add_observer(self, name='BlinkSessionStatisticsUpdated')
         notification_center.add_observer(self, name='ChatStreamGotMessage')
         notification_center.add_observer(self, name='ChatStreamGotComposingIndication')
         notification_center.add_observer(self, name='ChatStreamDidSendMessage')
@@ -1727,10 +2098,23 @@ class ChatWindow(base_class, ui_class, ColorHelperMixin):
         self.files_panel_participants_button.setVisible(self.selected_session.blink_session.remote_focus)
 
     def _update_session_info_panel(self, elements=set(), update_visibility=False):
+        if self.selected_session is None:
+            return
+        if not self.info_panel.isVisible():
+            # the panel is refreshed with the accumulated changes when it is shown again
+            self._info_panel_pending_elements.update(elements)
+            self._info_panel_pending_visibility = self._info_panel_pending_visibility or update_visibility
+            return
+
+        elements = self._info_panel_pending_elements.union(elements)
+        update_visibility = self._info_panel_pending_visibility or update_visibility
+        self._info_panel_pending_elements.clear()
+        self._info_panel_pending_visibility = False
+
         blink_session = self.selected_session.blink_session
-        have_session = blink_session.state in ('connecting/*', 'connected/*', 'ending')
 
         if update_visibility:
+            have_session = blink_session.state in ('connecting/*', 'connected/*', 'ending')
             self.status_value_label.setEnabled(have_session)
             self.duration_value_label.setEnabled(have_session)
             self.account_value_label.setEnabled(have_session)
@@ -1740,180 +2124,202 @@ class ChatWindow(base_class, ui_class, ColorHelperMixin):
             self.chat_value_widget.setEnabled('chat' in blink_session.streams)
             self.screen_value_widget.setEnabled('screen-sharing' in blink_session.streams)
 
+        for element in self.info_panel_elements:
+            if element in elements:
+                start_time = time()
+                getattr(self, '_update_info_panel_%s' % element)(blink_session)
+                self.info_panel_profiler(element, time() - start_time)
+
+    def _update_info_panel_status(self, blink_session):
+        if blink_session.state not in ('initialized', 'connecting/*', 'connected/*', 'ended'):
+            return
+
+        state_map = {'initialized': 'Disconnected',
+                     'connecting/dns_lookup': 'Finding destination',
+                     'connecting': 'Connecting',
+                     'connecting/ringing': 'Ringing',
+                     'connecting/starting': 'Starting media',
+                     'connected': 'Connected'}
+
+        if blink_session.state == 'ended':
+            self.status_value_label.setForegroundRole(QPalette.AlternateBase if blink_session.state.error else QPalette.WindowText)
+            self.status_value_label.setText(blink_session.state.reason)
+        elif blink_session.state in state_map:
+            self.status_value_label.setForegroundRole(QPalette.WindowText)
+            self.status_value_label.setText(state_map[blink_session.state])
+
+        want_duration = blink_session.state == 'connected/*' or blink_session.state == 'ended' and not blink_session.state.error
+        self.status_title_label.setVisible(not want_duration)
+        self.status_value_label.setVisible(not want_duration)
+        self.duration_title_label.setVisible(want_duration)
+        self.duration_value_label.setVisible(want_duration)
+
+    def _update_info_panel_session(self, blink_session):
         session_info = blink_session.info
+
+        self.account_value_label.setText(blink_session.account.id)
+        self.remote_agent_value_label.setText(session_info.remote_user_agent or u'N/A')
+
+    def _update_info_panel_media(self, blink_session):
         audio_info = blink_session.info.streams.audio
         video_info = blink_session.info.streams.video
         chat_info = blink_session.info.streams.chat
         screen_info = blink_session.info.streams.screen_sharing
 
-        if 'status' in elements and blink_session.state in ('initialized', 'connecting/*', 'connected/*', 'ended'):
-            state_map = {'initialized': 'Disconnected',
-                         'connecting/dns_lookup': 'Finding destination',
-                         'connecting': 'Connecting',
-                         'connecting/ringing': 'Ringing',
-                         'connecting/starting': 'Starting media',
-                         'connected': 'Connected'}
-
-            if blink_session.state == 'ended':
-                self.status_value_label.setForegroundRole(QPalette.AlternateBase if blink_session.state.error else QPalette.WindowText)
-                self.status_value_label.setText(blink_session.state.reason)
-            elif blink_session.state in state_map:
-                self.status_value_label.setForegroundRole(QPalette.WindowText)
-                self.status_value_label.setText(state_map[blink_session.state])
-
-            want_duration = blink_session.state == 'connected/*' or blink_session.state == 'ended' and not blink_session.state.error
-            self.status_title_label.setVisible(not want_duration)
-            self.status_value_label.setVisible(not want_duration)
-            self.duration_title_label.setVisible(want_duration)
-            self.duration_value_label.setVisible(want_duration)
-
-        if 'session' in elements:
-            self.account_value_label.setText(blink_session.account.id)
-            self.remote_agent_value_label.setText(session_info.remote_user_agent or u'N/A')
-
-        if 'media' in elements:
-            self.audio_value_label.setText(audio_info.codec or 'N/A')
-            if audio_info.ice_status == 'succeeded':
-                if 'relay' in {candidate.type.lower() for candidate in (audio_info.local_rtp_candidate, audio_info.remote_rtp_candidate)}:
-                    self.audio_connection_label.setPixmap(self.pixmaps.relay_connection)
-                    self.audio_connection_label.setToolTip(u'Using relay')
-                else:
-                    self.audio_connection_label.setPixmap(self.pixmaps.direct_connection)
-                    self.audio_connection_label.setToolTip(u'Peer to peer')
-            elif audio_info.ice_status == 'failed':
-                self.audio_connection_label.setPixmap(self.pixmaps.unknown_connection)
-                self.audio_connection_label.setToolTip(u"Couldn't negotiate ICE")
-            elif audio_info.ice_status == 'disabled':
-                if blink_session.contact.type == 'bonjour':
-                    self.audio_connection_label.setPixmap(self.pixmaps.direct_connection)
-                    self.audio_connection_label.setToolTip(u'Peer to peer')
-                else:
-                    self.audio_connection_label.setPixmap(self.pixmaps.unknown_connection)
-                    self.audio_connection_label.setToolTip(u'ICE is disabled')
-            elif audio_info.ice_status is None:
-                self.audio_connection_label.setPixmap(self.pixmaps.unknown_connection)
-                self.audio_connection_label.setToolTip(u'ICE is unavailable')
+        self.audio_value_label.setText(audio_info.codec or 'N/A')
+        if audio_info.ice_status == 'succeeded':
+            if 'relay' in {candidate.type.lower() for candidate in (audio_info.local_rtp_candidate, audio_info.remote_rtp_candidate)}:
+                self.audio_connection_label.setPixmap(self.pixmaps.relay_connection)
+                self.audio_connection_label.setToolTip(u'Using relay')
+            else:
+                self.audio_connection_label.setPixmap(self.pixmaps.direct_connection)
+                self.audio_connection_label.setToolTip(u'Peer to peer')
+        elif audio_info.ice_status == 'failed':
+            self.audio_connection_label.setPixmap(self.pixmaps.unknown_connection)
+            self.audio_connection_label.setToolTip(u"Couldn't negotiate ICE")
+        elif audio_info.ice_status == 'disabled':
+            if blink_session.contact.type == 'bonjour':
+                self.audio_connection_label.setPixmap(self.pixmaps.direct_connection)
+                self.audio_connection_label.setToolTip(u'Peer to peer')
             else:
                 self.audio_connection_label.setPixmap(self.pixmaps.unknown_connection)
-                self.audio_connection_label.setToolTip(u'Negotiating ICE')
+                self.audio_connection_label.setToolTip(u'ICE is disabled')
+        elif audio_info.ice_status is None:
+            self.audio_connection_label.setPixmap(self.pixmaps.unknown_connection)
+            self.audio_connection_label.setToolTip(u'ICE is unavailable')
+        else:
+            self.audio_connection_label.setPixmap(self.pixmaps.unknown_connection)
+            self.audio_connection_label.setToolTip(u'Negotiating ICE')
 
-            if audio_info.encryption is not None:
-                self.audio_encryption_label.setToolTip(u'Media is encrypted using %s (%s)' % (audio_info.encryption, audio_info.encryption_cipher))
-            else:
-                self.audio_encryption_label.setToolTip(u'Media is not encrypted')
-            self._update_rtp_encryption_icon(self.audio_encryption_label)
+        if audio_info.encryption is not None:
+            self.audio_encryption_label.setToolTip(u'Media is encrypted using %s (%s)' % (audio_info.encryption, audio_info.encryption_cipher))
+        else:
+            self.audio_encryption_label.setToolTip(u'Media is not encrypted')
+        self._update_rtp_encryption_icon(self.audio_encryption_label)
 
-            self.audio_connection_label.setVisible(audio_info.remote_address is not None)
-            self.audio_encryption_label.setVisible(audio_info.encryption is not None)
+        self.audio_connection_label.setVisible(audio_info.remote_address is not None)
+        self.audio_encryption_label.setVisible(audio_info.encryption is not None)
 
-            self.video_value_label.setText(video_info.codec or 'N/A')
-            if video_info.ice_status == 'succeeded':
-                if 'relay' in {candidate.type.lower() for candidate in (video_info.local_rtp_candidate, video_info.remote_rtp_candidate)}:
-                    self.video_connection_label.setPixmap(self.pixmaps.relay_connection)
-                    self.video_connection_label.setToolTip(u'Using relay')
-                else:
-                    self.video_connection_label.setPixmap(self.pixmaps.direct_connection)
-                    self.video_connection_label.setToolTip(u'Peer to peer')
-            elif video_info.ice_status == 'failed':
-                self.video_connection_label.setPixmap(self.pixmaps.unknown_connection)
-                self.video_connection_label.setToolTip(u"Couldn't negotiate ICE")
-            elif video_info.ice_status == 'disabled':
-                if blink_session.contact.type == 'bonjour':
-                    self.video_connection_label.setPixmap(self.pixmaps.direct_connection)
-                    self.video_connection_label.setToolTip(u'Peer to peer')
-                else:
-                    self.video_connection_label.setPixmap(self.pixmaps.unknown_connection)
-                    self.video_connection_label.setToolTip(u'ICE is disabled')
-            elif video_info.ice_status is None:
-                self.video_connection_label.setPixmap(self.pixmaps.unknown_connection)
-                self.video_connection_label.setToolTip(u'ICE is unavailable')
+        self.video_value_label.setText(video_info.codec or 'N/A')
+        if video_info.ice_status == 'succeeded':
+            if 'relay' in {candidate.type.lower() for candidate in (video_info.local_rtp_candidate, video_info.remote_rtp_candidate)}:
+                self.video_connection_label.setPixmap(self.pixmaps.relay_connection)
+                self.video_connection_label.setToolTip(u'Using relay')
             else:
-                self.video_connection_label.setPixmap(self.pixmaps.unknown_connection)
-                self.video_connection_label.setToolTip(u'Negotiating ICE')
-
-            if video_info.encryption is not None:
-                self.video_encryption_label.setToolTip(u'Media is encrypted using %s (%s)' % (video_info.encryption, video_info.encryption_cipher))
+                self.video_connection_label.setPixmap(self.pixmaps.direct_connection)
+                self.video_connection_label.setToolTip(u'Peer to peer')
+        elif video_info.ice_status == 'failed':
+            self.video_connection_label.setPixmap(self.pixmaps.unknown_connection)
+            self.video_connection_label.setToolTip(u"Couldn't negotiate ICE")
+        elif video_info.ice_status == 'disabled':
+            if blink_session.contact.type == 'bonjour':
+                self.video_connection_label.setPixmap(self.pixmaps.direct_connection)
+                self.video_connection_label.setToolTip(u'Peer to peer')
             else:
-                self.video_encryption_label.setToolTip(u'Media is not encrypted')
-            self._update_rtp_encryption_icon(self.video_encryption_label)
+                self.video_connection_label.setPixmap(self.pixmaps.unknown_connection)
+                self.video_connection_label.setToolTip(u'ICE is disabled')
+        elif video_info.ice_status is None:
+            self.video_connection_label.setPixmap(self.pixmaps.unknown_connection)
+            self.video_connection_label.setToolTip(u'ICE is unavailable')
+        else:
+            self.video_connection_label.setPixmap(self.pixmaps.unknown_connection)
+            self.video_connection_label.setToolTip(u'Negotiating ICE')
 
-            self.video_connection_label.setVisible(video_info.remote_address is not None)
-            self.video_encryption_label.setVisible(video_info.encryption is not None)
+        if video_info.encryption is not None:
+            self.video_encryption_label.setToolTip(u'Media is encrypted using %s (%s)' % (video_info.encryption, video_info.encryption_cipher))
+        else:
+            self.video_encryption_label.setToolTip(u'Media is not encrypted')
+        self._update_rtp_encryption_icon(self.video_encryption_label)
 
-            if self.zrtp_widget.isVisibleTo(self.info_panel):
-                # refresh the ZRTP widget (we need to hide/change/show because in certain configurations it flickers when changed while visible)
-                stream_info = blink_session.info.streams[self.zrtp_widget.stream_type]
-                self.zrtp_widget.hide()
-                self.zrtp_widget.peer_name = stream_info.zrtp_peer_name
-                self.zrtp_widget.peer_verified = stream_info.zrtp_verified
-                self.zrtp_widget.sas = stream_info.zrtp_sas
-                self.zrtp_widget.show()
+        self.video_connection_label.setVisible(video_info.remote_address is not None)
+        self.video_encryption_label.setVisible(video_info.encryption is not None)
 
-            if any(len(path) > 1 for path in (chat_info.full_local_path, chat_info.full_remote_path)):
-                self.chat_value_label.setText(u'Using relay')
-                self.chat_connection_label.setPixmap(self.pixmaps.relay_connection)
-                self.chat_connection_label.setToolTip(u'Using relay')
-            elif chat_info.full_local_path and chat_info.full_remote_path:
-                self.chat_value_label.setText(u'Peer to peer')
-                self.chat_connection_label.setPixmap(self.pixmaps.direct_connection)
-                self.chat_connection_label.setToolTip(u'Peer to peer')
-            else:
-                self.chat_value_label.setText(u'N/A')
-
-            if chat_info.encryption is not None and chat_info.transport == 'tls':
-                self.chat_encryption_label.setToolTip(u'Media is encrypted using TLS and {0.encryption} ({0.encryption_cipher})'.format(chat_info))
-            elif chat_info.encryption is not None:
-                self.chat_encryption_label.setToolTip(u'Media is encrypted using {0.encryption} ({0.encryption_cipher})'.format(chat_info))
-            elif chat_info.transport == 'tls':
-                self.chat_encryption_label.setToolTip(u'Media is encrypted using TLS')
-            else:
-                self.chat_encryption_label.setToolTip(u'Media is not encrypted')
-            self._update_chat_encryption_icon()
+        if self.zrtp_widget.isVisibleTo(self.info_panel):
+            # refresh the ZRTP widget (we need to hide/change/show because in certain configurations it flickers when changed while visible)
+            stream_info = blink_session.info.streams[self.zrtp_widget.stream_type]
+            self.zrtp_widget.hide()
+            self.zrtp_widget.peer_name = stream_info.zrtp_peer_name
+            self.zrtp_widget.peer_verified = stream_info.zrtp_verified
+            self.zrtp_widget.sas = stream_info.zrtp_sas
+            self.zrtp_widget.show()
+
+        if any(len(path) > 1 for path in (chat_info.full_local_path, chat_info.full_remote_path)):
+            self.chat_value_label.setText(u'Using relay')
+            self.chat_connection_label.setPixmap(self.pixmaps.relay_connection)
+            self.chat_connection_label.setToolTip(u'Using relay')
+        elif chat_info.full_local_path and chat_info.full_remote_path:
+            self.chat_value_label.setText(u'Peer to peer')
+            self.chat_connection_label.setPixmap(self.pixmaps.direct_connection)
+            self.chat_connection_label.setToolTip(u'Peer to peer')
+        else:
+            self.chat_value_label.setText(u'N/A')
+
+        if chat_info.encryption is not None and chat_info.transport == 'tls':
+            self.chat_encryption_label.setToolTip(u'Media is encrypted using TLS and {0.encryption} ({0.encryption_cipher})'.format(chat_info))
+        elif chat_info.encryption is not None:
+            self.chat_encryption_label.setToolTip(u'Media is encrypted using {0.encryption} ({0.encryption_cipher})'.format(chat_info))
+        elif chat_info.transport == 'tls':
+            self.chat_encryption_label.setToolTip(u'Media is encrypted using TLS')
+        else:
+            self.chat_encryption_label.setToolTip(u'Media is not encrypted')
+        self._update_chat_encryption_icon()
 
-            self.chat_connection_label.setVisible(chat_info.remote_address is not None)
-            self.chat_encryption_label.setVisible(chat_info.remote_address is not None and (chat_info.encryption is not None or chat_info.transport == 'tls'))
+        self.chat_connection_label.setVisible(chat_info.remote_address is not None)
+        self.chat_encryption_label.setVisible(chat_info.remote_address is not None and (chat_info.encryption is not None or chat_info.transport == 'tls'))
 
-            if self.otr_widget.isVisibleTo(self.info_panel):
-                # refresh the OTR widget (we need to hide/change/show because in certain configurations it flickers when changed while visible)
-                stream_info = blink_session.info.streams.chat
-                self.otr_widget.hide()
-                self.otr_widget.peer_name = stream_info.otr_peer_name
-                self.otr_widget.peer_verified = stream_info.otr_verified
-                self.otr_widget.peer_fingerprint = stream_info.otr_peer_fingerprint
-                self.otr_widget.my_fingerprint = stream_info.otr_key_fingerprint
-                self.otr_widget.smp_status = stream_info.smp_status
-                self.otr_widget.show()
+        if self.otr_widget.isVisibleTo(self.info_panel):
+            # refresh the OTR widget (we need to hide/change/show because in certain configurations it flickers when changed while visible)
+            stream_info = blink_session.info.streams.chat
+            self.otr_widget.hide()
+            self.otr_widget.peer_name = stream_info.otr_peer_name
+            self.otr_widget.peer_verified = stream_info.otr_verified
+            self.otr_widget.peer_fingerprint = stream_info.otr_peer_fingerprint
+            self.otr_widget.my_fingerprint = stream_info.otr_key_fingerprint
+            self.otr_widget.smp_status = stream_info.smp_status
+            self.otr_widget.show()
+
+        if screen_info.remote_address is not None and screen_info.mode == 'active':
+            self.screen_value_label.setText(u'Viewing remote')
+        elif screen_info.remote_address is not None and screen_info.mode == 'passive':
+            self.screen_value_label.setText(u'Sharing local')
+        else:
+            self.screen_value_label.setText(u'N/A')
 
-            if screen_info.remote_address is not None and screen_info.mode == 'active':
-                self.screen_value_label.setText(u'Viewing remote')
-            elif screen_info.remote_address is not None and screen_info.mode == 'passive':
-                self.screen_value_label.setText(u'Sharing local')
-            else:
-                self.screen_value_label.setText(u'N/A')
+        if any(len(path) > 1 for path in (screen_info.full_local_path, screen_info.full_remote_path)):
+            self.screen_connection_label.setPixmap(self.pixmaps.relay_connection)
+            self.screen_connection_label.setToolTip(u'Using relay')
+        elif screen_info.full_local_path and screen_info.full_remote_path:
+            self.screen_connection_label.setPixmap(self.pixmaps.direct_connection)
+            self.screen_connection_label.setToolTip(u'Peer to peer')
 
-            if any(len(path) > 1 for path in (screen_info.full_local_path, screen_info.full_remote_path)):
-                self.screen_connection_label.setPixmap(self.pixmaps.relay_connection)
-                self.screen_connection_label.setToolTip(u'Using relay')
-            elif screen_info.full_local_path and screen_info.full_remote_path:
-                self.screen_connection_label.setPixmap(self.pixmaps.direct_connection)
-                self.screen_connection_label.setToolTip(u'Peer to peer')
+        self.screen_encryption_label.setToolTip(u'Media is encrypted using TLS')
 
-            self.screen_encryption_label.setToolTip(u'Media is encrypted using TLS')
+        self.screen_connection_label.setVisible(screen_info.remote_address is not None)
+        self.screen_encryption_label.setVisible(screen_info.remote_address is not None and screen_info.transport == 'tls')
 
-            self.screen_connection_label.setVisible(screen_info.remote_address is not None)
-            self.screen_encryption_label.setVisible(screen_info.remote_address is not None and screen_info.transport == 'tls')
+    def _update_info_panel_statistics(self, blink_session):
+        session_info = blink_session.info
+        audio_info = blink_session.info.streams.audio
+        video_info = blink_session.info.streams.video
 
-        if 'statistics' in elements:
+        if self.duration_value_label.value != session_info.duration:
             self.duration_value_label.value = session_info.duration
-            self.audio_latency_graph.data = audio_info.latency
-            self.video_latency_graph.data = video_info.latency
-            self.audio_packet_loss_graph.data = audio_info.packet_loss
-            self.video_packet_loss_graph.data = video_info.packet_loss
-            self.incoming_traffic_graph.data = audio_info.incoming_traffic
-            self.outgoing_traffic_graph.data = audio_info.outgoing_traffic
-            self.latency_graph.update()
-            self.packet_loss_graph.update()
-            self.traffic_graph.update()
+
+        # the graphs only need to be redrawn if they show another session or if new samples were added since the last time
+        statistics_state = audio_info.latency, audio_info.latency.count, video_info.latency, video_info.latency.count
+        if statistics_state == self._info_panel_statistics_state:
+            return
+        self._info_panel_statistics_state = statistics_state
+
+        self.audio_latency_graph.data = audio_info.latency
+        self.video_latency_graph.data = video_info.latency
+        self.audio_packet_loss_graph.data = audio_info.packet_loss
+        self.video_packet_loss_graph.data = video_info.packet_loss
+        self.incoming_traffic_graph.data = audio_info.incoming_traffic
+        self.outgoing_traffic_graph.data = audio_info.outgoing_traffic
+        self.latency_graph.update()
+        self.packet_loss_graph.update()
+        self.traffic_graph.update()
 
     def _update_rtp_encryption_icon(self, encryption_label):
         stream = self.selected_session.blink_session.streams.get(encryption_label.stream_type)
@@ -1999,7 +2405,9 @@ class ChatWindow(base_class, ui_class, ColorHelperMixin):
             elif event_type in (QEvent.MouseButtonPress, QEvent.MouseButtonDblClick) and event.button() == Qt.LeftButton and event.modifiers() == Qt.NoModifier and watched.isEnabled():
                 self._EH_ChatEncryptionLabelClicked()
         elif watched is self.info_panel:
-            if event_type == QEvent.Resize:
+            if event_type == QEvent.Show:
+                self._update_session_info_panel()
+            elif event_type == QEvent.Resize:
                 if self.zrtp_widget.isVisibleTo(self.info_panel):
                     rect = self.zrtp_widget.geometry()
                     rect.setWidth(self.info_panel.width())
@@ -2191,6 +2599,10 @@ class ChatWindow(base_class, ui_class, ColorHelperMixin):
     def _NH_BlinkSessionInfoUpdated(self, notification):
         self._update_session_info_panel(elements=notification.data.elements)
 
+    def _NH_BlinkSessionStatisticsUpdated(self, notification):
+        if self.selected_session is not None and self.selected_session.blink_session in notification.data.sessions:
+            self._update_session_info_panel(elements={'statistics'})
+
     def _NH_BlinkSessionWillAddParticipant(self, notification):
         if len(notification.sender.server_conference.participants) == 1 and self.selected_session.active_panel is not self.participants_panel:
             if self.sliding_panels:
@@ -2212,9 +2624,9 @@ class ChatWindow(base_class, ui_class, ColorHelperMixin):
         message = notification.data.message
 
         if message.content_type.startswith('image/'):
-            content = u'''<img src="data:{};base64,{}" class="scaled-to-fit" />'''.format(message.content_type, message.content.encode('base64').rstrip())
+            content = session.chat_widget.image_html(message.content, message.content_type)
         elif message.content_type.startswith('text/'):
-            content = HtmlProcessor.autolink(message.content if message.content_type == 'text/html' else QTextDocument(message.content).toHtml())
+            content = HtmlProcessor.process(message.content, message.content_type)
         else:
             return
 
@@ -2234,6 +2646,8 @@ class ChatWindow(base_class, ui_class, ColorHelperMixin):
             session.chat_widget.add_message(ChatStatus(content))
         else:
             session.chat_widget.add_message(ChatMessage(content, sender, 'incoming'))
+            if message.content_type.startswith('text/') and not notification.sender.encryption.active:  # off the record messages are not archived
+                ChatArchive().add(ChatArchiveEntry(unicode(blink_session.account.id), session.chat_widget.archive_uri, 'incoming', sender.name, uri, message.content_type, message.content))
 
         session.remote_composing = False
         settings = SIPSimpleSettings()
@@ -2579,6 +2993,59 @@ class HtmlProcessor(object):
                                 """, re.IGNORECASE | re.UNICODE | re.VERBOSE),
                     re.compile(r'mailto:(?P<body>[\w.-]+@(?P<host>[a-z0-9.-]+))', re.IGNORECASE | re.UNICODE)]
 
+    # the same links as _autolink_re, combined with the characters that need escaping, so that plain text can be escaped and linkified in a single pass
+    _text_re = re.compile(r"""
+                           (?P<http>
+                             https?://(?:[^:@/]+(?::[^@]*)?@)?(?P<http_host>[a-z0-9.-]+)(?::\d*)?
+                             (?:/(?:[\w/%!$@#*&='~:;,.+-]*(?:\([\w/%!$@#*&='~:;,.+-]*\))?)*)?
+                             (?:\?(?:[\w/%!$@#*&='~:;,.+-]*(?:\([\w/%!$@#*&='~:;,.+-]*\))?)*)?
+                           )
+                           | (?P<ftp>
+                             ftps?://(?:[^:@/]+(?::[^@]*)?@)?(?P<ftp_host>[a-z0-9.-]+)(?::\d*)?
+                             (?:/(?:[\w/%!?$@*&='~:,.+-]*(?:\([\w/%!?$@*&='~:,.+-]*\))?)*(?:;type=[aid])?)?
+                           )
+                           | mailto:(?P<mailto>[\w.-]+@(?P<mailto_host>[a-z0-9.-]+))
+                           | (?P<newline>\r\n|\r|\n)
+                           | (?P<special>[&<>"])
+                           """, re.IGNORECASE | re.UNICODE | re.VERBOSE)
+    _escape_re = re.compile(r'\r\n|\r|\n|[&<>"]')
+    _avoid_hosts_re = re.compile(r'^localhost|\bexample\.(?:com|org|net)$|^127\.0\.0\.1$', re.IGNORECASE)  # the hosts lxml's autolink avoids
+    _replacements = {'&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', '\r\n': '<br/>', '\r': '<br/>', '\n': '<br/>'}
+
+    @classmethod
+    def process(cls, content, content_type='text/plain'):
+        """Return the HTML to display for a text message. Doesn't use Qt, so it can run in any thread"""
+        if content_type == 'text/html':
+            return cls.autolink(content)
+        else:
+            return cls.text_to_html(content)
+
+    @classmethod
+    def escape(cls, text):
+        return cls._escape_re.sub(lambda match: cls._replacements[match.group()], text)
+
+    @classmethod
+    def text_to_html(cls, text):
+        if isinstance(text, str):
+            text = text.decode('utf-8', 'replace')
+        return u'<span style="white-space: pre-wrap;">%s</span>' % cls._text_re.sub(cls._text_replacement, text)
+
+    @classmethod
+    def _text_replacement(cls, match):
+        kind = match.lastgroup
+        if kind in ('newline', 'special'):
+            return cls._replacements[match.group()]
+        link = match.group()
+        if cls._avoid_hosts_re.search(match.group(kind + '_host')):
+            return cls.escape(link)
+        tail = u''
+        if link[-1] in '.,':  # these punctuation marks shouldn't end a link
+            link, tail = link[:-1], link[-1]
+        body = match.group('mailto') if kind == 'mailto' else link
+        if body[-1] in '.,':
+            body = body[:-1]
+        return u'<a href="%s">%s</a>%s' % (cls.escape(link), cls.escape(body), tail)
+
     @classmethod
     def autolink(cls, content):
         if isinstance(content, basestring):
@@ -1,10 +1,13 @@
 
+import bisect
+import contextlib
 import cPickle as pickle
 import locale
 import os
 import re
 import socket
 import sys
+import time
 
 from PyQt5 import uic
 from PyQt5.QtCore import Qt, QAbstractListModel, QAbstractTableModel, QEasingCurve, QModelIndex, QPropertyAnimation, QSortFilterProxyModel
@@ -23,16 +26,15 @@ from application.python import Null
 from application.system import makedirs, unlink
 from collections import OrderedDict, deque
 from datetime import datetime
-from functools import partial
+from functools import cmp_to_key, partial
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-from heapq import heappush
 from httplib2 import Http, HttpLib2Error
 from itertools import count
 from oauth2client.client import OAuth2WebServerFlow, AccessTokenRefreshError
 from oauth2client.file import Storage
-from operator import attrgetter
-from threading import Event
+from operator import attrgetter, itemgetter
+from threading import Lock, local
 from zope.interface import implements
 
 from sipsimple import addressbook
@@ -44,7 +46,7 @@ from sipsimple.core import BaseSIPURI, SIPURI
 from sipsimple.threading import run_in_thread
 
 from blink.configuration.datatypes import IconDescriptor, FileURL
-from blink.resources import ApplicationData, Resources, IconManager
+from blink.resources import ApplicationData, Resources, IconManager, ThumbnailCache
 from blink.sessions import SessionManager, StreamDescription
 from blink.util import call_in_gui_thread, run_in_gui_thread
 from blink.widgets.buttons import SwitchViewButton
@@ -450,10 +452,13 @@ class GoogleContactIconMetadata(object):
 
 
 class GoogleContactIcon(object):
+    etag = None  # missing from the icons saved by older versions
+
     def __init__(self, url, metadata):
         self.url = url
         self.metadata = GoogleContactIconMetadata(metadata)
         self.downloaded_url = None
+        self.etag = None
 
     @property
     def alternate_url(self):
@@ -467,63 +472,104 @@ class GoogleContactIcon(object):
         return self.url != self.downloaded_url
 
 
-class GoogleContactIconRetriever(object):
-    threadpool = ThreadPool(name='google-icons', min_threads=1, max_threads=10)
+class GoogleContactIconFetcher(object):
+    """Download the icons of Google contacts in the background, a limited number at a time"""
+
+    max_attempts = 3
+    retry_delay = 1  # seconds, doubled after every failed attempt
+
+    threadpool = ThreadPool(name='google-icons', min_threads=1, max_threads=4)
     threadpool.start()
 
-    def __init__(self, contact, credentials):
-        self.contact = contact
-        self.credentials = credentials
-        self._event = Event()
+    def __init__(self, http_factory=None):
+        self.http_factory = http_factory or (lambda credentials: credentials.authorize(Http(timeout=5)))
+        self._lock = Lock()
+        self._pending = set()  # ids of the contacts that are queued or being fetched
+        self._local = local()  # every thread keeps its own connections open, as Http objects cannot be shared between threads
 
-    def wait(self):
-        return self._event.wait()
+    def fetch(self, contact, credentials):
+        with self._lock:
+            if contact.id in self._pending:
+                return
+            self._pending.add(contact.id)
+        self._fetch(contact, credentials)
+
+    def _get_http(self, credentials):
+        if getattr(self._local, 'credentials', None) is not credentials:
+            self._local.credentials = credentials
+            self._local.http = self.http_factory(credentials)
+        return self._local.http
+
+    def _request(self, http, url, headers):
+        delay = self.retry_delay
+        for attempt in xrange(1, self.max_attempts + 1):
+            try:
+                response, content = http.request(url, headers=headers)
+            except (HttpLib2Error, socket.error):
+                if attempt == self.max_attempts:
+                    raise
+            else:
+                if response.status not in (429, 500, 502, 503, 504) or attempt == self.max_attempts:
+                    return response, content
+            time.sleep(delay)
+            delay *= 2
 
     @run_in_threadpool(threadpool)
-    def run(self):
-        owner = self.contact.name or self.contact.organization or self.contact.id
-        icon = self.contact.icon
-        http = self.credentials.authorize(Http(timeout=5))
+    def _fetch(self, contact, credentials):
+        owner = contact.name or contact.organization or contact.id
+        icon = contact.icon
+        url = icon.url
+        updated = False
         try:
-            if icon.url is not None:
-                response, content = http.request(icon.url+'?size={}'.format(IconManager.max_size))
+            if url is None:
+                IconManager().store_data(contact.id, None)
+                icon.downloaded_url = icon.etag = None
+                updated = True
             else:
-                response = content = None
+                http = self._get_http(credentials)
+                updated = self._download(http, contact, url, url + '?size={}'.format(IconManager.max_size), {})
+                if updated is None and icon.alternate_url:  # private or unavailable photo. use old GData protocol if alternate_url is available.
+                    updated = self._download(http, contact, url, icon.alternate_url, {'GData-Version': '3.0'})
+                if updated is None:
+                    log.error(u'could not retrieve icon for {}: the photo is private or unavailable'.format(owner))
         except (HttpLib2Error, socket.error) as e:
             log.warning(u'could not retrieve icon for {owner}: {exception!s}'.format(owner=owner, exception=e))
-        else:
-            if response is None:
-                icon_manager = IconManager()
-                icon_manager.store_data(self.contact.id, None)
-                icon.downloaded_url = None
-            elif response['status'] == '200' and response['content-type'].startswith('image/'):
-                icon_manager = IconManager()
-                try:
-                    icon_manager.store_data(self.contact.id, content)
-                except Exception as e:
-                    log.error(u'could not store icon for {owner}: {exception!s}'.format(owner=owner, exception=e))
-                else:
-                    icon.downloaded_url = icon.url
-            elif response['status'] in ('403', '404') and icon.alternate_url:  # private or unavailable photo. use old GData protocol if alternate_url is available.
-                try:
-                    response, content = http.request(icon.alternate_url, headers={'GData-Version': '3.0'})
-                except (HttpLib2Error, socket.error) as e:
-                    log.warning(u'could not retrieve icon for {owner}: {exception!s}'.format(owner=owner, exception=e))
-                else:
-                    if response['status'] == '200' and response['content-type'].startswith('image/'):
-                        icon_manager = IconManager()
-                        try:
-                            icon_manager.store_data(self.contact.id, content)
-                        except Exception as e:
-                            log.error(u'could not store icon for {owner}: {exception!s}'.format(owner=owner, exception=e))
-                        else:
-                            icon.downloaded_url = icon.url
-                    else:
-                        log.error(u'could not retrieve icon for {} (status={}, content-type={!r})'.format(owner, response['status'], response['content-type']))
-            else:
-                log.error(u'could not retrieve icon for {} (status={}, content-type={!r})'.format(owner, response['status'], response['content-type']))
+        except Exception:
+            log.exception(u'could not retrieve icon for {}'.format(owner))
         finally:
-            self._event.set()
+            # the contact must leave the pending set even when the fetch fails unexpectedly, otherwise its icon would never be fetched again
+            with self._lock:
+                self._pending.discard(contact.id)
+                finished = not self._pending
+            if updated:
+                NotificationCenter().post_notification('GoogleContactIconFetcherDidFetchIcon', sender=self, data=NotificationData(contact=contact))
+            if finished:
+                self.threadpool.compact()
+
+    def _download(self, http, contact, url, request_url, headers):
+        """Return True if the icon is up to date, False if it could not be retrieved and None if it is not available at request_url"""
+        owner = contact.name or contact.organization or contact.id
+        icon = contact.icon
+        if icon.etag is not None and os.path.exists(ApplicationData.get(os.path.join('images', contact.id.replace('/', '_') + '.png'))):
+            headers = dict(headers, **{'If-None-Match': icon.etag})
+        response, content = self._request(http, request_url, headers)
+        if response.status == 304:
+            icon.downloaded_url = url
+            return True
+        elif response.status == 200 and response.get('content-type', '').startswith('image/'):
+            try:
+                IconManager().store_data(contact.id, content)
+            except Exception as e:
+                log.error(u'could not store icon for {owner}: {exception!s}'.format(owner=owner, exception=e))
+                return False
+            icon.downloaded_url = url
+            icon.etag = response.get('etag')
+            return True
+        elif response.status in (403, 404):
+            return None
+        else:
+            log.error(u'could not retrieve icon for {} (status={}, content-type={!r})'.format(owner, response.status, response.get('content-type')))
+            return False
 
 
 class GoogleContactURI(object):
@@ -672,10 +718,99 @@ class GoogleContactsList(object):
     def add(self, contact):
         self._contact_map[contact.id] = contact
 
+    def get(self, id, default=None):
+        return self._contact_map.get(id, default)
+
     def pop(self, id, *args):
         return self._contact_map.pop(id, *args)
 
 
+class GoogleContactsStore(object):
+    """Keep the Google contacts on disk as a snapshot plus a log of the changes made after it"""
+
+    compact_threshold = 1000  # records, compaction is also delayed until the log has more records than there are contacts
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.log_filename = filename + '.log'
+        self.contacts = GoogleContactsList()
+        self.sync_token = None
+        self._log_records = 0
+        self._lock = Lock()
+
+    def load(self):
+        with self._lock:
+            try:
+                with open(self.filename, 'rb') as f:
+                    self.contacts, self.sync_token = pickle.load(f)
+            except Exception:
+                pass
+            try:
+                f = open(self.log_filename, 'rb')
+            except (IOError, OSError):
+                return self.contacts, self.sync_token
+            with f:
+                while True:
+                    try:
+                        operation, argument = pickle.load(f)
+                    except EOFError:
+                        break
+                    except Exception:
+                        log.warning('google contacts log is corrupted, ignoring the rest of it')
+                        self._compact()  # appending after the corrupted record would make the new records unreadable
+                        break
+                    if operation == 'store':
+                        self.contacts.add(argument)
+                    elif operation == 'remove':
+                        self.contacts.pop(argument, None)
+                    elif operation == 'sync_token':
+                        self.sync_token = argument
+                    self._log_records += 1
+            return self.contacts, self.sync_token
+
+    def store(self, contacts):
+        self._write([('store', contact) for contact in contacts])
+
+    def remove(self, contact_ids):
+        self._write([('remove', contact_id) for contact_id in contact_ids])
+
+    def set_sync_token(self, sync_token):
+        if sync_token != self.sync_token:
+            self.sync_token = sync_token
+            self._write([('sync_token', sync_token)])
+
+    def _write(self, records):
+        if not records:
+            return
+        with self._lock:
+            try:
+                makedirs(os.path.dirname(self.filename))
+                with open(self.log_filename, 'ab') as f:
+                    for record in records:
+                        pickle.dump(record, f, pickle.HIGHEST_PROTOCOL)
+            except Exception as e:
+                log.error('could not save google contacts: %s' % e)
+                return
+            self._log_records += len(records)
+            if self._log_records > max(self.compact_threshold, len(self.contacts)):
+                self._compact()
+
+    def _compact(self):
+        tempname = '{}.{}'.format(self.filename, os.getpid())
+        try:
+            makedirs(os.path.dirname(self.filename))
+            with open(tempname, 'wb') as f:
+                pickle.dump((self.contacts, self.sync_token), f)
+            if sys.platform == 'win32':
+                unlink(self.filename)
+            os.rename(tempname, self.filename)
+        except Exception as e:
+            log.error('could not save google contacts: %s' % e)
+        else:
+            unlink(self.log_filename)
+            self._log_records = 0
+
+
 class GoogleAuthorizationView(QWebView):
     finished = pyqtSignal()
     accepted = pyqtSignal(unicode, unicode)  # accepted.emit(code, email)
@@ -778,20 +913,50 @@ class GoogleAuthorization(object):
         notification_center.post_notification('GoogleAuthorizationWasRejected', sender=self)
 
 
+class GoogleContactsSyncScheduler(object):
+    """Decide how long to wait before the next sync, based on how many changes the last syncs returned"""
+
+    min_interval = 30          # seconds, used after a burst of changes
+    default_interval = 60
+    max_interval = 30 * 60     # reached after a long series of syncs without changes or with errors
+    burst_threshold = 10       # changes
+
+    def __init__(self):
+        self.interval = self.default_interval
+
+    def sync_finished(self, changes):
+        if changes >= self.burst_threshold:
+            self.interval = self.min_interval
+        elif changes:
+            self.interval = min(self.interval, self.default_interval)
+        else:
+            self.interval = min(self.interval * 2, self.max_interval)
+        return self.interval
+
+    def sync_failed(self):
+        self.interval = min(max(self.interval, self.default_interval) * 2, self.max_interval)
+        return self.interval
+
+
 class GoogleContactsManager(object):
     __metaclass__ = Singleton
     implements(IObserver)
 
     def __init__(self):
-        self.contacts = GoogleContactsList()
+        self.store = GoogleContactsStore(ApplicationData.get('google/contacts'))
+        self.contacts = self.store.contacts
         self.running = False
         self.active = False
         self.auth = None
+        self.icon_fetcher = GoogleContactIconFetcher()
+        self.sync_scheduler = GoogleContactsSyncScheduler()
+        self.sync_stats = None
         self._service = None
         self._sync_timer = None
         self._sync_token = None
         self._initialize()
         notification_center = NotificationCenter()
+        notification_center.add_observer(self, sender=self.icon_fetcher)
         notification_center.add_observer(self, name='SIPApplicationDidStart')
         notification_center.add_observer(self, name='SIPApplicationWillEnd')
         notification_center.add_observer(self, name='CFGSettingsObjectDidChange', sender=SIPSimpleSettings())
@@ -815,13 +980,10 @@ class GoogleContactsManager(object):
     def _initialize(self):  # object is instantiated from a non-UI thread, while these need to be created in the UI thread
         self.auth = GoogleAuthorization()
         self._sync_timer = QTimer()
-        self._sync_timer.setInterval(60 * 1000)  # a minute (in milliseconds)
+        self._sync_timer.setInterval(self.sync_scheduler.default_interval * 1000)
         self._sync_timer.setSingleShot(True)
         self._sync_timer.timeout.connect(self.sync_contacts)
-        try:
-            self.contacts, self._sync_token = pickle.load(open(ApplicationData.get('google/contacts')))
-        except Exception:
-            pass
+        self.contacts, self._sync_token = self.store.load()
         notification_center = NotificationCenter()
         notification_center.add_observer(self, sender=self.auth)
 
@@ -856,8 +1018,16 @@ class GoogleContactsManager(object):
 
         person_fields = 'email_addresses,im_clients,metadata,names,organizations,phone_numbers,photos,urls'
 
+        full_sync = self._sync_token is None
+        seen_contact_ids = set()
+        stats = NotificationData(full_sync=full_sync, duration=0, pages=0, bytes=0, changes=0)
+        start_time = time.time()
+
         try:
-            connections, sync_token = self._get_connections(person_fields, sync_token=self._sync_token)
+            for connections, sync_token in self._get_connections(person_fields, stats, sync_token=self._sync_token):
+                if full_sync:
+                    seen_contact_ids.update(contact_data['resourceName'] for contact_data in connections)
+                stats.changes += self._process_connections(connections)
         except AccessTokenRefreshError:
             self.auth.request_credentials()
             return
@@ -867,78 +1037,89 @@ class GoogleContactsManager(object):
                 self.sync_contacts()
                 return
             log.warning(u'Could not fetch Google contacts: {!s}'.format(e))
+            interval = self.sync_scheduler.sync_failed()
         except (HttpLib2Error, socket.error) as e:
             log.warning(u'Could not fetch Google contacts: {!s}'.format(e))
+            interval = self.sync_scheduler.sync_failed()
         else:
-            added_contacts = []
-            modified_contacts = []
-            deleted_contact_ids = self.contacts.ids - {contact['resourceName'] for contact in connections} if self._sync_token is None else set()
-
-            for contact_data in connections:
-                contact_id = contact_data['resourceName']
-                if contact_data['metadata'].get('deleted') is True:
-                    if contact_id in self.contacts:
-                        deleted_contact_ids.add(contact_id)
-                    continue
-                try:
-                    contact = self.contacts[contact_id]
-                except KeyError:
-                    contact = GoogleContact.from_google_data(contact_data)
-                    if contact.uris:
-                        added_contacts.append(contact)
-                else:
-                    if contact.etag != contact_data['etag']:
-                        contact.update(contact_data)
-                        if contact.uris:
-                            modified_contacts.append(contact)
-                        else:
-                            deleted_contact_ids.add(contact.id)
+            if full_sync:
+                deleted_contact_ids = self.contacts.ids - seen_contact_ids
+                self._remove_contacts(deleted_contact_ids)
+                stats.changes += len(deleted_contact_ids)
 
-            notification_center = NotificationCenter()
-            for contact_id in deleted_contact_ids:
-                contact = self.contacts.pop(contact_id)
-                notification_center.post_notification('GoogleContactsManagerDidRemoveContact', sender=self, data=NotificationData(contact=contact))
-            for contact in added_contacts:
-                self.contacts.add(contact)
-                notification_center.post_notification('GoogleContactsManagerDidAddContact', sender=self, data=NotificationData(contact=contact))
-            for contact in modified_contacts:
-                notification_center.post_notification('GoogleContactsManagerDidUpdateContact', sender=self, data=NotificationData(contact=contact))
-
-            icon_retrievers = [GoogleContactIconRetriever(contact, self.auth.credentials) for contact in self.contacts if contact.icon.needs_update]
-            for retriever in icon_retrievers:
-                retriever.run()
-            for retriever in icon_retrievers:
-                retriever.wait()
-                notification_center.post_notification('GoogleContactsManagerDidUpdateContact', sender=self, data=NotificationData(contact=retriever.contact))
-
-            GoogleContactIconRetriever.threadpool.compact()
+            credentials = self.auth.credentials
+            for contact in (contact for contact in self.contacts if contact.icon.needs_update):
+                self.icon_fetcher.fetch(contact, credentials)
 
             self._sync_token = sync_token
+            self.store.set_sync_token(sync_token)  # the token is saved, so that syncs after a restart are incremental as well
 
-            if added_contacts or modified_contacts or deleted_contact_ids or icon_retrievers:
-                filename = ApplicationData.get('google/contacts')
-                tempname = '{}.{}'.format(filename, os.getpid())
-                try:
-                    makedirs(os.path.dirname(filename))
-                    with open(tempname, 'wb') as f:
-                        pickle.dump((self.contacts, self._sync_token), f)
-                    if sys.platform == 'win32':
-                        unlink(filename)
-                    os.rename(tempname, filename)
-                except Exception as e:
-                    log.error('could not save google contacts: %s' % e)
-
-        call_in_gui_thread(self._sync_timer.start)
-
-    def _get_connections(self, person_fields, sync_token=None):
-        connections = []
+            stats.duration = time.time() - start_time
+            self.sync_stats = stats
+            interval = self.sync_scheduler.sync_finished(stats.changes)
+            notification_center = NotificationCenter()
+            notification_center.post_notification('GoogleContactsManagerDidSync', sender=self, data=stats)
+
+        call_in_gui_thread(self._sync_timer.start, interval * 1000)
+
+    def _process_connections(self, connections):
+        added_contacts = []
+        modified_contacts = []
+        deleted_contact_ids = set()
+
+        for contact_data in connections:
+            contact_id = contact_data['resourceName']
+            if contact_data['metadata'].get('deleted') is True:
+                if contact_id in self.contacts:
+                    deleted_contact_ids.add(contact_id)
+                continue
+            try:
+                contact = self.contacts[contact_id]
+            except KeyError:
+                contact = GoogleContact.from_google_data(contact_data)
+                if contact.uris:
+                    added_contacts.append(contact)
+            else:
+                if contact.etag != contact_data['etag']:
+                    contact.update(contact_data)
+                    if contact.uris:
+                        modified_contacts.append(contact)
+                    else:
+                        deleted_contact_ids.add(contact.id)
+
+        self._remove_contacts(deleted_contact_ids)
+        notification_center = NotificationCenter()
+        for contact in added_contacts:
+            self.contacts.add(contact)
+            notification_center.post_notification('GoogleContactsManagerDidAddContact', sender=self, data=NotificationData(contact=contact))
+        for contact in modified_contacts:
+            notification_center.post_notification('GoogleContactsManagerDidUpdateContact', sender=self, data=NotificationData(contact=contact))
+        self.store.store(added_contacts + modified_contacts)
+        return len(added_contacts) + len(modified_contacts) + len(deleted_contact_ids)
+
+    def _remove_contacts(self, contact_ids):
+        notification_center = NotificationCenter()
+        for contact_id in contact_ids:
+            contact = self.contacts.pop(contact_id)
+            notification_center.post_notification('GoogleContactsManagerDidRemoveContact', sender=self, data=NotificationData(contact=contact))
+        self.store.remove(contact_ids)
+
+    def _get_connections(self, person_fields, stats, sync_token=None):
+        """Yield the connections one page at a time, together with the sync token, which is only known after the last page"""
         request = self._service.people().connections().list(resourceName='people/me', personFields=person_fields, syncToken=sync_token, requestSyncToken=True, pageSize=2000)
+        postproc = request.postproc
+
+        def count_bytes(response, content):
+            stats.bytes += len(content)
+            return postproc(response, content)
+
+        request.postproc = count_bytes  # the requests for the next pages are copies of this one, so they are counted as well
         while request is not None:
             response = request.execute()
-            connections.extend(response.get('connections', []))
+            stats.pages += 1
             sync_token = response.get('nextSyncToken', sync_token)
             request = self._service.people().connections().list_next(request, response)
-        return connections, sync_token
+            yield response.get('connections', []), sync_token
 
     def handle_notification(self, notification):
         handler = getattr(self, '_NH_%s' % notification.name, Null)
@@ -960,6 +1141,16 @@ class GoogleContactsManager(object):
         settings.google_contacts.enabled = False
         settings.save()
 
+    @run_in_thread('network-io')
+    def _store_contact(self, contact):
+        # the contacts are only modified by the synchronization, which runs in this thread, so the store must be written from it as well
+        if self.contacts.get(contact.id) is contact:
+            self.store.store([contact])
+
+    def _NH_GoogleContactIconFetcherDidFetchIcon(self, notification):
+        self._store_contact(notification.data.contact)  # remember that the icon was downloaded
+        notification.center.post_notification('GoogleContactsManagerDidUpdateContact', sender=self, data=notification.data)
+
     def _NH_SIPApplicationDidStart(self, notification):
         settings = SIPSimpleSettings()
         if settings.google_contacts.enabled:
@@ -1333,53 +1524,54 @@ class Contact(object):
 
     @property
     def icon(self):
-        try:
-            return self.__dict__['icon']
-        except KeyError:
-            if self.type == 'addressbook':
-                icon_manager = IconManager()
-                icon = icon_manager.get(self.settings.id + '_alt') or icon_manager.get(self.settings.id) or self.default_user_icon
-            elif self.type == 'google':
-                icon_manager = IconManager()
-                icon = icon_manager.get(self.settings.id) or self.default_user_icon
-            else:
-                icon = self.default_user_icon
-            return self.__dict__.setdefault('icon', icon)
+        # the callers need the real icon right away. the contact list does not use it, as it is painted from the thumbnails
+        icon_manager = IconManager()
+        for id in self._icon_ids:
+            icon = icon_manager.get(id)
+            if icon is not None:
+                return icon
+        return self.default_user_icon
 
     @property
     def pixmap(self):
-        try:
-            return self.__dict__['pixmap']
-        except KeyError:
-            size = 32
-            if self.stylish_icons:
-                pixmap = QPixmap(size, size)
-                pixmap.fill(Qt.transparent)
-                path = QPainterPath()
-                path.addRoundedRect(0, 0, size, size, 3.7, 3.7)
-                painter = QPainter(pixmap)
-                painter.setRenderHint(QPainter.Antialiasing, True)
-                painter.setCompositionMode(QPainter.CompositionMode_SourceOver)
-                painter.setClipPath(path)
-                self.icon.paint(painter, pixmap.rect(), Qt.AlignCenter)
-                painter.end()
-            else:
-                pixmap = self.icon.pixmap(size)
-            return self.__dict__.setdefault('pixmap', pixmap)
+        thumbnail_cache = ThumbnailCache()
+        icon_ids = self._icon_ids
+        if icon_ids:
+            pixmap = self._get_result(thumbnail_cache.request(icon_ids, 32, rounded=self.stylish_icons))
+            if pixmap is not None:
+                return pixmap
+        return thumbnail_cache.get(self.default_user_icon, 32, rounded=self.stylish_icons)
+
+    @property
+    def _icon_ids(self):
+        if self.type == 'addressbook':
+            return self.settings.id + '_alt', self.settings.id
+        elif self.type == 'google':
+            return self.settings.id,
+        else:
+            return ()
+
+    def _get_result(self, request):
+        if request.done:
+            return request.result
+        requests = self.__dict__.setdefault('icon_requests', set())
+        if request not in requests:
+            requests.add(request)
+            request.add_done_callback(self._icon_loaded)
+        return None
+
+    def _icon_loaded(self, request):
+        self.__dict__['icon_requests'].discard(request)
+        NotificationCenter().post_notification('BlinkContactIconDidChange', sender=self)
 
     def handle_notification(self, notification):
         handler = getattr(self, '_NH_%s' % notification.name, Null)
         handler(notification)
 
     def _NH_AddressbookContactDidChange(self, notification):
-        if {'icon', 'alternate_icon'}.intersection(notification.data.modified):
-            self.__dict__.pop('icon', None)
-            self.__dict__.pop('pixmap', None)
         notification.center.post_notification('BlinkContactDidChange', sender=self)
 
     def _NH_VirtualContactDidChange(self, notification):
-        self.__dict__.pop('icon', None)
-        self.__dict__.pop('pixmap', None)
         notification.center.post_notification('BlinkContactDidChange', sender=self)
 
 
@@ -1489,53 +1681,54 @@ class ContactDetail(object):
 
     @property
     def icon(self):
-        try:
-            return self.__dict__['icon']
-        except KeyError:
-            if self.type == 'addressbook':
-                icon_manager = IconManager()
-                icon = icon_manager.get(self.settings.id + '_alt') or icon_manager.get(self.settings.id) or self.default_user_icon
-            elif self.type == 'google':
-                icon_manager = IconManager()
-                icon = icon_manager.get(self.settings.id) or self.default_user_icon
-            else:
-                icon = self.default_user_icon
-            return self.__dict__.setdefault('icon', icon)
+        # the callers need the real icon right away. the contact list does not use it, as it is painted from the thumbnails
+        icon_manager = IconManager()
+        for id in self._icon_ids:
+            icon = icon_manager.get(id)
+            if icon is not None:
+                return icon
+        return self.default_user_icon
 
     @property
     def pixmap(self):
-        try:
-            return self.__dict__['pixmap']
-        except KeyError:
-            size = 32
-            if self.stylish_icons:
-                pixmap = QPixmap(size, size)
-                pixmap.fill(Qt.transparent)
-                path = QPainterPath()
-                path.addRoundedRect(0, 0, size, size, 3.7, 3.7)
-                painter = QPainter(pixmap)
-                painter.setRenderHint(QPainter.Antialiasing, True)
-                painter.setCompositionMode(QPainter.CompositionMode_SourceOver)
-                painter.setClipPath(path)
-                self.icon.paint(painter, pixmap.rect(), Qt.AlignCenter)
-                painter.end()
-            else:
-                pixmap = self.icon.pixmap(size)
-            return self.__dict__.setdefault('pixmap', pixmap)
+        thumbnail_cache = ThumbnailCache()
+        icon_ids = self._icon_ids
+        if icon_ids:
+            pixmap = self._get_result(thumbnail_cache.request(icon_ids, 32, rounded=self.stylish_icons))
+            if pixmap is not None:
+                return pixmap
+        return thumbnail_cache.get(self.default_user_icon, 32, rounded=self.stylish_icons)
+
+    @property
+    def _icon_ids(self):
+        if self.type == 'addressbook':
+            return self.settings.id + '_alt', self.settings.id
+        elif self.type == 'google':
+            return self.settings.id,
+        else:
+            return ()
+
+    def _get_result(self, request):
+        if request.done:
+            return request.result
+        requests = self.__dict__.setdefault('icon_requests', set())
+        if request not in requests:
+            requests.add(request)
+            request.add_done_callback(self._icon_loaded)
+        return None
+
+    def _icon_loaded(self, request):
+        self.__dict__['icon_requests'].discard(request)
+        NotificationCenter().post_notification('BlinkContactDetailDidChange', sender=self)
 
     def handle_notification(self, notification):
         handler = getattr(self, '_NH_%s' % notification.name, Null)
         handler(notification)
 
     def _NH_AddressbookContactDidChange(self, notification):
-        if {'icon', 'alternate_icon'}.intersection(notification.data.modified):
-            self.__dict__.pop('icon', None)
-            self.__dict__.pop('pixmap', None)
         notification.center.post_notification('BlinkContactDetailDidChange', sender=self)
 
     def _NH_VirtualContactDidChange(self, notification):
-        self.__dict__.pop('icon', None)
-        self.__dict__.pop('pixmap', None)
         notification.center.post_notification('BlinkContactDetailDidChange', sender=self)
 
 
@@ -2250,6 +2443,166 @@ class ItemList(list):
         self.__groupmap__.pop(item.settings, None)
 
 
+class ContactURIIndex(object):
+    """Index the URIs of the contacts in virtual groups for URIUtils.find_contact"""
+
+    uri_re = re.compile(r'^(?:sips?:)?(?P<user>.+?)(?:@(?P<host>[^:;?]+).*)?$')
+
+    def __init__(self):
+        self.uri_map = {}      # (user, host) -> [(order, contact, contact_uri), ...]
+        self.number_trie = {}  # reversed trimmed number -> ... -> {None: [(order, contact, contact_uri), ...]}
+        self.contact_map = {}  # contact -> [(key, number, entry), ...]
+        self.counter = count()
+
+    def __contains__(self, contact):
+        return contact in self.contact_map
+
+    def add(self, contact):
+        self.remove(contact)
+        records = []
+        for contact_uri in contact.uris:
+            match = self.uri_re.match(contact_uri.uri)
+            if match is None:
+                continue
+            user, host = match.group('user', 'host')
+            entry = (next(self.counter), contact, contact_uri)
+            key = (user, host)
+            self.uri_map.setdefault(key, []).append(entry)
+            if URIUtils.is_number(user):
+                number = URIUtils.trim_number(user)
+                node = self.number_trie
+                for char in reversed(number):
+                    node = node.setdefault(char, {})
+                node.setdefault(None, []).append(entry)
+            else:
+                number = None
+            records.append((key, number, entry))
+        self.contact_map[contact] = records
+
+    def remove(self, contact):
+        for key, number, entry in self.contact_map.pop(contact, ()):
+            entries = self.uri_map[key]
+            entries.remove(entry)
+            if not entries:
+                del self.uri_map[key]
+            if number is not None:
+                chars = number[::-1]
+                path = [self.number_trie]
+                for char in chars:
+                    path.append(path[-1][char])
+                path[-1][None].remove(entry)
+                if not path[-1][None]:
+                    del path[-1][None]
+                for char, parent, node in reversed(zip(chars, path, path[1:])):  # prune the branches that became empty
+                    if node:
+                        break
+                    del parent[char]
+
+    def find_uri(self, user, host):
+        """Return the (contact, contact_uri) candidates whose URI has the given user and host, or only the user"""
+        entries = self.uri_map.get((user, host), []) + self.uri_map.get((user, None), [])
+        return [(contact, contact_uri) for order, contact, contact_uri in sorted(entries)]
+
+    def find_number(self, number):
+        """Return the best (contact, contact_uri) whose number ends with the given one and is at most twice as long"""
+        if not number:
+            return None
+        node = self.number_trie
+        for char in reversed(number):
+            node = node.get(char)
+            if node is None:
+                return None
+        # walk the numbers ending in number breadth first, so the shortest ones (with the best match ratio) are found first
+        level = [node]
+        for depth in xrange(len(number)+1):
+            entries = [entry for level_node in level for entry in level_node.get(None, ())]
+            if entries:
+                return min(entries)[1:]  # order, contact, uri
+            level = [child for level_node in level for char, child in level_node.iteritems() if char is not None]
+            if not level:
+                break
+        return None
+
+
+class ContactSearchIndex(object):
+    """An n-gram index over the names and URI user parts of the contacts in virtual groups"""
+
+    gram_sizes = (1, 2, 3)
+
+    def __init__(self):
+        self.gram_map = {}  # n-gram -> {contact, ...}
+        self.text_map = {}  # contact -> searchable text
+        self.generation = 0
+
+    def __contains__(self, contact):
+        return contact in self.text_map
+
+    def add(self, contact):
+        text = u' '.join([contact.name] + [self._uri_user(uri.uri) for uri in contact.uris]).lower()
+        if self.text_map.get(contact) == text:
+            return  # the searchable text did not change, so neither do the results of the searches made before
+        self.remove(contact)
+        self.text_map[contact] = text
+        for gram in self._grams(text):
+            self.gram_map.setdefault(gram, set()).add(contact)
+        self.generation += 1
+
+    def remove(self, contact):
+        text = self.text_map.pop(contact, None)
+        if text is None:
+            return
+        for gram in self._grams(text):
+            contacts = self.gram_map[gram]
+            contacts.discard(contact)
+            if not contacts:
+                del self.gram_map[gram]
+        self.generation += 1
+
+    def match(self, contact, tokens):
+        try:
+            searched_text = self.text_map[contact]
+        except KeyError:
+            return False
+        return all(token in searched_text for token in tokens)
+
+    def lookup(self, tokens):
+        """Return the candidates for a search and whether they are an exact match or still need to be checked with match"""
+        if not tokens:
+            return set(self.text_map), True
+        max_size = self.gram_sizes[-1]
+        grams = set()
+        for token in tokens:
+            if len(token) <= max_size:
+                grams.add(token)
+            else:
+                grams.update(self._grams(token, sizes=[max_size]))
+        try:
+            posting_lists = sorted((self.gram_map[gram] for gram in grams), key=len)
+        except KeyError:
+            return set(), True
+        # when the tokens are n-grams themselves the result is exact
+        return posting_lists[0].intersection(*posting_lists[1:]), all(len(token) <= max_size for token in tokens)
+
+    def search(self, text):
+        tokens = text.lower().split()
+        candidates, exact = self.lookup(tokens)
+        if exact:
+            return candidates
+        return set(contact for contact in candidates if self.match(contact, tokens))
+
+    def _grams(self, text, sizes=None):
+        return set(word[i:i+size] for word in text.split() for size in sizes or self.gram_sizes for i in xrange(len(word)-size+1))
+
+    @staticmethod
+    def _uri_user(uri):
+        if uri.startswith(('sip:', 'sips:')):
+            uri = uri.partition(':')[2]
+        return uri.partition('@')[0]
+
+
+contact_sort_key = cmp_to_key(locale.strcoll)  # orders contact names the same way Contact comparisons do
+
+
 class ContactModel(QAbstractListModel):
     implements(IObserver)
 
@@ -2266,7 +2619,21 @@ class ContactModel(QAbstractListModel):
         super(ContactModel, self).__init__(parent)
         self.state = 'stopped'
         self.items = ItemList()
+        self.uri_index = ContactURIIndex()
+        self.search_index = ContactSearchIndex()
+        self.group_offsets = None  # group -> row, rebuilt on demand after the groups are rearranged
+        self.group_contacts = {}   # group -> [contact, ...] in row order
+        self.group_keys = {}       # group -> [sort key, ...] matching group_contacts
+        self.contact_keys = {}     # contact -> the sort key it was inserted with, which is unique as it includes the contact's sequence number
+        self.contact_numbers = {}  # contact -> sequence number, which orders the contacts with the same name by the time they were added
+        self._contact_counter = count()
         self.deleted_items = []
+        self._batch_level = 0
+        self._pending_contacts = OrderedDict()  # contact -> None, for the contacts added during a batch
+        self.batch_timer = QTimer()
+        self.batch_timer.setInterval(0)
+        self.batch_timer.setSingleShot(True)
+        self.batch_timer.timeout.connect(self.end_batch)
         self.contact_list = parent.contact_list
         self.virtual_group_manager = VirtualGroupManager()
 
@@ -2286,6 +2653,7 @@ class ContactModel(QAbstractListModel):
         notification_center.add_observer(self, name='VirtualGroupDidAddContact')
         notification_center.add_observer(self, name='VirtualGroupDidRemoveContact')
         notification_center.add_observer(self, name='BlinkContactDidChange')
+        notification_center.add_observer(self, name='BlinkContactIconDidChange')
 
     @property
     def bonjour_group(self):
@@ -2388,6 +2756,7 @@ class ContactModel(QAbstractListModel):
             position = len(self.items) if drop_group is groups[-1] else self.items.index(groups[groups.index(drop_group)+1])
         self.beginInsertRows(QModelIndex(), position, position+len(items)-1)
         self.items[position:position] = items
+        self.group_offsets = None
         self.endInsertRows()
         for index, item in enumerate(items):
             if isinstance(item, Group):
@@ -2501,8 +2870,7 @@ class ContactModel(QAbstractListModel):
     def _NH_AddressbookGroupWasActivated(self, notification):
         group = Group(notification.sender)
         self.addGroup(group)
-        for contact in notification.sender.contacts:
-            self.addContact(Contact(contact, group))
+        self.addContacts([Contact(contact, group) for contact in notification.sender.contacts])
 
     def _NH_AddressbookGroupWasDeleted(self, notification):
         group = self.items[GroupElement, notification.sender]
@@ -2512,28 +2880,31 @@ class ContactModel(QAbstractListModel):
         if 'contacts' not in notification.data.modified:
             return
         group = self.items[GroupElement, notification.sender]
-        group_contacts = self.items[GroupContacts, notification.sender]
+        group_contacts = self._group_contact_list(group)
         for contact in notification.data.modified['contacts'].removed:
             self.removeContact(group_contacts[contact])
-        for contact in notification.data.modified['contacts'].added:
-            self.addContact(Contact(contact, group))
+        self.addContacts([Contact(contact, group) for contact in notification.data.modified['contacts'].added])
 
     def _NH_VirtualGroupWasActivated(self, notification):
         group = Group(notification.sender)
         self.addGroup(group)
-        for contact in notification.data.contacts:
-            self.addContact(Contact(contact, group))
+        self.addContacts([Contact(contact, group) for contact in notification.data.contacts])
 
     def _NH_VirtualGroupWasDeactivated(self, notification):
         group = self.items[GroupElement, notification.sender]
         self.removeGroup(group)
 
     def _NH_VirtualGroupDidAddContact(self, notification):
+        # contacts are added to virtual groups one by one, so collect the ones that arrive close together and insert them at once
+        if not self.batch_timer.isActive():
+            self.begin_batch()
+            self.batch_timer.start()
         group = self.items[GroupElement, notification.sender]
         self.addContact(Contact(notification.data.contact, group))
 
     def _NH_VirtualGroupDidRemoveContact(self, notification):
-        contact = self.items[GroupContacts, notification.sender][notification.data.contact]
+        group = self.items[GroupElement, notification.sender]
+        contact = self._group_contact_list(group)[notification.data.contact]
         self.removeContact(contact)
         if notification.sender is AllContactsGroup():
             icon_manager = IconManager()
@@ -2545,16 +2916,31 @@ class ContactModel(QAbstractListModel):
 
     def _NH_BlinkContactDidChange(self, notification):
         contact = notification.sender
-        position = self.items.index(contact)
+        if contact not in self.contact_keys:
+            return  # the contact is waiting for the current batch to end and will be inserted using its latest data
+        if contact in self.search_index:
+            self.search_index.add(contact)
+        position = self._contact_position(contact)
         move_point = self._find_contact_move_point(contact)
         if move_point is not None:
             self.beginMoveRows(QModelIndex(), position, position, QModelIndex(), move_point)
             del self.items[position]
-            self.items.insert(self._find_contact_insertion_point(contact), contact)
+            self._unregister_contact(contact)
+            position = self._find_contact_insertion_point(contact)
+            self.items.insert(position, contact)
+            self._register_contact(contact, position)
             self.endMoveRows()
-        index = self.index(self.items.index(contact))
+        if contact in self.uri_index:
+            self.uri_index.add(contact)
+        index = self.index(position)
         self.dataChanged.emit(index, index)
 
+    def _NH_BlinkContactIconDidChange(self, notification):
+        contact = notification.sender
+        if contact in self.contact_keys:  # only the icon changed, so the contact neither moves nor needs to be indexed again
+            index = self.index(self._contact_position(contact))
+            self.dataChanged.emit(index, index)
+
     def _NH_SIPAccountManagerDidStart(self, notification):
         if notification.sender.default_account is BonjourAccount():
             groups = self.items[GroupList]
@@ -2666,37 +3052,72 @@ class ContactModel(QAbstractListModel):
                 modified = True
         return modified
 
+    def _get_group_offsets(self):
+        if self.group_offsets is None:
+            self.group_offsets = dict((item, row) for row, item in enumerate(self.items) if isinstance(item, Group))
+        return self.group_offsets
+
+    def _group_position(self, group):
+        return self._get_group_offsets()[group]
+
+    def _sort_key(self, contact):
+        # the sequence number keeps contacts with the same name in the order they were added and makes every key unique, so it can be found with bisect
+        try:
+            number = self.contact_numbers[contact]
+        except KeyError:
+            number = self.contact_numbers[contact] = next(self._contact_counter)
+        return contact_sort_key(contact.name), number
+
+    def _contact_position(self, contact):
+        return self._group_position(contact.group) + 1 + bisect.bisect_left(self.group_keys[contact.group], self.contact_keys[contact])
+
+    def _register_contact(self, contact, position):
+        """Record a contact that was inserted in self.items at position"""
+        group = contact.group
+        index = position - self._group_position(group) - 1
+        key = self.contact_keys[contact] = self._sort_key(contact)
+        self.group_contacts[group].insert(index, contact)
+        self.group_keys[group].insert(index, key)
+        for item, offset in self.group_offsets.iteritems():
+            if offset >= position and item is not group:
+                self.group_offsets[item] = offset + 1
+
+    def _unregister_contact(self, contact):
+        """Forget a contact that was removed from self.items"""
+        group = contact.group
+        position = self._contact_position(contact)
+        index = position - self._group_position(group) - 1
+        del self.group_contacts[group][index]
+        del self.group_keys[group][index]
+        del self.contact_keys[contact]
+        for item, offset in self.group_offsets.iteritems():
+            if offset > position:
+                self.group_offsets[item] = offset - 1
+
     def _find_contact_move_point(self, contact):
-        position = self.items.index(contact)
-        prev_item = self.items[position-1] if position>0 else None
-        next_item = self.items[position+1] if position+1<len(self.items) else None
-        prev_ok = prev_item is None or isinstance(prev_item, Group) or prev_item <= contact
-        next_ok = next_item is None or isinstance(next_item, Group) or next_item >= contact
-        if prev_ok and next_ok:
-            return None
-        for position in xrange(self.items.index(contact.group)+1, len(self.items)):
-            item = self.items[position]
-            if isinstance(item, Group) or item > contact:
-                break
+        group_keys = self.group_keys[contact.group]
+        index = self._contact_position(contact) - self._group_position(contact.group) - 1
+        key = self._sort_key(contact)
+        if index > 0 and group_keys[index-1] > key:
+            move_index = bisect.bisect_left(group_keys, key, 0, index-1)
+        elif index+1 < len(group_keys) and group_keys[index+1] < key:
+            # searching after the contact gives the destination row in the coordinates before the move, as beginMoveRows expects
+            move_index = bisect.bisect_left(group_keys, key, index+2)
         else:
-            position = len(self.items)
-        return position
+            self.contact_keys[contact] = group_keys[index] = key
+            return None
+        return self._group_position(contact.group) + 1 + move_index
 
     def _find_contact_insertion_point(self, contact):
-        for position in xrange(self.items.index(contact.group)+1, len(self.items)):
-            item = self.items[position]
-            if isinstance(item, Group) or item > contact:
-                break
-        else:
-            position = len(self.items)
-        return position
+        return self._group_position(contact.group) + 1 + bisect.bisect_left(self.group_keys[contact.group], self._sort_key(contact))
 
     def _find_group_insertion_point(self, group):
         if group.settings.position is None:
             return 0  # insert new groups at the top
-        for item in self.items[GroupList]:
+        group_offsets = self._get_group_offsets()
+        for item in sorted(group_offsets, key=group_offsets.get):
             if item.relocation_info is None and item.settings.position >= group.settings.position:
-                position = self.items.index(item)
+                position = group_offsets[item]
                 break
             elif item.relocation_info is not None and item.settings.position == group.settings.position - 1:
                 item.relocation_info.successor = group
@@ -2708,29 +3129,97 @@ class ContactModel(QAbstractListModel):
         position = self._find_contact_insertion_point(contact)
         self.beginInsertRows(QModelIndex(), position, position)
         self.items.insert(position, contact)
+        self._register_contact(contact, position)
         self.endInsertRows()
         self.contact_list.setRowHidden(position, contact.group.collapsed)
 
+    def _add_contacts(self, contacts):
+        """Insert contacts using one beginInsertRows/endInsertRows pair for each contiguous range of rows"""
+        group_contacts = {}
+        for contact in contacts:
+            group_contacts.setdefault(contact.group, []).append((self._sort_key(contact), contact))
+        for group, new_contacts in group_contacts.iteritems():
+            new_contacts.sort(key=lambda item: item[0])
+            group_keys = self.group_keys[group]
+            ranges = []
+            for key, contact in new_contacts:
+                index = bisect.bisect_left(group_keys, key)
+                if ranges and ranges[-1][0] == index:
+                    ranges[-1][1].append((key, contact))
+                else:
+                    ranges.append((index, [(key, contact)]))
+            # insert from the end, so the rows for the ranges that come before remain valid
+            for index, items in reversed(ranges):
+                position = self._group_position(group) + 1 + index
+                self.beginInsertRows(QModelIndex(), position, position+len(items)-1)
+                self.items[position:position] = [contact for key, contact in items]
+                self.group_contacts[group][index:index] = [contact for key, contact in items]
+                self.group_keys[group][index:index] = [key for key, contact in items]
+                self.contact_keys.update((contact, key) for key, contact in items)
+                for item, offset in self.group_offsets.iteritems():
+                    if offset >= position and item is not group:
+                        self.group_offsets[item] = offset + len(items)
+                self.endInsertRows()
+                for row in xrange(position, position+len(items)):
+                    self.contact_list.setRowHidden(row, group.collapsed)
+
+    def _reset_contacts(self, contacts):
+        """Merge contacts into the list and rebuild it with a single model reset"""
+        new_contacts = {}
+        for contact in contacts:
+            new_contacts.setdefault(contact.group, []).append((self._sort_key(contact), contact))
+        group_offsets = self._get_group_offsets()
+        groups = sorted(group_offsets, key=group_offsets.get)
+        self.beginResetModel()
+        items = []
+        group_offsets = {}
+        for group in groups:
+            entries = zip(self.group_keys[group], self.group_contacts[group]) + new_contacts.get(group, [])
+            entries.sort(key=itemgetter(0))
+            group_offsets[group] = len(items)
+            items.append(group)
+            self.group_keys[group] = [key for key, contact in entries]
+            self.group_contacts[group] = [contact for key, contact in entries]
+            items.extend(self.group_contacts[group])
+        self.contact_keys.update((contact, key) for entries in new_contacts.itervalues() for key, contact in entries)
+        self.items = ItemList(items)
+        self.group_offsets = group_offsets
+        self.endResetModel()
+        # the reset closed the group editors and cleared the hidden rows
+        for group in groups:
+            self.contact_list.openPersistentEditor(self.index(group_offsets[group]))
+        for group in (group for group in groups if group.collapsed):
+            for row in xrange(group_offsets[group]+1, group_offsets[group]+1+len(self.group_contacts[group])):
+                self.contact_list.setRowHidden(row, True)
+
+    def _group_contact_list(self, group):
+        return GroupContactList(self.group_contacts[group] + [contact for contact in self._pending_contacts if contact.group is group])
+
     def _add_group(self, group):
         position = self._find_group_insertion_point(group)
         self.beginInsertRows(QModelIndex(), position, position)
         self.items.insert(position, group)
+        self.group_offsets = None
+        self.group_contacts[group] = []
+        self.group_keys[group] = []
         self.endInsertRows()
         self.contact_list.openPersistentEditor(self.index(position))
 
     def _pop_contact(self, contact):
-        position = self.items.index(contact)
+        position = self._contact_position(contact)
         self.beginRemoveRows(QModelIndex(), position, position)
         del self.items[position]
+        self._unregister_contact(contact)
         self.endRemoveRows()
         return contact
 
     def _pop_group(self, group):
-        start = self.items.index(group)
-        end = start + len(self.items[GroupContacts, group])
+        start = self._group_position(group)
+        end = start + len(self.group_contacts[group])
         self.beginRemoveRows(QModelIndex(), start, end)
         items = self.items[start:end+1]
         del self.items[start:end+1]
+        self.group_offsets = None
         self.endRemoveRows()
         return items
 
@@ -2743,6 +3232,7 @@ class ContactModel(QAbstractListModel):
             self.beginRemoveRows(QModelIndex(), start, end)
             items[0:0] = self.items[start:end+1]
             del self.items[start:end+1]
+            self.group_offsets = None
             self.endRemoveRows()
         return items
 
@@ -2761,16 +3251,55 @@ class ContactModel(QAbstractListModel):
             group.settings.position = position
             group.settings.save()
 
+    @contextlib.contextmanager
+    def batch(self):
+        """Defer adding contacts until the end of the block, when they are all inserted at once"""
+        self.begin_batch()
+        try:
+            yield
+        finally:
+            self.end_batch()
+
+    def begin_batch(self):
+        self._batch_level += 1
+
+    def end_batch(self):
+        self._batch_level -= 1
+        if self._batch_level == 0:
+            contacts, self._pending_contacts = self._pending_contacts.keys(), OrderedDict()
+            self.addContacts(contacts)
+
     def addContact(self, contact):
-        if contact in self.items:
+        self.addContacts([contact])
+
+    def addContacts(self, contacts):
+        contacts = [contact for contact in contacts if contact not in self.contact_keys and contact not in self._pending_contacts]
+        if not contacts:
             return
-        self._add_contact(contact)
-        self.itemsAdded.emit([contact])
+        if self._batch_level > 0:
+            self._pending_contacts.update((contact, None) for contact in contacts)
+            return
+        for contact in (contact for contact in contacts if contact.group.virtual):
+            self.uri_index.add(contact)
+            self.search_index.add(contact)
+        if len(contacts) > len(self.items):
+            self._reset_contacts(contacts)  # it is cheaper to rebuild the whole list than to insert more rows than it already has
+        elif len(contacts) == 1:
+            self._add_contact(contacts[0])
+        else:
+            self._add_contacts(contacts)
+        self.itemsAdded.emit(contacts)
 
     def removeContact(self, contact):
-        if contact not in self.items:
+        if contact in self._pending_contacts:
+            del self._pending_contacts[contact]
+            return
+        if contact not in self.contact_keys:
             return
         self._pop_contact(contact)
+        del self.contact_numbers[contact]
+        self.uri_index.remove(contact)
+        self.search_index.remove(contact)
         self.itemsRemoved.emit([contact])
 
     def addGroup(self, group):
@@ -2783,8 +3312,15 @@ class ContactModel(QAbstractListModel):
     def removeGroup(self, group):
         if group not in self.items:
             return
+        self._pending_contacts = OrderedDict((contact, None) for contact in self._pending_contacts if contact.group is not group)
         items = self._pop_group(group)
         group.widget = Null
+        for item in items:
+            self.uri_index.remove(item)
+            self.search_index.remove(item)
+            self.contact_keys.pop(item, None)
+            self.contact_numbers.pop(item, None)
+        del self.group_contacts[group], self.group_keys[group]
         self.itemsRemoved.emit(items)
         self._update_group_positions()
 
@@ -2796,6 +3332,7 @@ class ContactModel(QAbstractListModel):
         position = self.items.index(successor) if successor in groups else len(self.items)
         self.beginInsertRows(QModelIndex(), position, position+len(items)-1)
         self.items[position:position] = items
+        self.group_offsets = None
         self.endInsertRows()
         self.contact_list.openPersistentEditor(self.index(position))
         self._update_group_positions()
@@ -2833,12 +3370,29 @@ class ContactModel(QAbstractListModel):
 
 
 class ContactSearchModel(QSortFilterProxyModel):
+    searchFinished = pyqtSignal()
+
     # The MIME types we accept in drop operations, in the order they should be handled
     accepted_mime_types = ['text/uri-list']
 
+    search_delay = 150        # milliseconds to wait for further keystrokes before searching
+    search_chunk_size = 2000  # how many contacts to check in one event loop iteration
+
     def __init__(self, model, parent=None):
         super(ContactSearchModel, self).__init__(parent)
         self.contact_list = parent.search_list
+        self.search_pattern = None
+        self.search_results = set()
+        self.search_generation = None
+        self.search_text = None
+        self.search_job = None
+        self.search_timer = QTimer()
+        self.search_timer.setInterval(self.search_delay)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.timeout.connect(self._SH_SearchTimerTimeout)
+        self.search_step_timer = QTimer()
+        self.search_step_timer.setInterval(0)
+        self.search_step_timer.timeout.connect(self._SH_SearchStepTimerTimeout)
         self.setSourceModel(model)
         self.setDynamicSortFilter(True)
         self.sort(0)
@@ -2851,13 +3405,68 @@ class ContactSearchModel(QSortFilterProxyModel):
 
     def filterAcceptsRow(self, source_row, source_parent):
         source_model = self.sourceModel()
-        source_index = source_model.index(source_row, 0, source_parent)
-        item = source_index.data(Qt.UserRole)
+        item = source_model.items[source_row]
         if isinstance(item, Group) or not item.group.virtual:
             return False
-        search_tokens = self.filterRegExp().pattern().lower().split()
-        searched_item = u' '.join([item.name] + [uri.uri for uri in item.uris]).lower()  # should we only search in the username part of the uris? -Dan
-        return all(token in searched_item for token in search_tokens)
+        search_index = source_model.search_index
+        pattern = self.filterRegExp().pattern()
+        if pattern != self.search_pattern or search_index.generation != self.search_generation:
+            # the index changed after the search was made, so search again once instead of checking every row directly
+            self.search_pattern = pattern
+            self.search_results = search_index.search(pattern)
+            self.search_generation = search_index.generation
+        return item in self.search_results
+
+    def search(self, text):
+        """Filter the contacts by text once the user stops typing, cancelling any search in progress"""
+        self.search_text = text
+        self.search_job = None
+        self.search_step_timer.stop()
+        if text:
+            self.search_timer.start()
+        else:
+            self.search_timer.stop()
+            self._apply_search(text, self.sourceModel().search_index.search(text), self.sourceModel().search_index.generation)
+
+    def _search_job(self, text):
+        search_index = self.sourceModel().search_index
+        generation = search_index.generation
+        tokens = text.lower().split()
+        previous_tokens = (self.search_pattern or u'').lower().split()
+        if previous_tokens and generation == self.search_generation and all(any(previous_token in token for token in tokens) for previous_token in previous_tokens):
+            # every previous token is part of a new one, so the new results are a subset of the previous ones
+            candidates, exact = self.search_results, False
+        else:
+            candidates, exact = search_index.lookup(tokens)
+        if not exact:
+            candidates = list(candidates)
+            results = set()
+            for start in xrange(0, len(candidates), self.search_chunk_size):
+                results.update(contact for contact in candidates[start:start+self.search_chunk_size] if search_index.match(contact, tokens))
+                yield
+            candidates = results
+        self._apply_search(text, candidates, generation)
+
+    def _apply_search(self, text, results, generation):
+        self.search_pattern = text
+        self.search_results = results
+        self.search_generation = generation
+        if self.filterRegExp().pattern() == text:
+            self.invalidateFilter()
+        else:
+            self.setFilterFixedString(text)
+        self.searchFinished.emit()
+
+    def _SH_SearchTimerTimeout(self):
+        self.search_job = self._search_job(self.search_text)
+        self.search_step_timer.start()
+
+    def _SH_SearchStepTimerTimeout(self):
+        try:
+            next(self.search_job)
+        except StopIteration:
+            self.search_step_timer.stop()
+            self.search_job = None
 
     def lessThan(self, left_index, right_index):
         return left_index.data(Qt.DisplayRole) < right_index.data(Qt.DisplayRole)
@@ -4709,29 +5318,14 @@ class URIUtils(object):
             is_number = False
 
         # Exact URI matches
-        for contact in (contact for contact in contact_model.iter_contacts() if contact.group.virtual):
-            for contact_uri in contact.uris:
-                if uri.matches(contact_uri.uri):
-                    return contact, contact_uri
+        for contact, contact_uri in contact_model.uri_index.find_uri(uri.user, uri.host):
+            if uri.matches(contact_uri.uri):
+                return contact, contact_uri
 
         if not exact and is_number:
-            number = uri.user.lstrip('0')
-            counter = count()
-            matched_numbers = []
-            for contact in (contact for contact in contact_model.iter_contacts() if contact.group.virtual):
-                for contact_uri in contact.uris:
-                    uri_str = contact_uri.uri
-                    if uri_str.startswith(('sip:', 'sips:')):
-                        uri_str = uri_str.partition(':')[2]
-                    contact_user = uri_str.partition('@')[0]
-                    if cls.is_number(contact_user):
-                        contact_user = cls.trim_number(contact_user)  # these could be expensive, maybe cache -Dan
-                        if contact_user.endswith(number):
-                            ratio = len(number) * 100 / len(contact_user)
-                            if ratio >= 50:
-                                heappush(matched_numbers, (100-ratio, next(counter), contact, contact_uri))
-            if matched_numbers:
-                return matched_numbers[0][2:]  # ratio, index, contact, uri
+            match = contact_model.uri_index.find_number(uri.user.lstrip('0'))
+            if match is not None:
+                return match  # contact, uri
 
         display_name = display_name or "%s@%s" % (uri.user, uri.host)
         contact = Contact(DummyContact(display_name, [DummyContactURI(str(uri).partition(':')[2], default=True)]), None)
@@ -1,27 +1,132 @@
 
 import bisect
+import calendar
 import cPickle as pickle
+import os
 import re
+import sqlite3
 
 from PyQt5.QtGui import QIcon
 
 from application.notification import IObserver, NotificationCenter
 from application.python import Null
 from application.python.types import Singleton
-from datetime import date
+from application.system import unlink
+from datetime import date, datetime, timedelta
 from dateutil.tz import tzlocal
+from lxml import etree, html
+from threading import Lock
+from time import time
 from zope.interface import implements
 
 from sipsimple.account import BonjourAccount
-from sipsimple.addressbook import AddressbookManager
 from sipsimple.threading import run_in_thread
 from sipsimple.util import ISOTimestamp
 
+from blink.addressbook import AddressbookIndex
 from blink.resources import ApplicationData, Resources
-from blink.util import run_in_gui_thread
+from blink.util import call_later, run_in_gui_thread
 
 
-__all__ = ['HistoryManager']
+__all__ = ['ChatArchive', 'ChatArchiveEntry', 'HistoryManager']
+
+
+class SQLiteStore(object):
+    """An append-only, indexed on-disk store kept in a sqlite database, which is read newest first, one page at a time"""
+
+    table = None
+    schema = None
+    columns = ()  # the columns that are selected by the queries, in the order expected by the unpack function given to _query
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.executescript(self.schema)
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM %s' % self.table).fetchone()[0]
+
+    def _query(self, unpack, count, before=None, conditions=(), arguments=(), join=None):
+        """
+        Return at most count entries that match the conditions, newest first,
+        made from the selected rows by unpack. To get the next page pass the
+        last entry of the current page as before.
+        """
+        conditions = list(conditions)
+        arguments = list(arguments)
+        if before is not None:
+            conditions.append('(timestamp < ? OR (timestamp = ? AND id < ?))')
+            arguments.extend([before.timestamp, before.timestamp, before.id])
+        query = 'SELECT %s FROM %s' % (', '.join(self.columns), self.table)
+        if join is not None:
+            query += ' ' + join
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        query += ' ORDER BY timestamp DESC, id DESC LIMIT ?'
+        arguments.append(count)
+        with self.lock:
+            rows = self.connection.execute(query, arguments).fetchall()
+        return [unpack(row) for row in rows]
+
+
+class HistoryStore(SQLiteStore):
+    """An append-only, indexed on-disk store for the calls history"""
+
+    table = 'calls'
+    schema = """
+        CREATE TABLE IF NOT EXISTS calls (
+            id         INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp  REAL NOT NULL,
+            call_time  TEXT NOT NULL,
+            direction  TEXT NOT NULL,
+            name       TEXT,
+            uri        TEXT NOT NULL,
+            account_id TEXT NOT NULL,
+            duration   REAL,
+            failed     INTEGER NOT NULL DEFAULT 0,
+            reason     TEXT
+        );
+        CREATE INDEX IF NOT EXISTS calls_timestamp_idx ON calls (timestamp, id);
+        CREATE INDEX IF NOT EXISTS calls_uri_idx ON calls (uri, timestamp);
+        CREATE INDEX IF NOT EXISTS calls_account_idx ON calls (account_id, timestamp);
+    """
+    columns = ('id', 'call_time', 'direction', 'name', 'uri', 'account_id', 'duration', 'failed', 'reason')
+
+    def add(self, entries):
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT INTO calls (timestamp, call_time, direction, name, uri, account_id, duration, failed, reason) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', [self._pack(entry) for entry in entries])
+
+    def get_entries(self, count, before=None, uri=None, account_id=None):
+        """
+        Return at most count entries, newest first. To get the next page pass
+        the last entry of the current page as before.
+        """
+        conditions = []
+        arguments = []
+        if uri is not None:
+            conditions.append('uri = ?')
+            arguments.append(uri)
+        if account_id is not None:
+            conditions.append('account_id = ?')
+            arguments.append(account_id)
+        return self._query(self._unpack, count, before, conditions, arguments)
+
+    @staticmethod
+    def _pack(entry):
+        duration = entry.duration.total_seconds() if entry.duration is not None else None
+        return entry.timestamp, unicode(entry.call_time), entry.direction, entry.name, entry.uri, entry.account_id, duration, entry.failed, entry.reason
+
+    @staticmethod
+    def _unpack(row):
+        id, call_time, direction, name, uri, account_id, duration, failed, reason = row
+        duration = timedelta(seconds=duration) if duration is not None else None
+        entry = HistoryEntry(direction, name, uri, account_id, ISOTimestamp(call_time), duration, bool(failed), reason)
+        entry.id = id
+        return entry
 
 
 class HistoryManager(object):
@@ -31,22 +136,34 @@ class HistoryManager(object):
     history_size = 20
 
     def __init__(self):
+        self.store = HistoryStore(ApplicationData.get('calls_history.db'))
+        self._import_legacy_history()
+        self.calls = list(reversed(self.store.get_entries(self.history_size)))
+        notification_center = NotificationCenter()
+        notification_center.add_observer(self, name='SIPSessionDidEnd')
+        notification_center.add_observer(self, name='SIPSessionDidFail')
+
+    def _import_legacy_history(self):
+        filename = ApplicationData.get('calls_history')
+        if not os.path.exists(filename):
+            return
         try:
-            data = pickle.load(open(ApplicationData.get('calls_history')))
+            data = pickle.load(open(filename))
             if not isinstance(data, list) or not all(isinstance(item, HistoryEntry) and item.text and isinstance(item.call_time, ISOTimestamp) for item in data):
                 raise ValueError("invalid save data")
         except Exception:
-            self.calls = []
+            pass
         else:
-            self.calls = data[-self.history_size:]
-        notification_center = NotificationCenter()
-        notification_center.add_observer(self, name='SIPSessionDidEnd')
-        notification_center.add_observer(self, name='SIPSessionDidFail')
+            if not self.store:
+                self.store.add(sorted(data))
+        unlink(filename)
+
+    def get_entries(self, count=history_size, before=None, uri=None, account_id=None):
+        return self.store.get_entries(count, before=before, uri=uri, account_id=account_id)
 
     @run_in_thread('file-io')
-    def save(self):
-        with open(ApplicationData.get('calls_history'), 'wb+') as history_file:
-            pickle.dump(self.calls, history_file)
+    def save(self, entry):
+        self.store.add([entry])
 
     @run_in_gui_thread
     def handle_notification(self, notification):
@@ -60,7 +177,7 @@ class HistoryManager(object):
         entry = HistoryEntry.from_session(session)
         bisect.insort(self.calls, entry)
         self.calls = self.calls[-self.history_size:]
-        self.save()
+        self.save(entry)
 
     def _NH_SIPSessionDidFail(self, notification):
         if notification.sender.account is BonjourAccount():
@@ -80,7 +197,160 @@ class HistoryManager(object):
             entry.failed = True
         bisect.insort(self.calls, entry)
         self.calls = self.calls[-self.history_size:]
-        self.save()
+        self.save(entry)
+
+
+class ChatArchiveStore(SQLiteStore):
+    """An append-only, indexed on-disk store for chat messages, with a full text index over the message text"""
+
+    table = 'messages'
+    schema = """
+        CREATE TABLE IF NOT EXISTS messages (
+            id           INTEGER PRIMARY KEY AUTOINCREMENT,
+            timestamp    REAL NOT NULL,
+            account_id   TEXT NOT NULL,
+            uri          TEXT NOT NULL,
+            direction    TEXT NOT NULL,
+            sender_name  TEXT,
+            sender_uri   TEXT,
+            content_type TEXT NOT NULL,
+            content      TEXT NOT NULL,
+            text         TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS messages_timestamp_idx ON messages (timestamp, id);
+        CREATE INDEX IF NOT EXISTS messages_uri_idx ON messages (uri, timestamp, id);
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_text USING fts4(content="messages", text);
+    """
+    columns = ('id', 'timestamp', 'account_id', 'uri', 'direction', 'sender_name', 'sender_uri', 'content_type', 'content')
+
+    def add(self, entries):
+        with self.lock, self.connection:
+            for entry in entries:
+                text = self._get_text(entry)
+                cursor = self.connection.execute('INSERT INTO messages (timestamp, account_id, uri, direction, sender_name, sender_uri, content_type, content, text) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                                 (entry.timestamp, entry.account_id, entry.uri, entry.direction, entry.sender_name, entry.sender_uri, entry.content_type, entry.content, text))
+                self.connection.execute('INSERT INTO messages_text (docid, text) VALUES (?, ?)', (cursor.lastrowid, text))
+
+    def get_entries(self, count, before=None, until=None, uri=None, account_id=None):
+        """
+        Return at most count entries, newest first. To get the next page pass
+        the last entry of the current page as before.
+        """
+        conditions, arguments = self._get_filter(until, uri, account_id)
+        return self._query(self._unpack, count, before, conditions, arguments)
+
+    def search(self, text, count, before=None, until=None, uri=None, account_id=None):
+        """
+        Return at most count entries that contain all the words in text,
+        newest first. Pagination works the same as for get_entries.
+        """
+        words = text.replace(u'"', u' ').split()
+        if not words:
+            return []
+        match = u' '.join(u'"%s"' % word for word in words)  # quote the words, so that they are not interpreted as query operators
+        conditions, arguments = self._get_filter(until, uri, account_id)
+        return self._query(self._unpack, count, before, ['messages_text MATCH ?'] + conditions, [match] + arguments, join='JOIN messages_text ON messages_text.docid = messages.id')
+
+    @staticmethod
+    def _get_filter(until, uri, account_id):
+        conditions = []
+        arguments = []
+        if until is not None:
+            conditions.append('timestamp < ?')
+            arguments.append(until)
+        if uri is not None:
+            conditions.append('uri = ?')
+            arguments.append(uri)
+        if account_id is not None:
+            conditions.append('account_id = ?')
+            arguments.append(account_id)
+        return conditions, arguments
+
+    @staticmethod
+    def _get_text(entry):
+        if entry.content_type == 'text/html':
+            try:
+                return html.fromstring(entry.content).text_content()
+            except (etree.ParserError, ValueError):
+                return u''
+        return entry.content
+
+    @staticmethod
+    def _unpack(row):
+        id, timestamp, account_id, uri, direction, sender_name, sender_uri, content_type, content = row
+        entry = ChatArchiveEntry(account_id, uri, direction, sender_name, sender_uri, content_type, content, timestamp)
+        entry.id = id
+        return entry
+
+
+class ChatArchiveEntry(object):
+    def __init__(self, account_id, uri, direction, sender_name, sender_uri, content_type, content, timestamp=None):
+        self.account_id = account_id
+        self.uri = uri
+        self.direction = direction
+        self.sender_name = sender_name
+        self.sender_uri = sender_uri
+        self.content_type = content_type
+        self.content = content
+        self.timestamp = timestamp if timestamp is not None else time()
+        self.id = None
+
+    def __repr__(self):
+        return '%s(%r, %r, %r, %r, %r, %r, %r, %r)' % (self.__class__.__name__, self.account_id, self.uri, self.direction, self.sender_name, self.sender_uri, self.content_type, self.content, self.timestamp)
+
+    @property
+    def time(self):
+        return datetime.fromtimestamp(self.timestamp)
+
+
+class ChatArchive(object):
+    """Keep the chat messages in a local archive that can be searched"""
+
+    __metaclass__ = Singleton
+    implements(IObserver)
+
+    write_delay = 1  # seconds to wait for more messages before they are written to the archive
+
+    def __init__(self):
+        self.store = ChatArchiveStore(ApplicationData.get('chat_archive.db'))
+        self._pending_entries = []
+        self._pending_entries_lock = Lock()
+        notification_center = NotificationCenter()
+        notification_center.add_observer(self, name='SIPApplicationWillEnd')
+
+    def add(self, entry):
+        with self._pending_entries_lock:
+            self._pending_entries.append(entry)
+            if len(self._pending_entries) > 1:
+                return
+        call_later(self.write_delay, self._write_pending_entries)
+
+    def get_entries(self, count, before=None, until=None, uri=None, account_id=None):
+        """Return a page of archived messages. This writes the pending messages and queries the database, so it must not be called from the GUI thread"""
+        self._flush()  # the messages waiting to be written must be found by the query, or they would be missing from the pages
+        return self.store.get_entries(count, before=before, until=until, uri=uri, account_id=account_id)
+
+    def search(self, text, count, before=None, until=None, uri=None, account_id=None):
+        """Return a page of the archived messages that contain text. Like get_entries, this must not be called from the GUI thread"""
+        self._flush()
+        return self.store.search(text, count, before=before, until=until, uri=uri, account_id=account_id)
+
+    def _flush(self):
+        with self._pending_entries_lock:
+            entries, self._pending_entries = self._pending_entries, []
+        if entries:
+            self.store.add(entries)
+
+    @run_in_thread('file-io')
+    def _write_pending_entries(self):
+        self._flush()
+
+    def handle_notification(self, notification):
+        handler = getattr(self, '_NH_%s' % notification.name, Null)
+        handler(notification)
+
+    def _NH_SIPApplicationWillEnd(self, notification):
+        self._write_pending_entries()
 
 
 class IconDescriptor(object):
@@ -118,6 +388,7 @@ class HistoryEntry(object):
         self.duration = duration
         self.failed = failed
         self.reason = reason
+        self.id = None
 
     def __reduce__(self):
         return self.__class__, (self.direction, self.name, self.uri, self.account_id, self.call_time, self.duration, self.failed, self.reason)
@@ -140,6 +411,10 @@ class HistoryEntry(object):
     def __ge__(self, other):
         return self.call_time >= other.call_time
 
+    @property
+    def timestamp(self):
+        return calendar.timegm(self.call_time.utctimetuple()) + self.call_time.microsecond / 1e6
+
     @property
     def icon(self):
         if self.failed:
@@ -189,12 +464,11 @@ class HistoryEntry(object):
         match = cls.phone_number_re.match(remote_uri)
         if match:
             remote_uri = match.group('number')
-        try:
-            contact = next(contact for contact in AddressbookManager().get_contacts() if remote_uri in (addr.uri for addr in contact.uris))
-        except StopIteration:
-            display_name = session.remote_identity.display_name
+        contacts = AddressbookIndex().get_contacts(remote_uri)
+        if contacts:
+            display_name = contacts[0].name
         else:
-            display_name = contact.name
+            display_name = session.remote_identity.display_name
         return cls(session.direction, display_name, remote_uri, unicode(session.account.id), call_time, duration)
 
 
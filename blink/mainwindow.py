@@ -1,5 +1,4 @@
 
-import hashlib
 import os
 
 from functools import partial
@@ -147,6 +146,7 @@ class MainWindow(base_class, ui_class):
         self.contact_list.selectionModel().selectionChanged.connect(self._SH_ContactListSelectionChanged)
         self.contact_model.itemsAdded.connect(self._SH_ContactModelAddedItems)
         self.contact_model.itemsRemoved.connect(self._SH_ContactModelRemovedItems)
+        self.contact_search_model.searchFinished.connect(self._SH_ContactSearchFinished)
 
         self.display_name.editingFinished.connect(self._SH_DisplayNameEditingFinished)
         self.hangup_all_button.clicked.connect(self._SH_HangupAllButtonClicked)
@@ -511,7 +511,7 @@ class MainWindow(base_class, ui_class):
             if filename is not None:
                 icon = icon_manager.store_file('avatar', filename)
                 if icon is not None:
-                    blink_settings.presence.icon = IconDescriptor(FileURL(icon.filename), hashlib.sha1(icon.content).hexdigest())
+                    blink_settings.presence.icon = IconDescriptor(FileURL(icon.filename), icon.digest)
                 else:
                     icon_manager.remove('avatar')
                     blink_settings.presence.icon = None
@@ -624,6 +624,10 @@ class MainWindow(base_class, ui_class):
             active_widget = self.search_list_panel if self.contact_search_model.rowCount() else self.not_found_panel
             self.search_view.setCurrentWidget(active_widget)
 
+    def _SH_ContactSearchFinished(self):
+        if self.search_box.text():
+            self.search_view.setCurrentWidget(self.search_list_panel if self.contact_search_model.rowCount() else self.not_found_panel)
+
     def _SH_DisplayNameEditingFinished(self):
         self.display_name.clearFocus()
         index = self.identity.currentIndex()
@@ -672,14 +676,13 @@ class MainWindow(base_class, ui_class):
             session_manager.create_session(contact, contact_uri, [StreamDescription('audio')])
 
     def _SH_SearchBoxTextChanged(self, text):
-        self.contact_search_model.setFilterFixedString(text)
+        self.contact_search_model.search(text)
         account_manager = AccountManager()
         if text:
             self.switch_view_button.view = SwitchViewButton.ContactView
             if self.contacts_view.currentWidget() is not self.search_panel:
                 self.search_list.selectionModel().clearSelection()
             self.contacts_view.setCurrentWidget(self.search_panel)
-            self.search_view.setCurrentWidget(self.search_list_panel if self.contact_search_model.rowCount() else self.not_found_panel)
             selected_items = self.search_list.selectionModel().selectedIndexes()
             self.enable_call_buttons(account_manager.default_account is not None and len(selected_items)<=1)
         else:
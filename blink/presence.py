@@ -3,19 +3,24 @@ import base64
 import hashlib
 import re
 import socket
+import time
 import uuid
 
 from PyQt5 import uic
 from PyQt5.QtCore import Qt, QTimer
 
+from application import log
 from application.notification import IObserver, NotificationCenter, NotificationData
 from application.python import Null, limit
+from application.python.threadpool import ThreadPool, run_in_threadpool
+from application.python.types import Singleton
 from datetime import datetime
 from dateutil.tz import tzutc
-from eventlib.green import urllib2
+from functools import partial
+from httplib2 import Http
 from itertools import chain
+from threading import Lock, local
 from twisted.internet import reactor
-from twisted.internet.error import ConnectionLost
 from zope.interface import implements
 
 from sipsimple import addressbook
@@ -28,10 +33,11 @@ from sipsimple.payloads import cipid
 from sipsimple.threading.green import run_in_green_thread
 from sipsimple.util import ISOTimestamp
 
+from blink.addressbook import AddressbookIndex
 from blink.configuration.datatypes import IconDescriptor, FileURL, PresenceState
 from blink.configuration.settings import BlinkSettings
 from blink.resources import IconManager, Resources
-from blink.util import run_in_gui_thread
+from blink.util import call_in_gui_thread, call_later, run_in_gui_thread
 
 del cipid  # this only needs to be imported to register its namespace and extensions
 
@@ -185,7 +191,8 @@ class PresencePublicationHandler(object):
                     account.xcap_manager.set_offline_status(OfflineStatus(state) if state is not None else None)
             if 'presence.icon' in notification.data.modified:
                 icon = IconManager().get('avatar')
-                status_icon = Icon(icon.content, icon.content_type) if icon is not None else None
+                content = icon.content if icon is not None else None
+                status_icon = Icon(content, icon.content_type) if content is not None else None
                 for account in (account for account in account_manager.get_accounts() if account.xcap.discovered):
                     account.xcap_manager.set_status_icon(status_icon)
             if 'presence.current_state' in notification.data.modified:
@@ -245,8 +252,9 @@ class PresencePublicationHandler(object):
     def _NH_SIPAccountDidDiscoverXCAPSupport(self, notification):
         account = notification.sender
         icon = IconManager().get('avatar')
-        if icon is not None:
-            account.xcap_manager.set_status_icon(Icon(icon.content, icon.content_type))
+        content = icon.content if icon is not None else None
+        if content is not None:
+            account.xcap_manager.set_status_icon(Icon(content, icon.content_type))
 
     @run_in_gui_thread
     def _NH_XCAPManagerDidReloadData(self, notification):
@@ -301,30 +309,76 @@ class ContactIcon(object):
         self.data = data
         self.descriptor = descriptor
 
-    @classmethod
-    def fetch(cls, url, etag=None, descriptor_etag=None):
-        headers = {'If-None-Match': etag} if etag else {}
-        req = urllib2.Request(url, headers=headers)
+
+class ContactIconFetcher(object):
+    """Download the icons published in presence documents, without making the caller wait for them"""
+
+    __metaclass__ = Singleton
+
+    failure_timeout = 600  # seconds during which a URL that could not be retrieved is not requested again
+
+    threadpool = ThreadPool(name='presence-icons', min_threads=1, max_threads=4)
+    threadpool.start()
+
+    def __init__(self):
+        self._lock = Lock()
+        self._requests = {}  # (url, etag, descriptor_etag) -> [callback, ...] for the requests in progress
+        self._failures = {}  # url -> time when it can be requested again
+        self._local = local()  # every thread keeps its own connections open, as Http objects cannot be shared between threads
+
+    def fetch(self, url, callback, etag=None, descriptor_etag=None):
+        """Retrieve the icon in the background and call callback with it, or with None if it did not change or could not be retrieved"""
+        key = url, etag, descriptor_etag
+        with self._lock:
+            if self._failures.get(url, 0) > time.time():
+                return
+            if key in self._requests:
+                self._requests[key].append(callback)
+                return
+            self._requests[key] = [callback]
+        self._fetch(url, etag, descriptor_etag)
+
+    @run_in_threadpool(threadpool)
+    def _fetch(self, url, etag, descriptor_etag):
         try:
-            response = urllib2.urlopen(req)
-            content = response.read()
-            info = response.info()
-        except (ConnectionLost, urllib2.URLError, urllib2.HTTPError):
+            icon = self._retrieve(url, etag, descriptor_etag)
+        except Exception as e:
+            log.warning(u'could not retrieve icon from {}: {!s}'.format(url, e))
+            icon = None
+            failed = True
+        else:
+            failed = icon is Null
+        with self._lock:
+            if failed:
+                self._failures[url] = time.time() + self.failure_timeout
+            else:
+                self._failures.pop(url, None)
+            callbacks = self._requests.pop((url, etag, descriptor_etag))
+        for callback in callbacks:
+            callback(icon or None)
+
+    def _retrieve(self, url, etag, descriptor_etag):
+        """Return the icon, None if it did not change and Null if the URL did not provide one"""
+        try:
+            http = self._local.http
+        except AttributeError:
+            http = self._local.http = Http(timeout=10)
+        headers = {'If-None-Match': etag} if etag else {}
+        response, content = http.request(url, headers=headers)
+        if response.status == 304:
             return None
-        content_type = info.getheader('content-type')
-        etag = info.getheader('etag')
+        if response.status != 200 or response.get('content-type') != prescontent.PresenceContentDocument.content_type:
+            return Null
+        try:
+            pres_content = prescontent.PresenceContentDocument.parse(content)
+            data = base64.decodestring(pres_content.data.value)
+        except Exception:
+            return Null
+        etag = response.get('etag', '')
         if etag.startswith('W/'):
             etag = etag[2:]
         etag = etag.replace('\"', '')
-        if content_type == prescontent.PresenceContentDocument.content_type:
-            try:
-                pres_content = prescontent.PresenceContentDocument.parse(content)
-                data = base64.decodestring(pres_content.data.value)
-            except Exception:
-                return None
-            return cls(data, IconDescriptor(url, descriptor_etag or etag))
-        else:
-            return None
+        return ContactIcon(data, IconDescriptor(url, descriptor_etag or etag or None))
 
 
 class PresenceSubscriptionHandler(object):
@@ -332,10 +386,14 @@ class PresenceSubscriptionHandler(object):
 
     sip_prefix_re = re.compile("^sips?:")
 
+    update_delay = 0.2  # seconds to wait for more presence changes, before applying them together
+
     def __init__(self):
         self._pidf_map = {}
         self._winfo_map = {}
         self._winfo_timers = {}
+        self._pending_updates = {}
+        self._pending_updates_lock = Lock()
 
     def start(self):
         notification_center = NotificationCenter()
@@ -343,6 +401,8 @@ class PresenceSubscriptionHandler(object):
         notification_center.add_observer(self, name='SIPAccountWillDeactivate')
         notification_center.add_observer(self, name='SIPAccountGotPresenceState')
         notification_center.add_observer(self, name='SIPAccountGotPresenceWinfo')
+        notification_center.add_observer(self, name='AddressbookContactWasActivated')
+        notification_center.add_observer(self, name='AddressbookContactDidChange')
 
     def stop(self):
         notification_center = NotificationCenter()
@@ -350,6 +410,8 @@ class PresenceSubscriptionHandler(object):
         notification_center.remove_observer(self, name='SIPAccountWillDeactivate')
         notification_center.remove_observer(self, name='SIPAccountGotPresenceState')
         notification_center.remove_observer(self, name='SIPAccountGotPresenceWinfo')
+        notification_center.remove_observer(self, name='AddressbookContactWasActivated')
+        notification_center.remove_observer(self, name='AddressbookContactDidChange')
         self._pidf_map.clear()
         self._winfo_map.clear()
         for timer in self._winfo_timers.values():
@@ -359,8 +421,19 @@ class PresenceSubscriptionHandler(object):
 
     @run_in_green_thread
     def _process_presence_data(self, uris=None):
-        addressbook_manager = addressbook.AddressbookManager()
+        addressbook_index = AddressbookIndex()
 
+        # If no URIs were provided, process all of them
+        if not uris:
+            uris = set(chain(*(item.iterkeys() for item in self._pidf_map.itervalues())))
+
+        self._update_contacts(set(chain(*(addressbook_index.get_contacts(uri) for uri in uris))))
+
+    @run_in_green_thread
+    def _process_contacts(self, contacts):
+        self._update_contacts(contacts)
+
+    def _update_contacts(self, contacts):
         def service_sort_key(service):
             timestamp = service.timestamp.value if service.timestamp else epoch
             if service.status.extended is not None:
@@ -370,24 +443,11 @@ class PresenceSubscriptionHandler(object):
             else:
                 return 0, timestamp
 
-        current_pidf_map = {}
-        contact_pidf_map = {}
-
-        # If no URIs were provided, process all of them
-        if not uris:
-            uris = list(chain(*(item.iterkeys() for item in self._pidf_map.itervalues())))
-
-        for uri, pidf_list in chain(*(x.iteritems() for x in self._pidf_map.itervalues())):
-            current_pidf_map.setdefault(uri, []).extend(pidf_list)
-
-        for uri in uris:
-            pidf_list = current_pidf_map.get(uri, [])
-            for contact in (contact for contact in addressbook_manager.get_contacts() if uri in (self.sip_prefix_re.sub('', contact_uri.uri) for contact_uri in contact.uris)):
-                contact_pidf_map.setdefault(contact, []).extend(pidf_list)
-
-        for contact, pidf_list in contact_pidf_map.iteritems():
+        for contact in contacts:
+            uris = {AddressbookIndex.normalize(contact_uri.uri) for contact_uri in contact.uris}
+            pidf_list = list(chain(*(account_map.get(uri, ()) for account_map in self._pidf_map.itervalues() for uri in uris)))
             if not pidf_list:
-                state = note = icon = None
+                state = note = None
             else:
                 services = list(chain(*(list(pidf_doc.services) for pidf_doc in pidf_list)))
                 services.sort(key=service_sort_key, reverse=True)
@@ -400,47 +460,71 @@ class PresenceSubscriptionHandler(object):
                 icon_url = unicode(service.icon) if service.icon else None
 
                 if icon_url:
+                    icon_fetcher = ContactIconFetcher()
                     url, token, icon_hash = icon_url.partition('#blink-icon')
                     if token:
-                        if contact.icon and icon_hash == contact.icon.etag:
-                            # Fast path, icon hasn't changed
-                            icon = None
-                        else:
-                            # New icon, client uses fast path mechanism
-                            icon = ContactIcon.fetch(icon_url, etag=None, descriptor_etag=icon_hash)
+                        # The client uses the fast path mechanism, so the icon only needs to be fetched if its hash changed
+                        if not contact.icon or icon_hash != contact.icon.etag:
+                            icon_fetcher.fetch(icon_url, partial(self._update_presence_icon, contact), etag=None, descriptor_etag=icon_hash)
                     else:
-                        icon = ContactIcon.fetch(icon_url, etag=contact.icon.etag if contact.icon else None)
-                else:
-                    icon = None
-            self._update_presence_state(contact, state, note, icon)
+                        icon_fetcher.fetch(icon_url, partial(self._update_presence_icon, contact), etag=contact.icon.etag if contact.icon else None)
+            self._update_presence_state(contact, state, note)
 
-    @run_in_gui_thread
-    def _update_presence_state(self, contact, state, note, icon):
-        icon_manager = IconManager()
-        contact.presence.state = state
-        contact.presence.note = note
+    def _update_presence_state(self, contact, state, note):
+        self._queue_update(contact, state=state, note=note)
+
+    def _update_presence_icon(self, contact, icon):
         if icon is not None:
-            icon_manager.store_data(contact.id, icon.data)
-            contact.icon = icon.descriptor
-        contact.save()
+            self._queue_update(contact, icon=icon)
+
+    def _queue_update(self, contact, **update):
+        with self._pending_updates_lock:
+            start_timer = not self._pending_updates
+            self._pending_updates.setdefault(contact, {}).update(update)
+        if start_timer:
+            call_in_gui_thread(call_later, self.update_delay, self._apply_presence_updates)
+
+    def _apply_presence_updates(self):
+        with self._pending_updates_lock:
+            updates, self._pending_updates = self._pending_updates, {}
+        icon_manager = IconManager()
+        with addressbook.AddressbookManager.transaction():
+            for contact, update in updates.iteritems():
+                if 'state' in update:
+                    contact.presence.state = update['state']
+                    contact.presence.note = update['note']
+                if 'icon' in update:
+                    icon_manager.store_data(contact.id, update['icon'].data)
+                    contact.icon = update['icon'].descriptor
+                contact.save()
 
     def handle_notification(self, notification):
         handler = getattr(self, '_NH_%s' % notification.name, Null)
         handler(notification)
 
+    def _NH_AddressbookContactWasActivated(self, notification):
+        if self._pidf_map:
+            self._process_contacts([notification.sender])
+
+    def _NH_AddressbookContactDidChange(self, notification):
+        if any(key.startswith('uris') for key in notification.data.modified):
+            self._process_contacts([notification.sender])
+
     def _NH_CFGSettingsObjectDidChange(self, notification):
         account = notification.sender
         if '__id__' in notification.data.modified:
             old_id = notification.data.modified['__id__'].old
-            self._pidf_map.pop(old_id, None)
+            account_map = self._pidf_map.pop(old_id, None)
             self._winfo_map.pop(old_id, None)
-            self._process_presence_data()
+            if account_map:
+                self._process_presence_data(account_map.keys())
             return
         if {'enabled', 'presence.enabled'}.intersection(notification.data.modified):
             if not account.enabled or not account.presence.enabled:
-                self._pidf_map.pop(account.id, None)
+                account_map = self._pidf_map.pop(account.id, None)
                 self._winfo_map.pop(account.id, None)
-                self._process_presence_data()
+                if account_map:
+                    self._process_presence_data(account_map.keys())
 
     def _NH_SIPAccountWillActivate(self, notification):
         if notification.sender is not BonjourAccount():
@@ -459,12 +543,16 @@ class PresenceSubscriptionHandler(object):
         new_pidf_map = dict((self.sip_prefix_re.sub('', uri), resource.pidf_list) for uri, resource in notification.data.resource_map.iteritems())
         account_map = self._pidf_map.setdefault(account.id, {})
         if notification.data.full_state:
+            changed_uris = set(account_map).union(new_pidf_map)  # the URIs missing from a full state have no presence anymore
             account_map.clear()
+        else:
+            changed_uris = set(new_pidf_map)
         account_map.update(new_pidf_map)
-        self._process_presence_data(new_pidf_map.keys())
+        if changed_uris:
+            self._process_presence_data(changed_uris)
 
     def _NH_SIPAccountGotPresenceWinfo(self, notification):
-        addressbook_manager = addressbook.AddressbookManager()
+        addressbook_index = AddressbookIndex()
         account = notification.sender
         watcher_list = notification.data.watcher_list
 
@@ -480,18 +568,12 @@ class PresenceSubscriptionHandler(object):
 
         pending_watchers = self._winfo_map[account.id].setdefault('pending', set()) | self._winfo_map[account.id].setdefault('waiting', set())
         for uri in pending_watchers:
-            # check if there is a policy
-            try:
-                next(policy for policy in addressbook_manager.get_policies() if policy.uri == uri and policy.presence.policy != 'default')
-            except StopIteration:
-                # check if there is a contact
-                try:
-                    next(contact for contact in addressbook_manager.get_contacts() if contact.presence.policy != 'default' and uri in (addr.uri for addr in contact.uris))
-                except StopIteration:
-                    # TODO: add display name -Saul
-                    if uri not in self._winfo_timers:
-                        self._winfo_timers[uri] = reactor.callLater(600, self._winfo_timers.pop, uri, None)
-                        notification.center.post_notification('SIPAccountGotPendingWatcher', sender=account, data=NotificationData(uri=uri, display_name=None, event='presence'))
+            # check if there is a policy or a contact
+            if not addressbook_index.has_presence_policy(uri):
+                # TODO: add display name -Saul
+                if uri not in self._winfo_timers:
+                    self._winfo_timers[uri] = reactor.callLater(600, self._winfo_timers.pop, uri, None)
+                    notification.center.post_notification('SIPAccountGotPendingWatcher', sender=account, data=NotificationData(uri=uri, display_name=None, event='presence'))
 
 
 class PresenceManager(object):
@@ -524,10 +606,9 @@ class PendingWatcherDialog(base_class, ui_class):
         font = self.name_label.font()
         font.setPointSizeF(name_font_size)
         self.name_label.setFont(font)
-        addressbook_manager = addressbook.AddressbookManager()
         try:
-            self.contact = next(contact for contact in addressbook_manager.get_contacts() if uri in (addr.uri for addr in contact.uris))
-        except StopIteration:
+            self.contact = AddressbookIndex().get_contacts(uri)[0]
+        except IndexError:
             self.contact = None
         else:
             display_name = self.contact.name
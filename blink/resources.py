@@ -2,23 +2,27 @@
 """Provide access to Blink's resources"""
 
 import __main__
+import hashlib
 import imghdr
 import os
 import platform
 import sys
 
 from PyQt5.QtCore import Qt, QBuffer
-from PyQt5.QtGui import QIcon, QPixmap
+from PyQt5.QtGui import QIcon, QImage, QPainter, QPainterPath, QPixmap
 
 from application.python.descriptor import classproperty
+from application.python.threadpool import ThreadPool, run_in_threadpool
 from application.python.types import Singleton
 from application.system import makedirs, unlink
+from collections import OrderedDict
 
 from sipsimple.configuration.datatypes import Path
-from blink.util import run_in_gui_thread
+from sipsimple.threading import run_in_thread
+from blink.util import call_in_gui_thread, run_in_gui_thread
 
 
-__all__ = ['ApplicationData', 'Resources', 'IconManager']
+__all__ = ['ApplicationData', 'Resources', 'IconManager', 'ThumbnailCache']
 
 
 class DirectoryContextManager(unicode):
@@ -83,94 +87,419 @@ class Resources(object):
         return os.path.join(cls.directory, os.path.normpath(resource))
 
 
+class FileIcon(QIcon):
+    """An icon stored in a file, whose content is only read when it is needed"""
+
+    def __init__(self, pixmap, filename, digest, content_type='image/png'):
+        super(FileIcon, self).__init__(pixmap)
+        self.filename = filename
+        self.digest = digest
+        self.content_type = content_type
+        self.cost = pixmap.width() * pixmap.height() * 4
+
+    @property
+    def content(self):
+        try:
+            with open(self.filename, 'rb') as f:
+                return f.read()
+        except (IOError, OSError):
+            return None  # the file was removed, so the icon is no longer available
+
+
+class IconRequest(object):
+    """The result of loading an icon in the background, which may not be available yet"""
+
+    def __init__(self, ids):
+        self.ids = ids
+        self.done = False
+        self.result = None
+        self._callbacks = []
+
+    def add_done_callback(self, callback):
+        if self.done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def set_result(self, result):
+        self.done = True
+        self.result = result
+        callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
 class IconManager(object):
     __metaclass__ = Singleton
 
     max_size = 256
+    memory_limit = 32*1024*1024  # bytes. the contact list is painted from thumbnails, so this only needs to hold the icons shown at full size
+
+    threadpool = ThreadPool(name='icon-loader', min_threads=1, max_threads=4)
+    threadpool.start()
 
     def __init__(self):
-        self.iconmap = {}
+        self.iconmap = OrderedDict()  # id -> icon or None, least recently used first
+        self.memory_usage = 0
+        self.requests = {}  # ids -> pending request
+        self.digests = {}  # id -> digest of the icon content or None if it does not exist, kept after the icon is evicted
 
     @run_in_gui_thread(wait=True)
     def get(self, id):
         id = id.replace('/', '_')
         try:
-            return self.iconmap[id]
+            return self._lookup(id)
         except KeyError:
-            pixmap = QPixmap()
-            filename = ApplicationData.get(os.path.join('images', id + '.png'))
+            return self._add(id, *self._load(id))
+
+    def request(self, *ids):
+        """Return a request for the first of the icons that exists, loading them in the background if needed. Must be called from the GUI thread."""
+        ids = tuple(id.replace('/', '_') for id in ids)
+        try:
+            return self.requests[ids]
+        except KeyError:
+            pass
+        request = IconRequest(ids)
+        for id in ids:
             try:
-                with open(filename, 'rb') as f:
-                    data = f.read()
-            except (IOError, OSError):
-                data = None
-            if data is not None and pixmap.loadFromData(data):
-                icon = QIcon(pixmap)
-                icon.filename = filename
-                icon.content = data
-                icon.content_type = 'image/png'
-            else:
-                icon = None
-            return self.iconmap.setdefault(id, icon)
+                icon = self._lookup(id)
+            except KeyError:
+                break
+            if icon is not None:
+                request.set_result(icon)
+                return request
+        else:
+            request.set_result(None)
+            return request
+        self.requests[ids] = request
+        self._load_request(request)
+        return request
 
-    @run_in_gui_thread(wait=True)
     def store_data(self, id, data):
         id = id.replace('/', '_')
-        directory = ApplicationData.get('images')
-        filename = os.path.join(directory, id + '.png')
-        makedirs(directory)
-        pixmap = QPixmap()
-        if data is not None and pixmap.loadFromData(data):
-            image_size = pixmap.size()
+        old_digest = self._get_digest(id)
+        image = QImage.fromData(data) if data is not None else QImage()
+        if not image.isNull():
+            image_size = image.size()
             if image_size.width() > self.max_size or image_size.height() > self.max_size:
-                pixmap = pixmap.scaled(self.max_size, self.max_size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
-            if imghdr.what(None, data) != 'png' or pixmap.size() != image_size:
+                image = image.scaled(self.max_size, self.max_size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+            if imghdr.what(None, data) != 'png' or image.size() != image_size:
                 buffer = QBuffer()
-                pixmap.save(buffer, 'png')
+                image.save(buffer, 'png')
                 data = str(buffer.data())
-            with open(filename, 'wb') as f:
-                f.write(data)
-            icon = QIcon(pixmap)
-            icon.filename = filename
-            icon.content = data
-            icon.content_type = 'image/png'
+            self._write(id, data)
+            ThumbnailCache().prepare(data)
+            return self._publish(id, image, hashlib.sha1(data).hexdigest(), old_digest)
         else:
-            unlink(filename)
-            icon = None
-        self.iconmap[id] = icon
-        return icon
+            unlink(ApplicationData.get(os.path.join('images', id + '.png')))
+            return self._publish(id, None, None, old_digest)
 
-    @run_in_gui_thread(wait=True)
     def store_file(self, id, file):
         id = id.replace('/', '_')
-        directory = ApplicationData.get('images')
-        filename = os.path.join(directory, id + '.png')
+        filename = ApplicationData.get(os.path.join('images', id + '.png'))
         if filename == os.path.normpath(file):
-            return self.iconmap.get(id, None)
-        makedirs(directory)
-        pixmap = QPixmap()
-        if file is not None and pixmap.load(file):
-            if pixmap.size().width() > self.max_size or pixmap.size().height() > self.max_size:
-                pixmap = pixmap.scaled(self.max_size, self.max_size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+            return self.get(id)
+        old_digest = self._get_digest(id)
+        image = QImage(file) if file is not None else QImage()
+        if not image.isNull():
+            if image.width() > self.max_size or image.height() > self.max_size:
+                image = image.scaled(self.max_size, self.max_size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
             buffer = QBuffer()
-            pixmap.save(buffer, 'png')
+            image.save(buffer, 'png')
             data = str(buffer.data())
-            with open(filename, 'wb') as f:
-                f.write(data)
-            icon = QIcon(pixmap)
-            icon.filename = filename
-            icon.content = data
-            icon.content_type = 'image/png'
+            self._write(id, data)
+            ThumbnailCache().prepare(data)
+            return self._publish(id, image, hashlib.sha1(data).hexdigest(), old_digest)
         else:
             unlink(filename)
+            return self._publish(id, None, None, old_digest)
+
+    @run_in_gui_thread(wait=True)
+    def remove(self, id):
+        id = id.replace('/', '_')
+        icon = self.iconmap.pop(id, None)
+        if icon is not None:
+            self.memory_usage -= icon.cost
+        digest = self._get_digest(id)
+        self.digests.pop(id, None)
+        thumbnail_cache = ThumbnailCache()
+        thumbnail_cache.invalidate(id)
+        if digest is not None:
+            thumbnail_cache.remove(digest)
+        unlink(ApplicationData.get(os.path.join('images', id + '.png')))
+
+    def _lookup(self, id):
+        icon = self.iconmap.pop(id)
+        self.iconmap[id] = icon
+        return icon
+
+    def _add(self, id, image, digest):
+        if image is not None:
+            icon = FileIcon(QPixmap.fromImage(image), ApplicationData.get(os.path.join('images', id + '.png')), digest)
+        else:
             icon = None
+        old_icon = self.iconmap.pop(id, None)
+        if old_icon is not None:
+            self.memory_usage -= old_icon.cost
         self.iconmap[id] = icon
+        self.digests[id] = digest if icon is not None else None
+        if icon is not None:
+            self.memory_usage += icon.cost
+        while self.memory_usage > self.memory_limit and len(self.iconmap) > 1:
+            old_id, old_icon = self.iconmap.popitem(last=False)
+            if old_icon is not None:
+                self.memory_usage -= old_icon.cost
         return icon
 
     @run_in_gui_thread(wait=True)
-    def remove(self, id):
+    def _publish(self, id, image, digest, old_digest):
+        thumbnail_cache = ThumbnailCache()
+        thumbnail_cache.invalidate(id)
+        if old_digest not in (None, digest):
+            thumbnail_cache.remove(old_digest)
+        return self._add(id, image, digest)
+
+    def _get_digest(self, id):
+        try:
+            return self.digests[id]
+        except KeyError:
+            try:
+                with open(ApplicationData.get(os.path.join('images', id + '.png')), 'rb') as f:
+                    return hashlib.sha1(f.read()).hexdigest()
+            except (IOError, OSError):
+                return None
+
+    @staticmethod
+    def _load(id):
+        # this only uses QImage, so it is safe to call it from any thread
+        try:
+            with open(ApplicationData.get(os.path.join('images', id + '.png')), 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return None, None
+        image = QImage.fromData(data)
+        if image.isNull():
+            return None, None
+        return image, hashlib.sha1(data).hexdigest()
+
+    @run_in_threadpool(threadpool)
+    def _load_request(self, request):
+        results = []
+        for id in request.ids:
+            image, digest = self._load(id)
+            results.append((id, image, digest))
+            if image is not None:
+                break
+        call_in_gui_thread(self._finish_request, request, results)
+
+    def _finish_request(self, request, results):
+        icon = None
+        for id, image, digest in results:
+            try:
+                icon = self._lookup(id)  # the icon was stored while it was being loaded
+            except KeyError:
+                icon = self._add(id, image, digest)
+            if icon is not None:
+                break
+        if self.requests.get(request.ids) is request:
+            del self.requests[request.ids]
+        request.set_result(icon)
+
+    @staticmethod
+    def _write(id, data):
+        directory = ApplicationData.get('images')
+        filename = os.path.join(directory, id + '.png')
+        makedirs(directory)
+        with open(filename + '.tmp', 'wb') as f:
+            f.write(data)
+        try:
+            os.rename(filename + '.tmp', filename)  # loaders running in the background must never see the file half written
+        except OSError:
+            unlink(filename)
+            os.rename(filename + '.tmp', filename)
+
+
+class ThumbnailCache(object):
+    """Cache the small pixmaps used to display avatars, in memory and on disk"""
+
+    __metaclass__ = Singleton
+
+    size = 32
+    memory_limit = 16*1024*1024  # bytes
+
+    def __init__(self):
+        self.directory = ApplicationData.get('thumbnails')
+        self.pixmaps = OrderedDict()  # key -> pixmap, least recently used first
+        self.memory_usage = 0
+        self.requests = {}  # (ids, size, rounded) -> pending request
+
+    def get(self, icon, size=None, rounded=True):
+        """Return the thumbnail of an icon that is already loaded. It is rendered from the icon and only cached in memory."""
+        size = size or self.size
+        key = self._key(getattr(icon, 'digest', None) or 'icon%d' % icon.cacheKey(), size, rounded)
+        try:
+            return self._lookup(key)
+        except KeyError:
+            return self._add(key, QPixmap.fromImage(self.render(icon.pixmap(size).toImage(), size, rounded)))
+
+    def request(self, ids, size=None, rounded=True):
+        """Return a request for the thumbnail of the first of the icons that exists. The icons are not loaded, as the thumbnail is read or rendered in the background. Must be called from the GUI thread."""
+        size = size or self.size
+        ids = tuple(id.replace('/', '_') for id in ids)
+        try:
+            return self.requests[ids, size, rounded]
+        except KeyError:
+            pass
+        request = IconRequest(ids)
+        digests = IconManager().digests
+        for id in ids:
+            try:
+                digest = digests[id]
+                if digest is not None:
+                    request.set_result(self._lookup(self._key(digest, size, rounded)))
+                    return request
+            except KeyError:
+                break
+        else:
+            request.set_result(None)
+            return request
+        self.requests[ids, size, rounded] = request
+        self._load_request(request, size, rounded, dict((id, digests[id]) for id in ids if id in digests))
+        return request
+
+    def remove(self, digest):
+        """Remove the thumbnails of the icon with the given digest from memory and from disk"""
+        prefix = digest + '-'
+        for key in [key for key in self.pixmaps if key.startswith(prefix)]:
+            pixmap = self.pixmaps.pop(key)
+            self.memory_usage -= pixmap.width() * pixmap.height() * 4
+        self._remove_files(prefix)
+
+    def invalidate(self, id):
+        """Forget the pending requests that involve the icon, as it changed while they were being loaded"""
         id = id.replace('/', '_')
-        self.iconmap.pop(id, None)
-        unlink(ApplicationData.get(os.path.join('images', id + '.png')))
+        for key in [key for key in self.requests if id in key[0]]:
+            del self.requests[key]
+
+    @run_in_thread('file-io')
+    def prepare(self, data, size=None, rounded=True):
+        """Create the thumbnail for an icon ahead of time, so that it will not be rendered in the GUI thread when the icon is first displayed"""
+        size = size or self.size
+        key = self._key(hashlib.sha1(data).hexdigest(), size, rounded)
+        filename = os.path.join(self.directory, key + '.png')
+        if os.path.exists(filename):
+            return
+        image = QImage.fromData(data)
+        if image.isNull():
+            return
+        buffer = QBuffer()
+        self.render(image, size, rounded).save(buffer, 'png')
+        self._write(key, str(buffer.data()))
+
+    @staticmethod
+    def render(image, size, rounded):
+        image = image.scaled(size, size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+        if not rounded:
+            return image
+        thumbnail = QImage(size, size, QImage.Format_ARGB32_Premultiplied)
+        thumbnail.fill(Qt.transparent)
+        path = QPainterPath()
+        path.addRoundedRect(0, 0, size, size, 3.7, 3.7)
+        painter = QPainter(thumbnail)
+        painter.setRenderHint(QPainter.Antialiasing, True)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform, True)
+        painter.setClipPath(path)
+        painter.drawImage((size - image.width()) / 2, (size - image.height()) / 2, image)
+        painter.end()
+        return thumbnail
+
+    @staticmethod
+    def _key(digest, size, rounded):
+        return '%s-%d-%s' % (digest, size, 'rounded' if rounded else 'plain')
+
+    def _lookup(self, key):
+        pixmap = self.pixmaps.pop(key)
+        self.pixmaps[key] = pixmap
+        return pixmap
+
+    def _add(self, key, pixmap):
+        old_pixmap = self.pixmaps.pop(key, None)
+        if old_pixmap is not None:
+            self.memory_usage -= old_pixmap.width() * old_pixmap.height() * 4
+        self.pixmaps[key] = pixmap
+        self.memory_usage += pixmap.width() * pixmap.height() * 4
+        while self.memory_usage > self.memory_limit and len(self.pixmaps) > 1:
+            old_key, old_pixmap = self.pixmaps.popitem(last=False)
+            self.memory_usage -= old_pixmap.width() * old_pixmap.height() * 4
+        return pixmap
+
+    def _load(self, id, digest, size, rounded):
+        # this only uses QImage, so it is safe to call it from any thread
+        if digest is not None:
+            image = QImage(os.path.join(self.directory, self._key(digest, size, rounded) + '.png'))
+            if not image.isNull():
+                return digest, image
+        try:
+            with open(ApplicationData.get(os.path.join('images', id + '.png')), 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return None, None
+        digest = hashlib.sha1(data).hexdigest()
+        key = self._key(digest, size, rounded)
+        image = QImage(os.path.join(self.directory, key + '.png'))
+        if image.isNull():
+            image = QImage.fromData(data)
+            if image.isNull():
+                return None, None
+            image = self.render(image, size, rounded)
+            buffer = QBuffer()
+            image.save(buffer, 'png')
+            self._save(key, str(buffer.data()))
+        return digest, image
+
+    @run_in_threadpool(IconManager.threadpool)
+    def _load_request(self, request, size, rounded, digests):
+        results = []
+        for id in request.ids:
+            digest, image = self._load(id, digests.get(id), size, rounded)
+            results.append((id, digest))
+            if image is not None:
+                break
+        call_in_gui_thread(self._finish_request, request, size, rounded, results, image)
+
+    def _finish_request(self, request, size, rounded, results, image):
+        if self.requests.get((request.ids, size, rounded)) is not request:
+            request.set_result(None)  # an icon was stored or removed meanwhile, so the result may be out of date
+            return
+        del self.requests[request.ids, size, rounded]
+        IconManager().digests.update(results)
+        if image is not None:
+            digest = results[-1][1]
+            request.set_result(self._add(self._key(digest, size, rounded), QPixmap.fromImage(image)))
+        else:
+            request.set_result(None)
+
+    @run_in_thread('file-io')
+    def _save(self, key, data):
+        self._write(key, data)
+
+    @run_in_thread('file-io')
+    def _remove_files(self, prefix):
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        for name in (name for name in names if name.startswith(prefix)):
+            unlink(os.path.join(self.directory, name))
+
+    def _write(self, key, data):
+        filename = os.path.join(self.directory, key + '.png')
+        makedirs(self.directory)
+        with open(filename + '.tmp', 'wb') as f:
+            f.write(data)
+        try:
+            os.rename(filename + '.tmp', filename)  # thumbnails are loaded in the background, so they must never be seen half written
+        except OSError:
+            unlink(filename + '.tmp')
 
 
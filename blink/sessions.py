@@ -46,7 +46,7 @@ from sipsimple.threading import run_in_thread, run_in_twisted_thread
 from blink.configuration.settings import BlinkSettings
 from blink.resources import ApplicationData, Resources
 from blink.screensharing import ScreensharingWindow, VNCClient, ServerDefault
-from blink.util import call_later, run_in_gui_thread
+from blink.util import RingBuffer, call_later, run_in_gui_thread
 from blink.widgets.buttons import LeftSegment, MiddleSegment, RightSegment
 from blink.widgets.labels import Status
 from blink.widgets.color import ColorHelperMixin, ColorUtils, cache_result, background_color_key
@@ -80,11 +80,11 @@ class RTPStreamInfo(object):
         self.remote_address = None
         self.local_rtp_candidate = None
         self.remote_rtp_candidate = None
-        self.latency = deque(maxlen=self.dataset_size)
-        self.packet_loss = deque(maxlen=self.dataset_size)
-        self.jitter = deque(maxlen=self.dataset_size)
-        self.incoming_traffic = deque(maxlen=self.dataset_size)
-        self.outgoing_traffic = deque(maxlen=self.dataset_size)
+        self.latency = RingBuffer(self.dataset_size)
+        self.packet_loss = RingBuffer(self.dataset_size)
+        self.jitter = RingBuffer(self.dataset_size)
+        self.incoming_traffic = RingBuffer(self.dataset_size)
+        self.outgoing_traffic = RingBuffer(self.dataset_size)
         self.bytes_sent = 0
         self.bytes_received = 0
         self._total_packets = 0
@@ -128,6 +128,15 @@ class RTPStreamInfo(object):
             self.bytes_received = statistics['rx']['bytes']
             self.packet_loss.append(sum(self._average_loss_queue) / self.average_interval)
 
+    def reset_counters(self, statistics):
+        """Take the current counters as the reference for the next update, without adding a sample"""
+        if statistics:
+            self._total_packets = statistics['rx']['packets']
+            self._total_packets_lost = statistics['rx']['packets_lost']
+            self._total_packets_discarded = statistics['rx']['packets_discarded']
+            self.bytes_sent = statistics['tx']['bytes']
+            self.bytes_received = statistics['rx']['bytes']
+
     def reset(self):
         self.__init__()
 
@@ -448,6 +457,60 @@ class BlinkSessionBase(object):
         pass
 
 
+class SessionStatisticsTicker(object):
+    """Update the duration and RTP statistics of all connected sessions from a single timer"""
+
+    __metaclass__ = Singleton
+
+    interval = 1000
+
+    def __init__(self):
+        self.sessions = []
+        self.held_sessions = set()
+        self.timer = QTimer()
+        self.timer.setInterval(self.interval)
+        self.timer.timeout.connect(self._SH_TimerFired)
+
+    def add(self, session):
+        if session not in self.sessions:
+            self.sessions.append(session)
+            if not self.timer.isActive():
+                self.timer.start()
+
+    def discard(self, session):
+        self.held_sessions.discard(session)
+        try:
+            self.sessions.remove(session)
+        except ValueError:
+            pass
+        else:
+            if not self.sessions:
+                self.timer.stop()
+
+    def _SH_TimerFired(self):
+        updated_sessions = []
+        for session in self.sessions:
+            session.info.duration += timedelta(seconds=1)
+            if session.on_hold:
+                self.held_sessions.add(session)
+                continue
+            resumed = session in self.held_sessions
+            self.held_sessions.discard(session)
+            for stream_type in ('audio', 'video'):
+                statistics = session.streams.active.get(stream_type, Null).statistics
+                if not statistics:
+                    continue
+                if resumed:
+                    # the counters kept growing during the hold, which would otherwise show up as a spike in the first sample
+                    session.info.streams[stream_type].reset_counters(statistics)
+                else:
+                    session.info.streams[stream_type].update_statistics(statistics)
+            updated_sessions.append(session)
+        if updated_sessions:
+            notification_center = NotificationCenter()
+            notification_center.post_notification('BlinkSessionStatisticsUpdated', sender=self, data=NotificationData(sessions=updated_sessions))
+
+
 class BlinkSession(BlinkSessionBase):
     implements(IObserver)
 
@@ -473,12 +536,8 @@ class BlinkSession(BlinkSessionBase):
 
             self._delete_when_done = False
             self._delete_requested = False
-
-            self.timer = QTimer()
-            self.timer.setInterval(1000)
-            self.timer.timeout.connect(self._SH_TimerFired)
         else:
-            self.timer.stop()
+            SessionStatisticsTicker().discard(self)
 
         self.direction = None
         self.__dict__['active'] = False
@@ -878,7 +937,7 @@ class BlinkSession(BlinkSessionBase):
             self.state = 'ending'
             notification_center.post_notification('BlinkSessionWillEnd', sender=self)
 
-        self.timer.stop()
+        SessionStatisticsTicker().discard(self)
         self.streams.clear()
 
         self.lookup = None
@@ -929,13 +988,6 @@ class BlinkSession(BlinkSessionBase):
         if chat_stream.encryption.active and chat_stream.encryption.peer_name == u'':
             chat_stream.encryption.peer_name = self.info.streams.audio.zrtp_peer_name
 
-    def _SH_TimerFired(self):
-        self.info.duration += timedelta(seconds=1)
-        self.info.streams.audio.update_statistics(self.streams.get('audio', Null).statistics)
-        self.info.streams.video.update_statistics(self.streams.get('video', Null).statistics)
-        notification_center = NotificationCenter()
-        notification_center.post_notification('BlinkSessionInfoUpdated', sender=self, data=NotificationData(elements={'statistics'}))
-
     @run_in_gui_thread
     def handle_notification(self, notification):
         handler = getattr(self, '_NH_%s' % notification.name, Null)
@@ -985,7 +1037,7 @@ class BlinkSession(BlinkSessionBase):
             self.streams.set_active(stream)
         if self.state not in ('ending', 'ended', 'deleted'):
             self.state = 'connected'
-            self.timer.start()
+            SessionStatisticsTicker().add(self)
             self.info.update(self)
             notification.center.post_notification('BlinkSessionDidConnect', sender=self)
             notification.center.post_notification('BlinkSessionInfoUpdated', sender=self, data=NotificationData(elements={'session', 'media'}))
@@ -1197,6 +1249,9 @@ class BlinkSession(BlinkSessionBase):
     def _NH_BlinkContactDidChange(self, notification):
         notification.center.post_notification('BlinkSessionContactDidChange', sender=self)
 
+    def _NH_BlinkContactIconDidChange(self, notification):
+        notification.center.post_notification('BlinkSessionContactDidChange', sender=self)
+
 
 class SMPVerification(Enum):
     Unavailable = u'Unavailable'
@@ -1389,6 +1444,9 @@ class ConferenceParticipant(object):
     def _NH_BlinkContactDidChange(self, notification):
         notification.center.post_notification('ConferenceParticipantDidChange', sender=self)
 
+    def _NH_BlinkContactIconDidChange(self, notification):
+        notification.center.post_notification('ConferenceParticipantDidChange', sender=self)
+
 
 class ServerConference(object):
     implements(IObserver)
@@ -2038,6 +2096,10 @@ class AudioSessionItem(object):
     def send_dtmf(self, digit):
         self.blink_session.send_dtmf(digit)
 
+    def update_statistics(self):
+        self.widget.duration_label.value = self.blink_session.info.duration
+        # TODO: compute packet loss and latency statistics -Saul
+
     def _cleanup(self):
         if self.__deleted__:
             return
@@ -2110,8 +2172,7 @@ class AudioSessionItem(object):
             self.widget.update_rtp_encryption_icon()
             self.srtp = audio_info.encryption is not None
         if 'statistics' in notification.data.elements:
-            self.widget.duration_label.value = self.blink_session.info.duration
-            # TODO: compute packet loss and latency statistics -Saul
+            self.update_statistics()
 
     def _NH_BlinkSessionDidChangeHoldState(self, notification):
         self.widget.hold_button.setChecked(notification.data.local_hold)
@@ -2272,6 +2333,7 @@ class AudioSessionModel(QAbstractListModel):
         notification_center.add_observer(self, name='BlinkSessionDidRemoveStream')
         notification_center.add_observer(self, name='BlinkSessionDidEnd')
         notification_center.add_observer(self, name='BlinkSessionDidChangeClientConference')
+        notification_center.add_observer(self, name='BlinkSessionStatisticsUpdated')
 
     @property
     def active_sessions(self):
@@ -2623,6 +2685,11 @@ class AudioSessionModel(QAbstractListModel):
             call_later(5, self.removeSession, session_item)
             self.structureChanged.emit()
 
+    def _NH_BlinkSessionStatisticsUpdated(self, notification):
+        for session in notification.data.sessions:
+            if session.items.audio is not None:
+                session.items.audio.update_statistics()
+
     def _NH_BlinkSessionWillReinitialize(self, notification):
         session_item = notification.sender.items.audio
         if session_item is not None:
@@ -4,6 +4,8 @@ from PyQt5.QtWidgets import QApplication
 from application.python.decorator import decorator, preserve_signature
 from application.python.descriptor import classproperty
 from application.python.types import Singleton
+from array import array
+from collections import deque
 from functools import partial
 from threading import Event
 from sys import exc_info
@@ -11,13 +13,108 @@ from sys import exc_info
 from blink.event import CallFunctionEvent
 
 
-__all__ = ['QSingleton', 'call_in_gui_thread', 'call_later', 'run_in_gui_thread']
+__all__ = ['QSingleton', 'RingBuffer', 'call_in_gui_thread', 'call_later', 'run_in_gui_thread']
 
 
 class QSingleton(Singleton, type(QObject)):
     """A metaclass for making Qt objects singletons"""
 
 
+class RingBuffer(object):
+    """A fixed size series of numbers stored in an array, where adding a value discards the oldest one once the buffer is full"""
+
+    def __init__(self, maxlen, typecode='f'):
+        self.maxlen = maxlen
+        self._data = array(typecode, [0]) * (2 * maxlen)  # every value is stored twice, maxlen apart, so that the last values are always contiguous
+        self._position = 0  # where the next value goes
+        self._length = 0
+        self._count = 0     # how many values were ever added
+        self._sum = 0.0
+        self._min = deque()  # (count, value) candidates for the minimum, with increasing values
+        self._max = deque()  # (count, value) candidates for the maximum, with decreasing values
+
+    def __len__(self):
+        return self._length
+
+    def __iter__(self):
+        return iter(self.last(self._length))
+
+    def __reversed__(self):
+        return reversed(self.last(self._length))
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError('RingBuffer index out of range')
+        return self._data[self._position + self.maxlen - self._length + index]
+
+    def append(self, value):
+        if self.maxlen == 0:
+            return
+        position = self._position
+        if self._length == self.maxlen:
+            self._sum -= self._data[position]
+        else:
+            self._length += 1
+        self._data[position] = self._data[position + self.maxlen] = value
+        value = self._data[position]  # use the value as stored, so that the running sum does not drift
+        self._sum += value
+        self._position = (position + 1) % self.maxlen
+        self._count += 1
+        oldest = self._count - self._length  # the values added before this one are no longer in the buffer
+        while self._min and self._min[-1][1] >= value:
+            self._min.pop()
+        self._min.append((self._count, value))
+        if self._min[0][0] <= oldest:
+            self._min.popleft()
+        while self._max and self._max[-1][1] <= value:
+            self._max.pop()
+        self._max.append((self._count, value))
+        if self._max[0][0] <= oldest:
+            self._max.popleft()
+
+    @property
+    def count(self):
+        """The number of values ever added to the buffer"""
+        return self._count
+
+    def last(self, count):
+        """
+        Return the last count values as an array, oldest first. The values are
+        stored twice, so this is a single contiguous slice. It is a copy, as a
+        Python 2 array cannot be viewed as floats without copying (memoryview
+        does not support it and buffer only exposes the bytes), but copying a
+        visible window of a few hundred values in C is cheaper than iterating
+        over a view object in Python.
+        """
+        count = max(min(count, self._length), 0)
+        end = self._position + self.maxlen
+        return self._data[end - count:end]
+
+    def max_of_last(self, count):
+        """Return the maximum of the last count values, using the candidates kept for the running maximum"""
+        oldest = self._count - max(min(count, self._length), 0)  # the values added up to this one are not among the last count values
+        value = None
+        for position, candidate in reversed(self._max):
+            if position <= oldest:
+                break
+            value = candidate
+        return value
+
+    @property
+    def min(self):
+        return self._min[0][1] if self._length else None
+
+    @property
+    def max(self):
+        return self._max[0][1] if self._length else None
+
+    @property
+    def mean(self):
+        return self._sum / self._length if self._length else None
+
+
 def call_later(interval, function, *args, **kw):
     QTimer.singleShot(int(interval*1000), lambda: function(*args, **kw))
 
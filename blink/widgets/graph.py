@@ -1,6 +1,6 @@
 
-from PyQt5.QtCore import Qt, QLineF, QPointF, QMetaObject, pyqtSignal
-from PyQt5.QtGui import QColor, QLinearGradient, QPainterPath, QPen, QPolygonF
+from PyQt5.QtCore import Qt, QLineF, QPointF, QMetaObject, QRect, pyqtSignal
+from PyQt5.QtGui import QColor, QLinearGradient, QPainter, QPainterPath, QPen, QPixmap, QPolygonF
 from PyQt5.QtWidgets import QStyle, QStyleOption, QStylePainter, QWidget
 
 from abc import ABCMeta, abstractmethod
@@ -9,6 +9,7 @@ from collections import deque
 from itertools import chain, islice
 from math import ceil, log10, modf
 
+from blink.util import RingBuffer
 from blink.widgets.color import ColorHelperMixin
 from blink.widgets.util import QtDynamicProperty
 
@@ -71,12 +72,33 @@ class Graph(object):
 
     @property
     def max_value(self):
-        return max(self.data) if self.data else 0
+        """The maximum of all the values in the data, see max_of_last for the maximum of the visible ones"""
+        if not self.data:
+            return 0
+        return self.data.max if isinstance(self.data, RingBuffer) else max(self.data)
+
+    @property
+    def count(self):
+        """The number of values ever added to the data or None if it cannot be determined"""
+        return self.data.count if isinstance(self.data, RingBuffer) else None
 
     @property
     def last_value(self):
         return self.data[-1] if self.data else 0
 
+    def last(self, count):
+        """Return the last count values, oldest first"""
+        if isinstance(self.data, RingBuffer):
+            return self.data.last(count)
+        return list(islice(reversed(self.data), count))[::-1]
+
+    def max_of_last(self, count):
+        """Return the maximum of the last count values"""
+        if isinstance(self.data, RingBuffer):
+            value = self.data.max_of_last(count)
+            return value if value is not None else 0
+        return max(islice(reversed(self.data), count)) if self.data and count > 0 else 0
+
 
 class GraphWidget(QWidget, ColorHelperMixin):
     graphStyle = QtDynamicProperty('graphStyle', type=int)
@@ -114,6 +136,10 @@ class GraphWidget(QWidget, ColorHelperMixin):
         self.__dict__['graph_width'] = 0
         self.__dict__['graph_height'] = 0
         self.__dict__['max_value'] = 0
+        self._pixmap = QPixmap()
+        self._rendering_key = None
+        self._rendered_counts = {}
+        self._max_values = {}  # graph -> ((data, count, width), max value of the last width values)
 
     def _get_scaler(self):
         return self.__dict__['scaler']
@@ -149,7 +175,8 @@ class GraphWidget(QWidget, ColorHelperMixin):
         else:
             graph_width = self.__dict__['graph_width'] = int(ceil(float(contents_rect.width() - 1) / self.horizontalPixelsPerUnit) + 1)
 
-        max_value = self.__dict__['max_value'] = max(chain([0], *(islice(reversed(graph.data), graph_width) for graph in self.graphs if graph.enabled)))
+        graphs = [graph for graph in self.graphs if graph.enabled]
+        max_value = self.__dict__['max_value'] = max(chain([0], self._get_max_values(graphs, graph_width)))
 
         if self.graphHeight == self.AutomaticHeight or self.graphHeight < 0:
             graph_height = self.__dict__['graph_height'] = max(self.scaler.get_height(max_value), self.minHeight)
@@ -161,18 +188,90 @@ class GraphWidget(QWidget, ColorHelperMixin):
         else:
             height_scaling = float(contents_rect.height() - self.lineThickness) / graph_height
 
+        self._update_pixmap(contents_rect.size(), graphs, graph_width, graph_height, height_scaling)
+
         painter = QStylePainter(self)
         painter.drawPrimitive(QStyle.PE_Widget, option)
 
         painter.setClipRect(contents_rect)
+        painter.drawPixmap(contents_rect.topLeft(), self._pixmap)
+
+        if self.boundary is not None and self.boundaryColor:
+            painter.save()
+            painter.translate(contents_rect.x() + contents_rect.width() - 1, contents_rect.y() + contents_rect.height() - 1)
+            painter.scale(-1, -1)
+            painter.setPen(QPen(self.boundaryColor, 1.0))
+            painter.drawLine(0, self.boundary*height_scaling, contents_rect.width(), self.boundary*height_scaling)
+            painter.restore()
+
+        # queue the 'updated' signal to be emitted after returning to the main loop
+        QMetaObject.invokeMethod(self, 'updated', Qt.QueuedConnection)
 
-        painter.save()
-        painter.translate(contents_rect.x() + contents_rect.width() - 1, contents_rect.y() + contents_rect.height() - 1)
+    def _get_max_values(self, graphs, graph_width):
+        # the maximum of the visible values only changes when values are added or the width changes, so it is not computed for every paint
+        max_values = {}
+        for graph in graphs:
+            key = graph.data, graph.count, graph_width
+            try:
+                cached_key, max_value = self._max_values[graph]
+            except KeyError:
+                cached_key = None
+            if cached_key != key or graph.count is None:
+                max_value = graph.max_of_last(graph_width)
+            max_values[graph] = key, max_value
+        self._max_values = max_values
+        return [entry[1] for entry in max_values.itervalues()]
+
+    def _update_pixmap(self, size, graphs, graph_width, graph_height, height_scaling):
+        """Bring the offscreen pixmap with the rendered graphs up to date, by scrolling it and only drawing the new values if possible"""
+        pixel_ratio = self.devicePixelRatioF()
+        rendering_key = (size, pixel_ratio, graph_height, self.graphStyle, self.lineThickness, self.horizontalPixelsPerUnit, self.boundary, self.smoothEnvelope, self.smoothFactor, self.fillEnvelope, self.fillTransparency,
+                         [(graph, graph.data, graph.color, graph.over_boundary_color, graph.fill_envelope) for graph in graphs])
+        counts = {graph: graph.count for graph in graphs}
+
+        new_values = {counts[graph] - self._rendered_counts[graph] if None not in (counts[graph], self._rendered_counts.get(graph)) else None for graph in graphs if graph.data}
+        if rendering_key != self._rendering_key or len(new_values) > 1 or None in new_values:
+            new_values = None
+        else:
+            new_values = new_values.pop() if new_values else 0
+
+        if new_values == 0:
+            return
+        elif new_values is None or new_values >= graph_width:
+            self._pixmap = QPixmap(size * pixel_ratio)
+            self._pixmap.setDevicePixelRatio(pixel_ratio)
+            self._pixmap.fill(Qt.transparent)
+            painter = QPainter(self._pixmap)
+            datasets = {graph: graph.last(graph_width) for graph in graphs}
+        else:
+            # scroll the existing image to make room for the new values and redraw the part that changed, including the last 2 old values, because
+            # the smoothing of the envelope for the old values close to the new ones depends on the new values (it is negligible for older values)
+            shift = new_values * self.horizontalPixelsPerUnit
+            redraw_width = min((new_values + 2) * self.horizontalPixelsPerUnit, size.width())
+            pixmap = QPixmap(size * pixel_ratio)
+            pixmap.setDevicePixelRatio(pixel_ratio)
+            pixmap.fill(Qt.transparent)
+            painter = QPainter(pixmap)
+            painter.drawPixmap(QPointF(-shift, 0), self._pixmap)
+            painter.setClipRect(QRect(size.width() - redraw_width, 0, redraw_width, size.height()))
+            painter.setCompositionMode(QPainter.CompositionMode_Clear)
+            painter.fillRect(pixmap.rect(), Qt.transparent)
+            painter.setCompositionMode(QPainter.CompositionMode_SourceOver)
+            datasets = {graph: graph.last(new_values + 5) for graph in graphs}
+            self._pixmap = pixmap
+
+        painter.translate(size.width() - 1, size.height() - 1)
         painter.scale(-1, -1)
+        self._draw_graphs(painter, datasets, graph_height, height_scaling)
+        painter.end()
+
+        self._rendering_key = rendering_key
+        self._rendered_counts = counts
 
-        painter.setRenderHint(QStylePainter.Antialiasing, self.graphStyle != self.BarStyle)
+    def _draw_graphs(self, painter, datasets, graph_height, height_scaling):
+        painter.setRenderHint(QPainter.Antialiasing, self.graphStyle != self.BarStyle)
 
-        for graph in (graph for graph in self.graphs if graph.enabled and graph.data):
+        for graph in (graph for graph in self.graphs if graph in datasets and datasets[graph]):
             if self.boundary is not None and 0 < self.boundary < graph_height:
                 boundary_width = min(5.0/height_scaling, self.boundary-0, graph_height-self.boundary)
                 pen_color = QLinearGradient(0, (self.boundary - boundary_width) * height_scaling, 0, (self.boundary + boundary_width) * height_scaling)
@@ -184,7 +283,7 @@ class GraphWidget(QWidget, ColorHelperMixin):
             else:
                 pen_color = graph.color
                 brush_color = self.color_with_alpha(graph.color, self.fillTransparency)
-            dataset = islice(reversed(graph.data), graph_width)
+            dataset = reversed(datasets[graph])
             if self.graphStyle == self.BarStyle:
                 lines = [QLineF(x*self.horizontalPixelsPerUnit, 0, x*self.horizontalPixelsPerUnit, y*height_scaling) for x, y in enumerate(dataset)]
                 painter.setPen(QPen(pen_color, self.lineThickness))
@@ -231,16 +330,6 @@ class GraphWidget(QWidget, ColorHelperMixin):
 
                 painter.translate(0, -self.lineThickness/2 + 1)
 
-        if self.boundary is not None and self.boundaryColor:
-            painter.setRenderHint(QStylePainter.Antialiasing, False)
-            painter.setPen(QPen(self.boundaryColor, 1.0))
-            painter.drawLine(0, self.boundary*height_scaling, contents_rect.width(), self.boundary*height_scaling)
-
-        painter.restore()
-
-        # queue the 'updated' signal to be emitted after returning to the main loop
-        QMetaObject.invokeMethod(self, 'updated', Qt.QueuedConnection)
-
     def add_graph(self, graph):
         if not isinstance(graph, Graph):
             raise TypeError("graph should be an instance of Graph")